@@ -1,18 +1,17 @@
-from collections import OrderedDict
 from tempfile import TemporaryFile
 
 import numpy
-from django.contrib.gis.gdal import GDALRaster
 from django.core.files import File
-from raster.rasterize import rasterize
-from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
-from raster.tiles.utils import tile_bounds, tile_index_range
+from raster.tiles.const import WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import tile_index_range
 
-from classify.const import SCALE
+from classify.dataset import TrainingDataset, open_training_dataset
 from classify.models import TrainingPixels, TrainingPixelsPatch
 from classify.tasks import get_rasterlayer_ids
 from jobs import ecs
-from sentinel.utils import get_raster_tile
+from sentinel.tilecache import use_tile_cache
+from sentinel.tileindex import use_tile_index
+from sentinel.utils import TileRasterizer, get_raster_tiles
 
 ZOOM = 14
 GEOM_NAME_TEMPLATE = 'Y_{}'
@@ -61,67 +60,50 @@ def combine_trainingpixels_patches_2d(tp):
 
 def combine_trainingpixels_patches_flatten(tp):
     """
-    Combine all trainingpatches into one npz file where pixels are flattened
-    so that 2D structure is lost.
+    Combine all trainingpatches into one training dataset where pixels are
+    flattened so that 2D structure is lost. The patches contain flattened
+    pixels already, their rows are copied in chunks.
     """
-    # Prepare data containers.
-    Xs = OrderedDict()
-    Ys = OrderedDict()
     categories = {}
-    for patch in tp.trainingpixelspatch_set.all():
-        patch_data = numpy.load(patch.collected_pixels)
-        for key, val in patch_data.items():
-            # Process category dict.
-            if key == CATEGORIES_KEY:
-                categories.update({catkey: int(catval) for catkey, catval in val})
-                continue
-            # Split key name to determine X vs Y and get the PK of the sample.
-            xory, pk = key.split('_')
-            pk = int(pk)
-            if xory == 'X':
-                # We are not (yet) interested in the 2D shape of the sample, so
-                # lets ravel things down to the pixel level.
-                new_shp = (val.shape[0], val.shape[1], val.shape[2] * val.shape[3])
-                val = val.reshape(new_shp)
-                val = val.swapaxes(0, 2)
-                val = val.swapaxes(1, 2)
-                # Drop any pixel that has nodata in any of the timesteps or bands.
-                val = val[~numpy.any(val == NODATA, axis=(1, 2))]
-                Xs[pk] = val
-            else:
-                # Only keep the class number by id, the shape of the training
-                # will be lost but is not (yet) of interest.
-                Ys[pk] = numpy.unique(val[val > 0])
-    # Select datatype for Y.
     y_dtype = Y_DTYPE_CONTINUOUS if tp.traininglayer.continuous else Y_DTYPE
-    # Construct training pixel level 1D data arrays.
-    Ys1D = []
-    sample_ids = []
-    for pk, val in Xs.items():
-        Ys1D.append((numpy.ones(val.shape[0]) * Ys[pk]).astype(y_dtype))
-        sample_ids.append((numpy.ones(val.shape[0]) * pk).astype(SID_DTYPE))
-    # Stack Xs and Ys.
-    X = numpy.vstack(list(Xs.values()))
-    Y = numpy.hstack(Ys1D)
-    # Pixel IDs.
-    PID = numpy.arange(Y.shape[0]) + 1
-    # Sample IDs.
-    SID = numpy.hstack(sample_ids)
-    # Add categories to traininglayer, swapping keys with values because that
-    # is how the traininglayer legend should be stored.
-    tp.traininglayer.legend = {val: key for key, val in categories.items()}
-    tp.traininglayer.save()
-    # Convert categories dict to array (to avoid pickling objects).
-    categories = numpy.array([numpy.array([key, val]) for key, val in categories.items()])
-    # Store collected items.
     with TemporaryFile() as fl:
-        numpy.savez_compressed(fl, X=X, Y=Y, PID=PID, SID=SID, categories=categories)
-        name = 'trainingpixels-collected-pixels-{}.npz'.format(tp.id)
+        with TrainingDataset(fl, 'w') as dataset:
+            for patch in tp.trainingpixelspatch_set.all():
+                for X, Y, SID in read_trainingpixels_patch(patch, categories, y_dtype):
+                    # Pixel IDs.
+                    PID = numpy.arange(len(dataset), len(dataset) + len(Y)) + 1
+                    dataset.append(X=X, Y=Y, PID=PID, SID=SID)
+            dataset.categories = categories
+        # Add categories to traininglayer, swapping keys with values because
+        # that is how the traininglayer legend should be stored.
+        tp.traininglayer.legend = {val: key for key, val in categories.items()}
+        tp.traininglayer.save()
+        # Store collected items.
+        name = 'trainingpixels-collected-pixels-{}.hdf5'.format(tp.id)
         tp.collected_pixels.save(name, File(fl))
 
     return tp
 
 
+def read_trainingpixels_patch(patch, categories, y_dtype):
+    """
+    Iterate over the flattened pixel rows of a trainingpixels patch in blocks
+    of (X, Y, SID) arrays. The categories of the patch are added to the
+    categories dict.
+    """
+    # Pixels collected before the dataset format are stored as npz files with
+    # the 2D pixel stacks of each sample.
+    if patch.collected_pixels.name.endswith('.npz'):
+        patch_data = dict(numpy.load(patch.collected_pixels))
+        categories.update({catkey: int(catval) for catkey, catval in patch_data.pop(CATEGORIES_KEY, [])})
+        for sample_id, X, Y in flatten_trainingpixels_patch(patch_data, y_dtype):
+            yield X, Y, numpy.full(len(Y), sample_id, dtype=SID_DTYPE)
+        return
+    with open_training_dataset(patch.collected_pixels) as patch_data:
+        categories.update(patch_data.categories)
+        yield from patch_data.chunks('X', 'Y', 'SID')
+
+
 def populate_trainingpixels(trainingpixels_id):
     """
     Create trainingpixel patches and push their collection tasks.
@@ -143,6 +125,8 @@ def populate_trainingpixels(trainingpixels_id):
         ecs.populate_trainingpixels_patch(patch.id, tp.needs_large_instance)
 
 
+@use_tile_cache()
+@use_tile_index()
 def populate_trainingpixels_patch(trainingpixelspatch_id):
     """
     Collect pixels for one trainingpixels patch.
@@ -154,11 +138,13 @@ def populate_trainingpixels_patch(trainingpixelspatch_id):
     trainingpixels = patch.trainingpixels
     composites = trainingpixels.composites.all().order_by('min_date')
     band_names = trainingpixels.band_names.split(',')
+    all_touched = trainingpixels.training_all_touched
     # Select datatype for Y.
     y_dtype = Y_DTYPE_CONTINUOUS if trainingpixels.traininglayer.continuous else Y_DTYPE
     # Prepare data containers.
     result = {}
     categories = {}
+    samples = []
     for sample in trainingpixels.traininglayer.trainingsample_set.order_by('id').all()[patch.index_from:patch.index_to]:
         # Track categories.
         if not trainingpixels.traininglayer.continuous:
@@ -170,19 +156,24 @@ def populate_trainingpixels_patch(trainingpixelspatch_id):
             continue
         # Get geometry in web mercator projection.
         geom = sample.geom.transform(3857, clone=True)
+        # Buffer geom if required.
+        geom_buffered = geom.buffer(trainingpixels.buffer) if trainingpixels.buffer else None
+        samples.append((sample, rasterlayer_ids_lookups, geom, geom_buffered))
+    # Rasterize the geometries of all samples together, tile by tile.
+    rasterizer = TileRasterizer([geom for sample, lookups, geom, geom_buffered in samples], ZOOM, all_touched)
+    if trainingpixels.buffer:
+        rasterizer_buffered = TileRasterizer([geom_buffered for sample, lookups, geom, geom_buffered in samples], ZOOM, all_touched)
+    for index, (sample, rasterlayer_ids_lookups, geom, geom_buffered) in enumerate(samples):
         # Compute tile range for this geom.
-        geom_buffered = None
         if trainingpixels.buffer:
-            # Buffer geom if required.
-            geom_buffered = geom.buffer(trainingpixels.buffer)
             idx = tile_index_range(geom_buffered.extent, ZOOM)
         else:
             idx = tile_index_range(geom.extent, ZOOM)
         # Rasterize geom and set pixel values to class value.
-        geom_pixels = get_pixels(idx, geom, trainingpixels.training_all_touched).astype(y_dtype)
+        geom_pixels = get_geom_pixels(idx, rasterizer, index).astype(y_dtype)
         # Compute clipping mask.
         if trainingpixels.buffer:
-            geom_buffered_pixels = get_pixels(idx, geom_buffered, trainingpixels.training_all_touched).astype(y_dtype)
+            geom_buffered_pixels = get_geom_pixels(idx, rasterizer_buffered, index).astype(y_dtype)
             geom_mask = geom_buffered_pixels == 0
         else:
             geom_mask = geom_pixels == 0
@@ -192,32 +183,34 @@ def populate_trainingpixels_patch(trainingpixelspatch_id):
         result[GEOM_NAME_TEMPLATE.format(sample.id)] = geom_pixels
         # Get pixels.
         patch_result = []
-        ignore_sample = False
         for rasterlayer_ids in rasterlayer_ids_lookups:
-            if ignore_sample:
+            composite_pixels = get_pixels(idx, rasterlayer_ids)
+            # Ignore the sample if any band tile could not be found.
+            if composite_pixels is None:
                 break
-            composite_pixels = []
-            for rasterlayer_id in rasterlayer_ids:
-                band_pixels = get_pixels(idx, rasterlayer_id)
-                if band_pixels is None:
-                    ignore_sample = True
-                    break
-                # Clip band to geometry to reduce compressed data size.
-                band_pixels[geom_mask] = NODATA
-                composite_pixels.append(band_pixels)
-            patch_result.append(numpy.array(composite_pixels))
-        # Add this sample pixel stack to result dictionary, if there was data
-        # for this sample.
-        if not ignore_sample:
+            # Clip bands to geometry to reduce compressed data size.
+            composite_pixels[:, geom_mask] = NODATA
+            patch_result.append(composite_pixels)
+        else:
+            # Add this sample pixel stack to result dictionary, if there was
+            # data for this sample.
             result[PIXELS_NAME_TEMPLATE.format(sample.id)] = numpy.array(patch_result)
-    # Track categories present.
-    if not trainingpixels.traininglayer.continuous:
-        result[CATEGORIES_KEY] = numpy.array([numpy.array([key, val]) for key, val in categories.items()])
     # Store collected pixels.
     patch.write('Successfully collected pixels, storing result.', TrainingPixelsPatch.PROCESSING)
     with TemporaryFile() as fl:
-        numpy.savez_compressed(fl, **result)
-        name = 'trainingpixelspatch-collected-pixels-{}.npz'.format(patch.id)
+        if trainingpixels.flatten:
+            # Write the flattened pixels of all samples to a training dataset.
+            with TrainingDataset(fl, 'w') as dataset:
+                for sample_id, X, Y in flatten_trainingpixels_patch(result, y_dtype):
+                    dataset.append(X=X, Y=Y, SID=numpy.full(len(Y), sample_id, dtype=SID_DTYPE))
+                dataset.categories = categories
+            name = 'trainingpixelspatch-collected-pixels-{}.hdf5'.format(patch.id)
+        else:
+            # Track categories present.
+            if not trainingpixels.traininglayer.continuous:
+                result[CATEGORIES_KEY] = numpy.array([numpy.array([key, val]) for key, val in categories.items()])
+            numpy.savez_compressed(fl, **result)
+            name = 'trainingpixelspatch-collected-pixels-{}.npz'.format(patch.id)
         patch.collected_pixels.save(name, File(fl))
     patch.write('Successfully collected pixels, storing result.', TrainingPixelsPatch.FINISHED)
     # Push combination of patches into one file when all patches are done.
@@ -226,23 +219,61 @@ def populate_trainingpixels_patch(trainingpixelspatch_id):
         ecs.combine_trainingpixels_patches(patch.trainingpixels_id)
 
 
-def get_pixels(idx, src, all_touched=None):
+def flatten_trainingpixels_patch(result, y_dtype):
     """
-    Collect pixels over an index range and either a rasterlayer ID or as a
-    rasterized geometry.
+    Convert the 2D pixel stacks of the samples in a patch to pixel rows. Yields
+    the sample id, the pixel values and the sample values of each sample.
+    """
+    for key, val in result.items():
+        # Split key name to determine X vs Y and get the PK of the sample.
+        xory, pk = key.split('_')
+        if xory != 'X':
+            continue
+        # We are not (yet) interested in the 2D shape of the sample, so lets
+        # ravel things down to the pixel level.
+        new_shp = (val.shape[0], val.shape[1], val.shape[2] * val.shape[3])
+        val = val.reshape(new_shp)
+        val = val.swapaxes(0, 2)
+        val = val.swapaxes(1, 2)
+        # Drop any pixel that has nodata in any of the timesteps or bands.
+        val = val[~numpy.any(val == NODATA, axis=(1, 2))]
+        # Only keep the class number by id, the shape of the training will be
+        # lost but is not (yet) of interest.
+        geom_pixels = result[GEOM_NAME_TEMPLATE.format(pk)]
+        Y = (numpy.ones(val.shape[0]) * numpy.unique(geom_pixels[geom_pixels > 0])).astype(y_dtype)
+        yield int(pk), val, Y
+
+
+def get_pixels(idx, rasterlayer_ids):
+    """
+    Collect the pixels of multiple rasterlayers over an index range. The tiles
+    of all layers are fetched at once. Returns an array with one mosaic per
+    rasterlayer, or None if any of the tiles could not be found.
+    """
+    tilexs = range(idx[0], idx[2] + 1)
+    tileys = range(idx[1], idx[3] + 1)
+    tiles = get_raster_tiles([(rasterlayer_id, ZOOM, tilex, tiley) for rasterlayer_id in rasterlayer_ids for tilex in tilexs for tiley in tileys])
+    # Abort pixel collection if a tile could not be found.
+    if not all(tiles):
+        return
+    tiles = iter(tiles)
+    result = []
+    for rasterlayer_id in rasterlayer_ids:
+        result.append(numpy.hstack([numpy.vstack([next(tiles).bands[0].data() for tiley in tileys]) for tilex in tilexs]))
+    return numpy.array(result)
+
+
+def get_geom_pixels(idx, rasterizer, index):
+    """
+    Collect the rasterized pixels of a sample geometry over an index range.
     """
     hstack = []
     for tilex in range(idx[0], idx[2] + 1):
         vstack = []
         for tiley in range(idx[1], idx[3] + 1):
-            if isinstance(src, int):
-                tile = get_raster_tile(src, ZOOM, tilex, tiley)
-                # Abort pixel collection if tile could not be found.
-                if not tile:
-                    return
-                vstack.append(tile.bands[0].data())
-            else:
-                vstack.append(rasterize_geom(src, ZOOM, tilex, tiley, all_touched))
+            pixels = numpy.zeros(WEB_MERCATOR_TILESIZE ** 2, dtype='uint8')
+            pixels[rasterizer.pixels(index, tilex, tiley)] = 1
+            vstack.append(pixels.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE))
         hstack.append(numpy.vstack(vstack))
     return numpy.hstack(hstack)
 
@@ -286,25 +317,3 @@ def prepare_sample_lookups(trainingpixels_id, sample, composites, look_back_step
         sample_composites = composites
 
     return [get_rasterlayer_ids(band_names, composite.rasterlayer_lookup) for composite in sample_composites]
-
-
-def rasterize_geom(geom, tilez, tilex, tiley, all_touched):
-    """
-    Rasterize a geometry over a tile.
-    """
-    # Create a target raster for the rasterization.
-    bounds = tile_bounds(tilex, tiley, tilez)
-    rast = GDALRaster(
-        {
-            'width': WEB_MERCATOR_TILESIZE,
-            'height': WEB_MERCATOR_TILESIZE,
-            'srid': WEB_MERCATOR_SRID,
-            'scale': [SCALE, -SCALE],
-            'origin': [bounds[0], bounds[3]],
-            'datatype': 1,
-            'nr_of_bands': 1,
-        }
-    )
-    # Rasterize the sample area.
-    sample_rast = rasterize(geom, rast, all_touched=all_touched)
-    return sample_rast.bands[0].data()
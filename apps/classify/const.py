@@ -54,3 +54,6 @@ KERAS_FIT_ARGS = [
 ]
 
 KERAS_TRAIN_TYPE = 'float16'
+
+# Number of rows per chunk in on-disk training datasets.
+TRAINING_DATASET_CHUNK_ROWS = 4096
@@ -0,0 +1,120 @@
+import json
+import shutil
+from tempfile import TemporaryFile
+
+import h5py
+import numpy
+
+from classify.const import TRAINING_DATASET_CHUNK_ROWS
+
+# Attribute name of the category lookup in the dataset file.
+CATEGORIES_ATTRIBUTE = 'categories'
+
+
+class TrainingDataset(object):
+    """
+    On-disk training data, stored in a HDF5 file with one chunked dataset per
+    column. Rows are appended in blocks and the columns are read back as HDF5
+    datasets, so the data does not need to fit into memory.
+    """
+
+    def __init__(self, fl, mode='r', chunk_rows=TRAINING_DATASET_CHUNK_ROWS):
+        # Keep a reference to the file object, h5py only reads through it.
+        self.fl = fl
+        self.file = h5py.File(fl, mode)
+        self.chunk_rows = chunk_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, name):
+        return self.file[name]
+
+    def __contains__(self, name):
+        return name in self.file
+
+    def __len__(self):
+        columns = list(self.file.values())
+        return len(columns[0]) if columns else 0
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def categories(self):
+        return json.loads(self.file.attrs.get(CATEGORIES_ATTRIBUTE, '{}'))
+
+    @categories.setter
+    def categories(self, value):
+        self.file.attrs[CATEGORIES_ATTRIBUTE] = json.dumps(value)
+
+    def append(self, **arrays):
+        """
+        Add rows to the dataset, with one array per column. The columns are
+        created on the first append. The arrays can be memory mapped, they are
+        copied in blocks of chunk rows.
+        """
+        rows = {len(array) for array in arrays.values()}
+        if len(rows) != 1:
+            raise ValueError('All columns require the same number of rows.')
+        rows = rows.pop()
+        for name, array in arrays.items():
+            if name not in self.file:
+                self.file.create_dataset(
+                    name,
+                    shape=(0, ) + array.shape[1:],
+                    maxshape=(None, ) + array.shape[1:],
+                    dtype=array.dtype,
+                    chunks=(self.chunk_rows, ) + array.shape[1:],
+                    compression='gzip',
+                    shuffle=True,
+                )
+            column = self.file[name]
+            if column.shape[1:] != array.shape[1:]:
+                raise ValueError('Can not append rows of shape {} to column {} with row shape {}.'.format(array.shape[1:], name, column.shape[1:]))
+            offset = len(column)
+            column.resize(offset + rows, axis=0)
+            for start in range(0, rows, self.chunk_rows):
+                column[offset + start:offset + start + self.chunk_rows] = array[start:start + self.chunk_rows]
+
+    def chunks(self, *names):
+        """
+        Iterate over the rows of the given columns in blocks of chunk rows.
+        Yields one tuple of arrays per block.
+        """
+        for start in range(0, len(self), self.chunk_rows):
+            yield tuple(self.file[name][start:start + self.chunk_rows] for name in names)
+
+
+def open_training_dataset(field_file):
+    """
+    Open a training dataset stored in a file field. The file is copied into a
+    local temporary file, so that the rows can be read with random access.
+    """
+    fl = TemporaryFile()
+    field_file.open('rb')
+    try:
+        shutil.copyfileobj(field_file, fl)
+    finally:
+        field_file.close()
+    fl.seek(0)
+    return TrainingDataset(fl)
+
+
+def read_rows(data, rows):
+    """
+    Read rows from an array, memory map or HDF5 dataset. The row indices are
+    expected in ascending order. Consecutive rows are read as slices, which is
+    much faster than point selections for on-disk data.
+    """
+    if isinstance(data, numpy.ndarray) and not isinstance(data, numpy.memmap):
+        return data[rows]
+    if not len(rows):
+        return data[0:0]
+    breaks = numpy.flatnonzero(numpy.diff(rows) != 1) + 1
+    starts = numpy.concatenate([[0], breaks])
+    ends = numpy.concatenate([breaks, [len(rows)]])
+    return numpy.concatenate([data[rows[start]:rows[end - 1] + 1] for start, end in zip(starts, ends)])
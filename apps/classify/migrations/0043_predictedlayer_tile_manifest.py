@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classify', '0042_predictedlayer_store_class_probabilities'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictedlayer',
+            name='tile_manifest',
+            field=models.FileField(blank=True, editable=False, help_text='Sorted tile indices of the prediction, the chunks are slices of this list.', null=True, upload_to='clouds/predictedlayers'),
+        ),
+    ]
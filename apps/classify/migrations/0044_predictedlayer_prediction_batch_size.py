@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classify', '0043_predictedlayer_tile_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictedlayer',
+            name='prediction_batch_size',
+            field=models.PositiveIntegerField(default=8, help_text='Number of tiles that are predicted together in one batch. Reduce size for predictions with many composites.'),
+        ),
+    ]
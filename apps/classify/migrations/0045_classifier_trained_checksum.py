@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classify', '0044_predictedlayer_prediction_batch_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='classifier',
+            name='trained_checksum',
+            field=models.CharField(blank=True, default='', editable=False, help_text='SHA256 checksum of the trained file, used as key for the local model cache.', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classify', '0045_classifier_trained_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictedlayerchunk',
+            name='written_tiles',
+            field=models.FileField(blank=True, editable=False, help_text='Numpy array with the indices of the tiles written by this chunk.', null=True, upload_to='clouds/predictedlayers'),
+        ),
+    ]
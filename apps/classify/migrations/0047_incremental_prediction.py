@@ -0,0 +1,28 @@
+# Generated by Django 3.0.8 on 2026-10-17 13:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classify', '0046_predictedlayerchunk_written_tiles'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='predictedlayer',
+            name='incremental',
+            field=models.BooleanField(default=False, help_text='Only predict tiles for which the classifier or the input tiles changed since the last prediction, and only rebuild the affected pyramid tiles. Ignored for sieving.'),
+        ),
+        migrations.AddField(
+            model_name='predictedlayer',
+            name='tile_fingerprints',
+            field=models.FileField(blank=True, editable=False, help_text='Numpy array with the input fingerprints of the tiles from the last incremental prediction.', null=True, upload_to='clouds/predictedlayers'),
+        ),
+        migrations.AddField(
+            model_name='predictedlayerchunk',
+            name='tile_fingerprints',
+            field=models.FileField(blank=True, editable=False, help_text='Numpy array with the input fingerprints of the tiles of this chunk.', null=True, upload_to='clouds/predictedlayers'),
+        ),
+    ]
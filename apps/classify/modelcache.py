@@ -0,0 +1,136 @@
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+import structlog
+from django.conf import settings
+
+from classify.const import PIPELINE_ESTIMATOR_NAME, ZIP_ESTIMATOR_NAME, ZIP_PIPELINE_NAME
+from classify.models import Classifier
+
+logger = structlog.get_logger('django_structlog')
+
+# Models loaded in this process, keyed by the checksum of the trained file.
+_models = OrderedDict()
+_models_lock = threading.Lock()
+
+
+def trained_checksum(data):
+    """
+    Checksum of the trained model file bytes, used as cache key.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_cache_path(checksum, extension):
+    """
+    Path of a model in the local model cache directory, or None if the disk
+    cache is disabled.
+    """
+    if not settings.MODEL_CACHE_DIR:
+        return
+    return os.path.join(settings.MODEL_CACHE_DIR, '{}.{}'.format(checksum, extension))
+
+
+def write_cache_file(path, write):
+    """
+    Write a file into the model cache directory. The file is written under a
+    temporary name and moved in place, so that concurrent workers never read
+    partial files.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fl:
+            write(fl)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_keras_model(data, wrap_keras_with_sklearn):
+    import h5py
+    from tensorflow.keras.models import load_model
+    with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
+        model = load_model(h5py.File(io.BytesIO(zf.read(ZIP_ESTIMATOR_NAME)), 'r'))
+        if not wrap_keras_with_sklearn:
+            return model
+        clf = pickle.loads(zf.read(ZIP_PIPELINE_NAME))
+        clf.named_steps[PIPELINE_ESTIMATOR_NAME].model = model
+        return clf
+
+
+def load_cached_keras_model(classifier, checksum, data=None):
+    path = get_cache_path(checksum, 'zip')
+    if path and os.path.exists(path):
+        with open(path, 'rb') as fl:
+            return load_keras_model(fl.read(), classifier.wrap_keras_with_sklearn)
+    if data is None:
+        data = classifier.trained.read()
+    if path:
+        write_cache_file(path, lambda fl: fl.write(data))
+    return load_keras_model(data, classifier.wrap_keras_with_sklearn)
+
+
+def load_cached_sklearn_model(classifier, checksum, data=None):
+    path = get_cache_path(checksum, 'pickle')
+    if path and os.path.exists(path):
+        with open(path, 'rb') as fl:
+            return pickle.load(fl)
+    if data is None:
+        data = classifier.trained.read()
+    if path:
+        write_cache_file(path, lambda fl: fl.write(data))
+    return pickle.loads(data)
+
+
+def load_trained_model(classifier):
+    """
+    Return the trained model of a classifier. Models are cached in the process
+    and in the local model cache directory, keyed by the checksum of the
+    trained file, so that repeated prediction jobs on the same worker neither
+    download nor deserialize the model again.
+    """
+    data = None
+    checksum = classifier.trained_checksum
+    if not checksum:
+        # Classifiers trained before checksums were stored need to be
+        # downloaded once to compute the checksum, which is stored for the
+        # next loads.
+        data = classifier.trained.read()
+        checksum = trained_checksum(data)
+        Classifier.objects.filter(id=classifier.id).update(trained_checksum=checksum)
+        classifier.trained_checksum = checksum
+
+    with _models_lock:
+        clf = _models.get(checksum)
+        if clf is not None:
+            _models.move_to_end(checksum)
+            return clf
+
+    if classifier.is_keras:
+        clf = load_cached_keras_model(classifier, checksum, data)
+    else:
+        clf = load_cached_sklearn_model(classifier, checksum, data)
+    logger.info('Loaded trained model {} of classifier {}.'.format(checksum, classifier.id))
+
+    if settings.MODEL_CACHE_SIZE:
+        with _models_lock:
+            _models[checksum] = clf
+            while len(_models) > settings.MODEL_CACHE_SIZE:
+                _models.popitem(last=False)
+    return clf
+
+
+def clear_model_cache():
+    """
+    Drop the models cached in this process.
+    """
+    with _models_lock:
+        _models.clear()
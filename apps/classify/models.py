@@ -1,8 +1,5 @@
 import datetime
-import io
 import json
-import pickle
-import zipfile
 
 import numpy
 from django.contrib.gis.db import models
@@ -14,7 +11,6 @@ from guardian.models import GroupObjectPermissionBase, UserObjectPermissionBase
 from raster.models import Legend, RasterLayer
 from raster_aggregation.models import AggregationLayer
 
-from classify.const import PIPELINE_ESTIMATOR_NAME, ZIP_ESTIMATOR_NAME, ZIP_PIPELINE_NAME
 from sentinel.const import ZOOM_LEVEL_10M
 from sentinel.models import Composite, SentinelTile
 from sentinel.utils import populate_raster_metadata
@@ -92,6 +88,12 @@ class TrainingPixels(models.Model):
         self.save()
 
     def unpack_collected_pixels(self):
+        # Pixels collected before the dataset format are stored as npz files.
+        if self.flatten and not self.collected_pixels.name.endswith('.npz'):
+            from classify.dataset import open_training_dataset
+            data = open_training_dataset(self.collected_pixels)
+            # The pixel values are kept on disk, the other columns are loaded.
+            return data['X'], data['Y'][:], data['PID'][:], data['SID'][:], data.categories
         data = numpy.load(self.collected_pixels)
         if self.flatten:
             # Convert categories to dict.
@@ -192,6 +194,7 @@ class Classifier(models.Model):
     name = models.CharField(max_length=100)
     algorithm = models.CharField(max_length=10, choices=ALGORITHM_CHOICES)
     trained = models.FileField(upload_to='clouds/classifiers', blank=True, null=True)
+    trained_checksum = models.CharField(max_length=64, default='', blank=True, editable=False, help_text='SHA256 checksum of the trained file, used as key for the local model cache.')
     collected_pixels = models.FileField(upload_to='clouds/classifiers', blank=True, null=True)
     traininglayer = models.ForeignKey(TrainingLayer, blank=True, null=True, on_delete=models.SET_NULL)
     trainingpixels = models.ForeignKey(TrainingPixels, blank=True, null=True, on_delete=models.SET_NULL)
@@ -219,18 +222,8 @@ class Classifier(models.Model):
     @property
     def clf(self):
         if self._clf is None:
-            if self.is_keras:
-                import h5py
-                from tensorflow.keras.models import load_model
-                with zipfile.ZipFile(io.BytesIO(self.trained.read()), 'r') as zf:
-                    model = load_model(h5py.File(io.BytesIO(zf.read(ZIP_ESTIMATOR_NAME)), 'r'))
-                    if self.wrap_keras_with_sklearn:
-                        self._clf = pickle.loads(zf.read(ZIP_PIPELINE_NAME))
-                        self._clf.named_steps[PIPELINE_ESTIMATOR_NAME].model = model
-                    else:
-                        self._clf = model
-            else:
-                self._clf = pickle.loads(self.trained.read())
+            from classify.modelcache import load_trained_model
+            self._clf = load_trained_model(self)
         return self._clf
 
     def write(self, data, status=None):
@@ -308,6 +301,7 @@ class PredictedLayer(models.Model):
     min_date = models.DateField(null=True, blank=True, editable=False)
     max_date = models.DateField(null=True, blank=True, editable=False)
     chunk_size = models.IntegerField(default=100, help_text='Number of tiles to process per task. Reduce size for predictions with many composites.')
+    prediction_batch_size = models.PositiveIntegerField(default=8, help_text='Number of tiles that are predicted together in one batch. Reduce size for predictions with many composites.')
 
     sieve_threshold = models.IntegerField(default=0)
     sieve_connectivity = models.IntegerField(default=4, choices=SIEVE_CHOICES)
@@ -315,6 +309,10 @@ class PredictedLayer(models.Model):
 
     store_class_probabilities = models.BooleanField(default=False)
 
+    tile_manifest = models.FileField(upload_to='clouds/predictedlayers', blank=True, null=True, editable=False, help_text='Sorted tile indices of the prediction, the chunks are slices of this list.')
+    incremental = models.BooleanField(default=False, help_text='Only predict tiles for which the classifier or the input tiles changed since the last prediction, and only rebuild the affected pyramid tiles. Ignored for sieving.')
+    tile_fingerprints = models.FileField(upload_to='clouds/predictedlayers', blank=True, null=True, editable=False, help_text='Numpy array with the input fingerprints of the tiles from the last incremental prediction.')
+
     def __str__(self):
         if self.name:
             return '{} | {}'.format(self.name, self.status)
@@ -406,6 +404,8 @@ class PredictedLayerChunk(models.Model):
     from_index = models.IntegerField()
     to_index = models.IntegerField()
     status = models.CharField(choices=PLC_STATUS_CHOICES, default=UNPROCESSED, max_length=100)
+    written_tiles = models.FileField(upload_to='clouds/predictedlayers', blank=True, null=True, editable=False, help_text='Numpy array with the indices of the tiles written by this chunk.')
+    tile_fingerprints = models.FileField(upload_to='clouds/predictedlayers', blank=True, null=True, editable=False, help_text='Numpy array with the input fingerprints of the tiles of this chunk.')
 
     def __str__(self):
         return 'Chunk Range {}-{} for Predictedlayer {} ({})'.format(
@@ -1,57 +1,86 @@
+import hashlib
 import importlib
 import io
+import json
 import pickle
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryFile
 
 import h5py
 import numpy
 import sentry_sdk
+import structlog
+from django.conf import settings
 from django.contrib.gis.db.models import Extent
-from django.contrib.gis.gdal import GDALRaster
 from django.contrib.gis.geos import Polygon
 from django.core.files import File
-from raster.rasterize import rasterize
 from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
-from raster.tiles.utils import tile_bounds, tile_index_range
+from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
+from rasterio.features import rasterize as rasterize_shapes
 from rasterio.features import sieve
+from rasterio.transform import Affine
 from sklearn.metrics import accuracy_score, cohen_kappa_score, confusion_matrix, r2_score
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import RobustScaler
 from tensorflow.config import list_physical_devices
 from tensorflow.keras.layers import Dense
 from tensorflow.keras.models import model_from_json
-from tensorflow.keras.utils import to_categorical
 from tensorflow.keras.wrappers.scikit_learn import KerasClassifier
 
 from classify.const import (
     CLASSIFICATION_DATATYPE, CLASSIFICATION_DATATYPE_GDAL, CLASSIFICATION_NODATA, FITTING_ERROR_MSG, KERAS_FIT_ARGS,
     KERAS_JSON_MALFORMED_ERROR_MSG, KERAS_LAST_LAYER_NOT_DENSE_ERROR_MSG, KERAS_LAST_LAYER_UNITS_ERROR_MSG_TMPL,
     KERAS_MIN_ONE_LAYER_ERROR_MSG, KERAS_TRAIN_TYPE, PIPELINE_ESTIMATOR_NAME, PIPELINE_SCALER_NAME,
-    PREDICTION_CONFIG_ERROR_MSG, REGRESSION_DATATYPE, REGRESSION_DATATYPE_GDAL, SCALE, SENTINEL_PIXELTYPE,
+    PREDICTION_CONFIG_ERROR_MSG, REGRESSION_DATATYPE, REGRESSION_DATATYPE_GDAL, SENTINEL_PIXELTYPE,
     SIEVE_CONIFG_ERROR_MSG, TP_MSG_NOT_FINISHED, TP_MSG_REGRESSOR, TRAINING_DATA_SPLIT_ERROR_MSG,
     VALUE_CONFIG_ERROR_MSG, ZIP_ESTIMATOR_NAME, ZIP_PIPELINE_NAME, ZOOM
 )
+from classify.dataset import TrainingDataset, open_training_dataset
+from classify.modelcache import trained_checksum
 from classify.models import Classifier, ClassifierAccuracy, PredictedLayer, PredictedLayerChunk, TrainingPixels
-from classify.utils import LogCallback, PixelSequence, RNNRobustScaler
+from classify.utils import LogCallback, PixelSequence, RNNRobustScaler, TrainingMatrixAccumulator
 from jobs import ecs
 from report.tasks import push_reports
 from sentinel.const import SENTINEL_NODATA_VALUE
-from sentinel.utils import aggregate_tile, get_raster_tile, write_raster_tile
+from sentinel.tilecache import use_tile_cache
+from sentinel.tileindex import use_tile_index
+from sentinel.utils import (
+    AGGREGATE_MEAN, AGGREGATE_MODE, TileRasterizer, TileWriter, aggregate_tile, get_raster_tiles, get_tile_versions,
+    write_raster_tile
+)
 from sentinel_1.const import POLARIZATION_DV_BANDS
 
+logger = structlog.get_logger('django_structlog')
+
+# Number of parent tiles for which children are fetched at once when building
+# the predicted layer pyramid.
+PYRAMID_PREFETCH_SIZE = 64
+
+# Data type of the tile indices in prediction tile manifests.
+TILE_MANIFEST_DATATYPE = 'int32'
+
+# Tile indices and input fingerprints of incremental predictions.
+TILE_FINGERPRINT_DATATYPE = numpy.dtype([
+    ('tilex', TILE_MANIFEST_DATATYPE),
+    ('tiley', TILE_MANIFEST_DATATYPE),
+    ('fingerprint', 'S16'),
+])
+
+# Maximum width in tiles of the square tile blocks that are sieved at once.
+SIEVE_MAX_BLOCK_SIZE = 32
+
 
 def get_classifier_data(rasterlayer_ids, tilez, tilex, tiley):
     """
     Builds the 13 band training tile file for a training tile instance.
     """
-    # Get data for a tile of this scene.
-    result = []
-    for layer_id in rasterlayer_ids:
-        tile = get_raster_tile(layer_id, tilez=tilez, tilex=tilex, tiley=tiley)
-        if not tile:
-            return
-        result.append(tile.bands[0].data().ravel())
+    # Get data for a tile of this scene, fetching all layers at once.
+    tiles = get_raster_tiles([(layer_id, tilez, tilex, tiley) for layer_id in rasterlayer_ids])
+    if not all(tiles):
+        return
+    result = [tile.bands[0].data().ravel() for tile in tiles]
 
     return numpy.array(result).T
 
@@ -79,109 +108,108 @@ def get_rasterlayer_ids(band_names, rasterlayer_lookup):
     return rasterlayer_ids
 
 
-def populate_training_matrix_sample(sample, is_regressor, categories, rasterlayer_lookup, target_type, all_touched, band_names):
-    X = numpy.empty(shape=(0, len(band_names)), dtype=SENTINEL_PIXELTYPE)
-    Y = numpy.empty(shape=(0, ), dtype=target_type)
-    # Track pixel IDs to allow merging different training matrices from
-    # different traininglayers.
-    PID = numpy.empty(shape=(0, ), dtype='int64')
-    SID = numpy.empty(shape=(0, ), dtype='int64')
-    # Check for consistency in training samples for dicrete datasets.
-    if not is_regressor:
-        if sample.category in categories:
-            if sample.value != categories[sample.category]:
-                raise ValueError(VALUE_CONFIG_ERROR_MSG)
+def training_matrix_accumulator(band_names, target_type, spill_bytes=None):
+    """
+    Create an accumulator for the X, Y, PID and SID training data columns.
+    """
+    return TrainingMatrixAccumulator(
+        [
+            (SENTINEL_PIXELTYPE, (len(band_names), )),
+            (target_type, ()),
+            # Track pixel IDs to allow merging different training matrices
+            # from different traininglayers.
+            ('int64', ()),
+            ('int64', ()),
+        ],
+        spill_bytes=spill_bytes,
+    )
+
+
+def populate_training_matrix_samples(samples, is_regressor, categories, rasterlayer_lookup, target_type, all_touched, band_names):
+    """
+    Collect the training pixels of multiple samples. The samples are grouped by
+    the tiles they intersect, so that the band tiles are read once for all
+    samples over a tile and the samples are rasterized together.
+
+    Returns a list with the X, Y, PID and SID arrays of each sample, and the
+    updated categories.
+    """
+    sample_rasterlayer_ids = []
+    for sample in samples:
+        # Check for consistency in training samples for dicrete datasets.
+        if not is_regressor:
+            if sample.category in categories:
+                if sample.value != categories[sample.category]:
+                    raise ValueError(VALUE_CONFIG_ERROR_MSG)
+            else:
+                categories[sample.category] = sample.value if is_regressor else int(sample.value)
+        # Take rasterlayer lookup from the trainingsample if it was not provided as
+        # input.
+        if rasterlayer_lookup:
+            rasterlayer_lookup_sample = rasterlayer_lookup
+        elif sample.composite:
+            rasterlayer_lookup_sample = sample.composite.rasterlayer_lookup
         else:
-            categories[sample.category] = sample.value if is_regressor else int(sample.value)
-    # Take rasterlayer lookup from the trainingsample if it was not provided as
-    # input.
-    if rasterlayer_lookup:
-        rasterlayer_lookup_sample = rasterlayer_lookup
-    elif sample.composite:
-        rasterlayer_lookup_sample = sample.composite.rasterlayer_lookup
-    else:
-        rasterlayer_lookup_sample = sample.sentineltile.rasterlayer_lookup
-    # Convert lookup to id list.
-    rasterlayer_ids = get_rasterlayer_ids(band_names, rasterlayer_lookup_sample)
-    # Loop over index range for tiles intersecting with the sample geom.
-    idx = tile_index_range(sample.geom.transform(3857, clone=True).extent, ZOOM)
-    for tilex in range(idx[0], idx[2] + 1):
-        for tiley in range(idx[1], idx[3] + 1):
-            # Get stacked tile data for this tile.
-            data = get_classifier_data(rasterlayer_ids, ZOOM, tilex, tiley)
+            rasterlayer_lookup_sample = sample.sentineltile.rasterlayer_lookup
+        # Convert lookup to id list.
+        sample_rasterlayer_ids.append(tuple(get_rasterlayer_ids(band_names, rasterlayer_lookup_sample)))
+
+    rasterizer = TileRasterizer([sample.geom.transform(3857, clone=True) for sample in samples], ZOOM, all_touched)
+    matrices = [training_matrix_accumulator(band_names, target_type) for sample in samples]
+    for tilex, tiley in rasterizer.tiles():
+        pixels = rasterizer.burn(tilex, tiley)
+        # Compute pixel ids for this tile.
+        pid_from = (tiley * (2 ** ZOOM) + tilex) * WEB_MERCATOR_TILESIZE ** 2
+        # Get stacked tile data for each set of rasterlayers only once.
+        tile_data = {}
+        for index, selector in sorted(pixels.items()):
+            if not len(selector):
+                continue
+            rasterlayer_ids = sample_rasterlayer_ids[index]
+            if rasterlayer_ids not in tile_data:
+                tile_data[rasterlayer_ids] = get_classifier_data(rasterlayer_ids, ZOOM, tilex, tiley)
+            data = tile_data[rasterlayer_ids]
             if data is None:
                 continue
-            # Create a target raster for the rasterization.
-            bounds = tile_bounds(tilex, tiley, ZOOM)
-            rast = GDALRaster(
-                {
-                    'width': WEB_MERCATOR_TILESIZE,
-                    'height': WEB_MERCATOR_TILESIZE,
-                    'srid': WEB_MERCATOR_SRID,
-                    'scale': [SCALE, -SCALE],
-                    'origin': [bounds[0], bounds[3]],
-                    'datatype': 1,
-                    'nr_of_bands': 1,
-                }
+            sample = samples[index]
+            matrices[index].append(
+                # Use selector to pick sample pixels over geom.
+                data[selector],
+                # Create a constant array with sample value for all
+                # intersecting pixels.
+                numpy.full(len(selector), sample.value, dtype='float64').astype(target_type),
+                pid_from + selector,
+                # Make array with sample id for separating validation pixels
+                # at training sample level (instead of pixel level).
+                numpy.full(len(selector), sample.id, dtype='int64'),
             )
-            # Rasterize the sample area.
-            sample_rast = rasterize(sample.geom, rast, all_touched=all_touched)
-            # Create a selector boolean array from rasterized geometry.
-            sample_pixels = sample_rast.bands[0].data().ravel()
-            selector = sample_pixels == 1
-            # Create a constant array with sample value for all intersecting pixels.
-            sample_values = (sample.value * numpy.ones(sum(selector))).astype(target_type)
-            # Add sample values to dependent variable.
-            Y = numpy.hstack([sample_values, Y])
-            # Use selector to pick sample pixels over geom.
-            data = data[selector]
-            # Add explanatory variables to stack.
-            X = numpy.vstack([data, X])
-            # Compute pixel ids for this tile.
-            pid_from = (tiley * (2 ** ZOOM) + tilex) * WEB_MERCATOR_TILESIZE ** 2
-            pid_to = pid_from + WEB_MERCATOR_TILESIZE ** 2
-            pids = numpy.arange(pid_from, pid_to)
-            PID = numpy.hstack([pids[selector], PID])
-            # Make array with sample id for separating validation pixels at
-            # training sample level (instead of pixel level).
-            sample_id_values = (sample.id * numpy.ones(sum(selector))).astype('int64')
-            SID = numpy.hstack([sample_id_values, SID])
-
-    return X, Y, PID, SID, categories
+
+    # The pixels of the last tile of a sample come first.
+    return [matrix.arrays(reverse=True) for matrix in matrices], categories
 
 
 def populate_training_matrix(traininglayer, band_names, rasterlayer_lookup=None, is_regressor=False, all_touched=True):
     # Determine sample value datatype.
     target_type = REGRESSION_DATATYPE if is_regressor else CLASSIFICATION_DATATYPE
-    # Create numpy arrays holding training data.
-    number_of_bands = len(band_names)
-    X = numpy.empty(shape=(0, number_of_bands), dtype=SENTINEL_PIXELTYPE)
-    Y = numpy.empty(shape=(0, ), dtype=target_type)
-    # Track pixel IDs to allow merging different training matrices from
-    # different traininglayers.
-    PID = numpy.empty(shape=(0, ), dtype='int64')
-    SID = numpy.empty(shape=(0, ), dtype='int64')
+    # Create accumulator for the training data.
+    matrix = training_matrix_accumulator(band_names, target_type, settings.TRAINING_MATRIX_SPILL_BYTES)
     # Dictionary for categories or statistics.
     categories = {}
-    # Loop through training tiles to build training set.
-    for sample in traininglayer.trainingsample_set.all():
-        Xh, Yh, PIDh, SIDh, categories = populate_training_matrix_sample(
-            sample,
-            is_regressor,
-            categories,
-            rasterlayer_lookup,
-            target_type,
-            all_touched,
-            band_names,
-        )
-        # Add sample values to dependent variable.
-        Y = numpy.hstack([Yh, Y])
-        # Add explanatory variables to stack.
-        X = numpy.vstack([Xh, X])
-        # Add pixel ids for this tile to stack.
-        PID = numpy.hstack([PIDh, PID])
-        # Add sample IDs to stack.
-        SID = numpy.hstack([SIDh, SID])
+    # Collect the pixels of all training samples.
+    results, categories = populate_training_matrix_samples(
+        list(traininglayer.trainingsample_set.all()),
+        is_regressor,
+        categories,
+        rasterlayer_lookup,
+        target_type,
+        all_touched,
+        band_names,
+    )
+    for Xh, Yh, PIDh, SIDh in results:
+        matrix.append(Xh, Yh, PIDh, SIDh)
+
+    # The pixels of the last sample come first.
+    X, Y, PID, SID = matrix.arrays(reverse=True)
 
     save_traininglayer_legend(traininglayer, categories, Y, is_regressor)
 
@@ -221,19 +249,19 @@ def get_keras_model(keras_model_json, optimizer, loss=None, metrics=None, loss_w
 
 
 def populate_training_matrix_time(classifier):
-    Xs = None
-    Ys = None
-    PIDs = None
-    SIDs = None
     # Dictionary for categories or statistics.
     categories = {}
     # Determine sample value datatype.
     target_type = REGRESSION_DATATYPE if classifier.is_regressor else CLASSIFICATION_DATATYPE
+    band_names = classifier.band_names.split(',')
+    # Create accumulator for the training data.
+    matrix = training_matrix_accumulator(band_names, target_type, settings.TRAINING_MATRIX_SPILL_BYTES)
     # Get all classifier composites.
     composites = classifier.composites.all().order_by('min_date')
-    for index, sample in enumerate(classifier.traininglayer.trainingsample_set.all()):
-        if index % 250 == 0 and index > 0:
-            classifier.write('Collected data for {} training samples.'.format(index))
+    # Determine the composites of each training sample.
+    samples = []
+    samples_composites = []
+    for sample in classifier.traininglayer.trainingsample_set.all():
         # Check if all composites should be included in training (fixed end
         # date for all samples) or a flexible selection shall be used based on
         # the sample date stamp.
@@ -266,51 +294,54 @@ def populate_training_matrix_time(classifier):
             # Select all available composites.
             sample_composites = composites
 
-        for composite in sample_composites:
-            try:
-                X, Y, PID, SID, categories = populate_training_matrix_sample(
-                    sample,
-                    classifier.is_regressor,
-                    categories,
-                    composite.rasterlayer_lookup,
-                    target_type,
-                    classifier.training_all_touched,
-                    classifier.band_names.split(','),
-                )
-            except ValueError:
-                classifier.write(VALUE_CONFIG_ERROR_MSG, classifier.FAILED)
-                raise
+        samples.append(sample)
+        samples_composites.append(list(sample_composites))
 
-            if Xs is None:
-                Xs = X
-                Ys = Y
-                PIDs = PID
-                SIDs = SID
-            else:
-                Ys = numpy.hstack([Ys, Y])
-                Xs = numpy.vstack([Xs, X])
-                PIDs = numpy.hstack([PIDs, PID])
-                SIDs = numpy.hstack([SIDs, SID])
-
-    # Combine data
-    all_data = numpy.vstack([PIDs, SIDs, Ys, Xs.T]).T
+    # Collect the pixels of all samples over each composite at once. The
+    # composites are processed by date, so that the rows of each sample and
+    # pixel are ordered like the sample composites after sorting.
+    composite_order = {composite.id: position for position, composite in enumerate(composites)}
+    composite_samples = {}
+    for index, sample_composites in enumerate(samples_composites):
+        for composite in sample_composites:
+            composite_samples.setdefault(composite.id, (composite, []))[1].append(index)
+    for composite, indices in sorted(composite_samples.values(), key=lambda item: composite_order[item[0].id]):
+        try:
+            results, categories = populate_training_matrix_samples(
+                [samples[index] for index in indices],
+                classifier.is_regressor,
+                categories,
+                composite.rasterlayer_lookup,
+                target_type,
+                classifier.training_all_touched,
+                band_names,
+            )
+        except ValueError:
+            classifier.write(VALUE_CONFIG_ERROR_MSG, classifier.FAILED)
+            raise
+        for X, Y, PID, SID in results:
+            matrix.append(X, Y, PID, SID)
+        classifier.write('Collected data for {} training samples over composite {}.'.format(len(indices), composite.id))
+
+    Xs, Ys, PIDs, SIDs = matrix.arrays()
     # Sort by PID and SID
-    all_data = all_data[numpy.lexsort((PIDs, SIDs))]
+    order = numpy.lexsort((PIDs, SIDs))
     # Count number of unique pixel IDs (PIDs) over each sample (SIDs).
     nr_of_observations = len(Ys) / len(sample_composites)
-    # Split into groups by unique pixel/sampmle combos to convert data into
-    # keras ready tensor shapes.
-    try:
-        all_data = numpy.array(numpy.vsplit(all_data, nr_of_observations))
-    except ValueError:
+    # Group the rows by unique pixel/sample combos to convert data into keras
+    # ready tensor shapes. All columns share one data type, as in a combined
+    # matrix.
+    if len(Ys) % len(sample_composites):
         classifier.write(TRAINING_DATA_SPLIT_ERROR_MSG, classifier.FAILED)
-        raise
+        raise ValueError('array split does not result in an equal division')
+    shape = (int(nr_of_observations), len(sample_composites))
+    dtype = numpy.result_type(PIDs, SIDs, Ys, Xs)
 
     # Extract and return individual arrays.
-    PIDs = all_data[:, 0, 0]
-    SIDs = all_data[:, 0, 1]
-    Ys = all_data[:, 0, 2]
-    Xs = all_data[:, :, 3:]
+    PIDs = PIDs[order].reshape(shape)[:, 0].astype(dtype)
+    SIDs = SIDs[order].reshape(shape)[:, 0].astype(dtype)
+    Ys = Ys[order].reshape(shape)[:, 0].astype(dtype)
+    Xs = Xs[order].reshape(shape + (len(band_names), )).astype(dtype)
 
     save_traininglayer_legend(classifier.traininglayer, categories, Ys, classifier.is_regressor)
 
@@ -366,14 +397,19 @@ def train_sentinel_classifier(classifier_id):
         X, Y, PID, SID, categories = classifier.trainingpixels.unpack_collected_pixels()
         # Flatten the time dimension for non-keras models.
         if not classifier.is_keras and len(X.shape) == 3:
-            X = X.reshape((X.shape[0], X.shape[1] * X.shape[2]))
+            X = X[:].reshape((X.shape[0], X.shape[1] * X.shape[2]))
     elif classifier.collected_pixels.name:
         classifier.write('Found existing collected training data, loading from file.')
-        loaded = numpy.load(classifier.collected_pixels)
+        # Pixels collected before the dataset format are stored as npz files.
+        if classifier.collected_pixels.name.endswith('.npz'):
+            loaded = numpy.load(classifier.collected_pixels)
+        else:
+            loaded = open_training_dataset(classifier.collected_pixels)
+        # The pixel values are kept on disk, the other columns are loaded.
         X = loaded['X']
-        Y = loaded['Y']
-        PID = loaded['PID']
-        SID = loaded['SID']
+        Y = loaded['Y'][:]
+        PID = loaded['PID'][:]
+        SID = loaded['SID'][:]
     else:
         classifier.write('Collecting pixels from composites data.')
         # Check if the classifier has a custom data source specified.
@@ -404,8 +440,9 @@ def train_sentinel_classifier(classifier_id):
 
         # Store collected pixels.
         with TemporaryFile() as fl:
-            numpy.savez_compressed(fl, X=X, Y=Y, PID=PID, SID=SID)
-            name = 'classifier-collected-pixels-{}.npz'.format(classifier.id)
+            with TrainingDataset(fl, 'w') as dataset:
+                dataset.append(X=X, Y=Y, PID=PID, SID=SID)
+            name = 'classifier-collected-pixels-{}.hdf5'.format(classifier.id)
             classifier.collected_pixels.save(name, File(fl))
 
     # Check consistency of Y values.
@@ -494,6 +531,12 @@ def train_sentinel_classifier(classifier_id):
         clf_class = getattr(clf_module, clf_class_name)
         clf = clf_class(**clf_args)
 
+    # Keras classifiers are fitted from a batch generator that reads the pixel
+    # values from disk, for all other models the values are loaded.
+    use_generator = not classifier.is_regressor and classifier.is_keras and not classifier.wrap_keras_with_sklearn
+    if not use_generator:
+        X = X[:]
+
     # Select scaler.
     if len(X.shape) <= 2:
         scaler = RobustScaler()
@@ -507,15 +550,23 @@ def train_sentinel_classifier(classifier_id):
             (PIPELINE_ESTIMATOR_NAME, clf),
         ])
 
-    # TF keras cant handle unit16.
-    if classifier.is_keras:
+    # TF keras cant handle unit16. The generator converts each batch.
+    if classifier.is_keras and not use_generator:
         X = X.astype(KERAS_TRAIN_TYPE)
 
     # Compute train and test arrays. If all available pixels were used for
-    #  training, compute accuracy with full dataset.
+    #  training, compute accuracy with full dataset. The generator selects the
+    #  train and test rows by index.
+    train_indices = test_indices = None
     if classifier.splitfraction == 0:
         x_train = x_test = X
         y_train = y_test = Y
+    elif use_generator:
+        x_train = x_test = X
+        train_indices = numpy.flatnonzero(selector)
+        test_indices = numpy.flatnonzero(numpy.logical_not(selector))
+        y_train = Y[train_indices]
+        y_test = Y[test_indices]
     else:
         x_train = X[selector]
         y_train = Y[selector]
@@ -526,19 +577,27 @@ def train_sentinel_classifier(classifier_id):
 
     # Keras classifiers want y to be a one-hot-encoding matrix. Each class is
     # named after its column index in the matrix. This assumes class category
-    # values are sequential and start with 1.
+    # values are sequential and start with 1. The generator converts the y
+    # values of each batch.
     training_generator = None
     testing_generator = None
-    if not classifier.is_regressor and classifier.is_keras and not classifier.wrap_keras_with_sklearn:
+    if use_generator:
         class_weight = fit_args.pop("class_weight", None)
         if class_weight:
             class_weight = [class_weight[f] for f in sorted(class_weight.keys())]
             sample_weights = numpy.take(class_weight, y_train - 1)
         else:
             sample_weights = None
-        y_train = to_categorical(y_train - 1)
-        training_generator = PixelSequence(x_train, y_train, sample_weights=sample_weights, batch_size=fit_args.pop('batch_size', 100))
-        testing_generator = PixelSequence(x_test, batch_size=fit_args.pop('batch_size', 100))
+        training_generator = PixelSequence(
+            x_train,
+            y_train,
+            sample_weights=sample_weights,
+            batch_size=fit_args.pop('batch_size', 100),
+            indices=train_indices,
+            num_classes=clf.layers[-1].units,
+            dtype=KERAS_TRAIN_TYPE,
+        )
+        testing_generator = PixelSequence(x_test, batch_size=fit_args.pop('batch_size', 100), indices=test_indices, dtype=KERAS_TRAIN_TYPE)
 
     # Fit the model.
     try:
@@ -616,15 +675,20 @@ def train_sentinel_classifier(classifier_id):
         save_trained = io.BytesIO(pickle.dumps(clf))
 
     classifier.trained = File(save_trained, name=name)
+    classifier.trained_checksum = trained_checksum(save_trained.getvalue())
     classifier.write('Finished training algorithm', classifier.FINISHED)
 
 
-def get_aggregationlayer_tile_indices(aggregationlayer, zoom):
+def set_aggregationlayer_extent(aggregationlayer):
     # Set agglayer extent if not precomputed.
     if not aggregationlayer.extent:
         extent = aggregationlayer.aggregationarea_set.aggregate(Extent('geom'))['geom__extent']
         aggregationlayer.extent = Polygon.from_bbox(extent)
         aggregationlayer.save()
+
+
+def get_aggregationlayer_tile_indices(aggregationlayer, zoom):
+    set_aggregationlayer_extent(aggregationlayer)
     # Create set to hold tile indexes.
     indexranges = set()
     # Loop through all aggregationareas.
@@ -641,6 +705,37 @@ def get_aggregationlayer_tile_indices(aggregationlayer, zoom):
         yield idxr
 
 
+def get_aggregationlayer_tile_manifest(aggregationlayer, zoom):
+    """
+    Return the indices of the tiles that intersect with the geometry of any
+    aggregationarea, as sorted array of (tilex, tiley) rows.
+    """
+    set_aggregationlayer_extent(aggregationlayer)
+    # Size of one tile in web mercator units.
+    size = WEB_MERCATOR_TILESIZE * tile_scale(zoom)
+    tiles = [numpy.empty((0, 2), dtype=TILE_MANIFEST_DATATYPE)]
+    for aggarea in aggregationlayer.aggregationarea_set.all():
+        geom = aggarea.geom.transform(WEB_MERCATOR_SRID, clone=True)
+        if geom.empty:
+            continue
+        indexrange = tile_index_range(geom.extent, zoom, tolerance=1e-3)
+        bounds = tile_bounds(indexrange[0], indexrange[1], zoom)
+        # Rasterize the geometry on a grid with one pixel per tile. With the
+        # all touched option, all tiles intersecting the geometry are burned,
+        # tiles that are only in the bounding box are not.
+        touched = rasterize_shapes(
+            [json.loads(geom.json)],
+            out_shape=(indexrange[3] - indexrange[1] + 1, indexrange[2] - indexrange[0] + 1),
+            transform=Affine(size, 0, bounds[0], 0, -size, bounds[3]),
+            all_touched=True,
+            dtype='uint8',
+        )
+        tileys, tilexs = numpy.nonzero(touched)
+        tiles.append(numpy.stack([tilexs + indexrange[0], tileys + indexrange[1]], axis=1).astype(TILE_MANIFEST_DATATYPE))
+    # Remove duplicates from overlapping areas and sort by tilex and tiley.
+    return numpy.unique(numpy.concatenate(tiles), axis=0)
+
+
 def get_prediction_index_range(pred, zoom=ZOOM):
     # Get tile range for aggregationlayer, compositeband or sentineltile for
     # this prediction.
@@ -650,6 +745,157 @@ def get_prediction_index_range(pred, zoom=ZOOM):
     return get_aggregationlayer_tile_indices(pred.aggregationlayer, zoom)
 
 
+def get_tile_manifest_blocks(tiles, block_size):
+    """
+    Order the rows of a tile manifest by square blocks of block size tiles,
+    so that the tiles of each block are consecutive. Returns the reordered
+    tiles and the start index of every block, followed by the tile count.
+    """
+    blocks = tiles // block_size
+    order = numpy.lexsort((tiles[:, 1], tiles[:, 0], blocks[:, 1], blocks[:, 0]))
+    tiles = tiles[order]
+    blocks = blocks[order]
+    starts = numpy.flatnonzero(numpy.any(blocks[1:] != blocks[:-1], axis=1)) + 1
+    return tiles, [0] + starts.tolist() + [len(tiles)]
+
+
+def pack_tile_manifest_blocks(starts, chunk_size):
+    """
+    Pack consecutive tile blocks into chunks of at most chunk size tiles, so
+    that sparse layers with few tiles per block do not need one job per block.
+    Takes the block starts of get_tile_manifest_blocks and returns the start
+    index of every chunk, followed by the tile count.
+    """
+    packed = [starts[0]]
+    for start, end in zip(starts[:-1], starts[1:]):
+        if end - packed[-1] > chunk_size and start > packed[-1]:
+            packed.append(start)
+    return packed + [starts[-1]]
+
+
+def get_sieve_block_size(pred):
+    """
+    Width in tiles of the square tile blocks that are sieved as one mosaic.
+    """
+    return max(1, min(int(pred.chunk_size ** 0.5), SIEVE_MAX_BLOCK_SIZE))
+
+
+def save_array_file(field, name, array, save=True):
+    """
+    Store an array in a file field, in the numpy file format.
+    """
+    with TemporaryFile() as fl:
+        numpy.lib.format.write_array(fl, array, version=(1, 0))
+        field.save(name, File(fl), save=save)
+
+
+def read_array_file(field):
+    """
+    Read an array stored in a file field in the numpy file format.
+    """
+    with field.open('rb') as fl:
+        return numpy.lib.format.read_array(fl)
+
+
+def save_tile_manifest(field, name, tiles, save=True):
+    """
+    Store a list of (tilex, tiley) indices in a file field.
+    """
+    save_array_file(field, name, numpy.asarray(tiles, dtype=TILE_MANIFEST_DATATYPE).reshape(-1, 2), save=save)
+
+
+def write_prediction_tile_manifest(pred):
+    """
+    Compute the tiles of a prediction at full resolution and store them as
+    tile manifest of the predicted layer. Returns the (from_index, to_index)
+    ranges of the chunks over the manifest.
+
+    For sieving, the manifest is ordered by square blocks of tiles that are
+    each sieved as one mosaic, and the chunks cover consecutive whole blocks.
+    """
+    if not pred.aggregationlayer:
+        pred.write('ERROR: {}'.format(PREDICTION_CONFIG_ERROR_MSG), PredictedLayer.FAILED)
+        raise ValueError(PREDICTION_CONFIG_ERROR_MSG)
+    tiles = get_aggregationlayer_tile_manifest(pred.aggregationlayer, ZOOM)
+    if pred.sieve_threshold > 0 and len(tiles):
+        tiles, starts = get_tile_manifest_blocks(tiles, get_sieve_block_size(pred))
+        starts = pack_tile_manifest_blocks(starts, pred.chunk_size)
+    else:
+        starts = list(range(0, len(tiles), pred.chunk_size)) + [len(tiles)]
+    save_tile_manifest(pred.tile_manifest, 'predictedlayer-tile-manifest-{}.npy'.format(pred.id), tiles)
+    return [(from_index, to_index) for from_index, to_index in zip(starts[:-1], starts[1:])]
+
+
+def read_prediction_tile_manifest(pred, from_index, to_index):
+    """
+    Return the (tilex, tiley, tilez) indices of a slice of the tile manifest.
+    Only the rows of the slice are parsed, the storage backend might still
+    download the whole manifest file when opening it.
+    """
+    if not pred.tile_manifest:
+        # Chunks of predictions started before the tile manifest was introduced
+        # index into the prediction index range.
+        return list(get_prediction_index_range(pred))[from_index:to_index]
+    with pred.tile_manifest.open('rb') as fl:
+        numpy.lib.format.read_magic(fl)
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(fl)
+        to_index = min(to_index, shape[0])
+        from_index = min(from_index, to_index)
+        row_size = shape[1] * dtype.itemsize
+        fl.seek(from_index * row_size, io.SEEK_CUR)
+        tiles = numpy.frombuffer(fl.read((to_index - from_index) * row_size), dtype=dtype).reshape(-1, shape[1])
+    return [(tilex, tiley, ZOOM) for tilex, tiley in tiles.tolist()]
+
+
+def get_tile_fingerprints(pred, tiles, rasterlayer_ids):
+    """
+    Compute the input fingerprints of tiles for incremental predictions. The
+    fingerprint of a tile changes with the classifier, the input layers and
+    the versions of the input tiles in the tile store. Returns a structured
+    array with the tile indices and fingerprints, sorted by tile index.
+    """
+    layer_ids = [layer_id for ids in rasterlayer_ids for layer_id in ids]
+    versions = iter(get_tile_versions([(layer_id, tilez, tilex, tiley) for tilex, tiley, tilez in tiles for layer_id in layer_ids]))
+    config = [pred.classifier.trained_checksum, pred.store_class_probabilities, rasterlayer_ids]
+    fingerprints = numpy.empty(len(tiles), dtype=TILE_FINGERPRINT_DATATYPE)
+    for index, (tilex, tiley, tilez) in enumerate(tiles):
+        inputs = json.dumps([config, [next(versions) for layer_id in layer_ids]])
+        fingerprints[index] = (tilex, tiley, hashlib.blake2b(inputs.encode(), digest_size=16).digest())
+    return numpy.sort(fingerprints, order=['tilex', 'tiley'])
+
+
+def get_changed_tiles(pred, fingerprints):
+    """
+    Return the (tilex, tiley, tilez) indices of the tiles whose fingerprint
+    differs from the last incremental prediction of the layer.
+    """
+    changed = numpy.ones(len(fingerprints), dtype='bool')
+    previous = read_array_file(pred.tile_fingerprints) if pred.tile_fingerprints else None
+    if previous is not None and len(previous) and len(fingerprints):
+        # Match the tiles on a combined key, both arrays are sorted by tile.
+        keys = previous['tilex'].astype('int64') << 32 | previous['tiley'].astype('int64')
+        new_keys = fingerprints['tilex'].astype('int64') << 32 | fingerprints['tiley'].astype('int64')
+        positions = numpy.minimum(numpy.searchsorted(keys, new_keys), len(keys) - 1)
+        changed = (keys[positions] != new_keys) | (previous['fingerprint'][positions] != fingerprints['fingerprint'])
+    return [(tilex, tiley, ZOOM) for tilex, tiley in zip(fingerprints['tilex'][changed].tolist(), fingerprints['tiley'][changed].tolist())]
+
+
+def update_prediction_tile_fingerprints(pred):
+    """
+    Store the fingerprints recorded by the chunks as fingerprints of the
+    layer, for the next incremental prediction. If a chunk did not record
+    fingerprints, the stored fingerprints are removed, so that the next
+    prediction processes all tiles.
+    """
+    chunks = list(pred.predictedlayerchunk_set.all())
+    if chunks and all(chunk.tile_fingerprints for chunk in chunks):
+        fingerprints = numpy.concatenate([read_array_file(chunk.tile_fingerprints) for chunk in chunks])
+        fingerprints = numpy.sort(fingerprints, order=['tilex', 'tiley'])
+        save_array_file(pred.tile_fingerprints, 'predictedlayer-tile-fingerprints-{}.npy'.format(pred.id), fingerprints)
+    elif pred.tile_fingerprints:
+        pred.tile_fingerprints.delete()
+
+
 def predict_sentinel_layer(predicted_layer_id):
     """
     Use a classifier to predict data onto a rasterlayer. The PredictedLayer
@@ -674,32 +920,17 @@ def predict_sentinel_layer(predicted_layer_id):
             return
         pred.write('Started predicting layer.', pred.PROCESSING)
 
-    # Get tile range for compositeband or sentineltile for this prediction.
-    tiles = get_prediction_index_range(pred)
+    # Store the tiles for this prediction, the chunks process slices of them.
+    chunk_ranges = write_prediction_tile_manifest(pred)
+    tile_count = chunk_ranges[-1][1] if chunk_ranges else 0
+    pred.write('Found {} tiles intersecting with the aggregation areas.'.format(tile_count))
 
     # Push tasks for sentinel chunks.
-    counter = 0
-    for tile_index in tiles:
-        counter += 1
-        if counter % pred.chunk_size == 0:
-            chunk = PredictedLayerChunk.objects.create(
-                predictedlayer=pred,
-                from_index=counter - pred.chunk_size,
-                to_index=counter,
-                status=PredictedLayerChunk.PENDING,
-            )
-            if pred.sieve_threshold > 0:
-                ecs.sieve_sentinel_chunk(chunk.id)
-            else:
-                ecs.predict_sentinel_chunk(chunk.id)
-
-    # Push the remaining index range as well.
-    rest = counter % pred.chunk_size
-    if rest:
+    for from_index, to_index in chunk_ranges:
         chunk = PredictedLayerChunk.objects.create(
             predictedlayer=pred,
-            from_index=counter - rest,
-            to_index=counter,
+            from_index=from_index,
+            to_index=to_index,
             status=PredictedLayerChunk.PENDING,
         )
         if pred.sieve_threshold > 0:
@@ -712,17 +943,93 @@ def predict_sentinel_layer(predicted_layer_id):
     pred.write('Task will require {} chunks.'.format(pred.predictedlayerchunk_set.count()))
 
 
+def get_prediction_batch_data(tiles, rasterlayer_ids, is_rnn, dtype=None):
+    """
+    Get the classifier data for a batch of tiles. The rasterlayer ids contain
+    one id list per time step. Returns the tiles with data for all layers and
+    their pixels, stacked in one array of shape (pixels, bands) or (pixels,
+    time steps, bands).
+
+    The time steps are read one after the other, with the tiles of all bands
+    and tiles of a time step fetched at once. Tiles with a missing input are
+    dropped before the next time step is read, so no reads are spent on them.
+    The pixels are written directly into the stacked array, in the given data
+    type or the data type of the input tiles.
+    """
+    pixels = WEB_MERCATOR_TILESIZE * WEB_MERCATOR_TILESIZE
+    nr_of_bands = len(rasterlayer_ids[0])
+    valid = list(range(len(tiles)))
+    data = None
+    for step, ids in enumerate(rasterlayer_ids):
+        if not valid:
+            break
+        fetched = get_raster_tiles([(layer_id, tiles[index][2], tiles[index][0], tiles[index][1]) for index in valid for layer_id in ids])
+        step_tiles = [fetched[position * len(ids):(position + 1) * len(ids)] for position in range(len(valid))]
+        # Drop the tiles without data for any of the layers.
+        step_tiles = [(index, layers) for index, layers in zip(valid, step_tiles) if all(layers)]
+        valid = [index for index, layers in step_tiles]
+        if not valid:
+            break
+        if data is None:
+            dtype = dtype or numpy.result_type(*[tile.bands[0].data().dtype for tile in step_tiles[0][1]])
+            data = numpy.empty((len(tiles), pixels, len(rasterlayer_ids), nr_of_bands), dtype=dtype)
+        for index, layers in step_tiles:
+            for band, tile in enumerate(layers):
+                data[index, :, step, band] = tile.bands[0].data().ravel()
+
+    tiles = [tiles[index] for index in valid]
+    if not tiles:
+        return tiles, None
+    # Drop the slots of tiles without data.
+    if len(valid) < len(data):
+        data = data[valid]
+    data = data.reshape(len(tiles) * pixels, len(rasterlayer_ids), nr_of_bands)
+    return tiles, data if is_rnn else data[:, 0, :]
+
+
+def prediction_batches(tiles, batch_size, rasterlayer_ids, is_rnn, dtype=None):
+    """
+    Yield the classifier data for batches of tiles. If prefetching is enabled,
+    the data of the next batch is fetched in the background while the current
+    batch is processed.
+    """
+    batches = [tiles[start:start + batch_size] for start in range(0, len(tiles), batch_size)]
+    if not settings.PREDICTION_PREFETCH:
+        for batch in batches:
+            yield get_prediction_batch_data(batch, rasterlayer_ids, is_rnn, dtype)
+        return
+
+    if not batches:
+        return
+
+    def prefetch(batch):
+        return prefetcher.submit(get_prediction_batch_data, batch, rasterlayer_ids, is_rnn, dtype)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='predictprefetch') as prefetcher:
+        future = prefetch(batches[0])
+        for index in range(len(batches)):
+            batch_data = future.result()
+            # Start fetching the next batch.
+            if index + 1 < len(batches):
+                future = prefetch(batches[index + 1])
+            yield batch_data
+
+
+@use_tile_cache()
+@use_tile_index()
 def predict_sentinel_chunk(chunk_id):
     """
-    Predict over a group of tiles.
+    Predict over a group of tiles. The pixels of multiple tiles are predicted
+    in one batch, the batch size is configured on the predicted layer.
     """
+    start_time = time.perf_counter()
     # Get chunk.
     chunk = PredictedLayerChunk.objects.get(id=chunk_id)
     # Update chunk status.
     chunk.status = PredictedLayerChunk.PROCESSING
     chunk.save()
-    # Get global tile range.
-    tiles = get_prediction_index_range(chunk.predictedlayer)
+    # Get the tiles of this chunk.
+    tiles = read_prediction_tile_manifest(chunk.predictedlayer, chunk.from_index, chunk.to_index)
     # Get band names for data matrix construction.
     band_names = chunk.predictedlayer.classifier.band_names.split(',')
     # Get rasterlayer ids.
@@ -741,70 +1048,50 @@ def predict_sentinel_chunk(chunk_id):
         # number of composites to do the "look-back"
         is_rnn = True
         rasterlayer_lookup = [composite.rasterlayer_lookup for composite in chunk.predictedlayer.composites.all()]
+    # Convert lookups to id lists, one per time step.
+    if is_rnn:
+        rasterlayer_ids = [get_rasterlayer_ids(band_names, lookup) for lookup in rasterlayer_lookup]
+    else:
+        rasterlayer_ids = [get_rasterlayer_ids(band_names, rasterlayer_lookup)]
+    # Determine numpy and GDAL datatypes.
+    dtype = REGRESSION_DATATYPE if chunk.predictedlayer.classifier.is_regressor else CLASSIFICATION_DATATYPE
+    dtype_gdal = REGRESSION_DATATYPE_GDAL if chunk.predictedlayer.classifier.is_regressor else CLASSIFICATION_DATATYPE_GDAL
+    # For incremental predictions, only predict the tiles whose inputs
+    # changed since the last prediction. The classifier checksum is part of
+    # the fingerprint, classifiers trained before checksums were stored are
+    # always predicted fully.
+    predict_tiles = tiles
+    if chunk.predictedlayer.incremental and chunk.predictedlayer.classifier.trained_checksum:
+        fingerprints = get_tile_fingerprints(chunk.predictedlayer, tiles, rasterlayer_ids)
+        save_array_file(chunk.tile_fingerprints, 'predictedlayerchunk-tile-fingerprints-{}.npy'.format(chunk.id), fingerprints, save=False)
+        predict_tiles = get_changed_tiles(chunk.predictedlayer, fingerprints)
     # Predict tiles over this chunk's range.
-    for tilex, tiley, tilez in list(tiles)[chunk.from_index:chunk.to_index]:
-        if is_rnn:
-            data = []
-            for lookup in rasterlayer_lookup:
-                # Convert lookup to id list.
-                rasterlayer_ids = get_rasterlayer_ids(band_names, lookup)
-                # Get data from tiles for prediction.
-                pixels = get_classifier_data(rasterlayer_ids, tilez, tilex, tiley)
-                data.append(pixels)
-                if pixels is None:
-                    data = None
-                    break
-            if data is None:
-                continue
-            # Reshape array to right format.
-            data = numpy.swapaxes(numpy.array(data), 0, 1)
-        else:
-            # Convert lookup to id list.
-            rasterlayer_ids = get_rasterlayer_ids(band_names, rasterlayer_lookup)
-            # Get data from tiles for prediction.
-            data = get_classifier_data(rasterlayer_ids, tilez, tilex, tiley)
-            if data is None:
+    written = []
+    with TileWriter() as writer:
+        # TF keras cant handle unit16, the pixels are read as float16.
+        data_dtype = KERAS_TRAIN_TYPE if chunk.predictedlayer.classifier.is_keras else None
+        # Keras models predict in batches of 32 pixels by default.
+        clf = chunk.predictedlayer.classifier.clf
+        predict_kwargs = {}
+        if chunk.predictedlayer.classifier.is_keras and not isinstance(clf, Pipeline):
+            predict_kwargs['batch_size'] = settings.PREDICTION_KERAS_BATCH_SIZE
+        batches = prediction_batches(predict_tiles, max(1, chunk.predictedlayer.prediction_batch_size), rasterlayer_ids, is_rnn, data_dtype)
+        for batch_tiles, data in batches:
+            if not batch_tiles:
                 continue
-        # Determine numpy and GDAL datatypes.
-        dtype = REGRESSION_DATATYPE if chunk.predictedlayer.classifier.is_regressor else CLASSIFICATION_DATATYPE
-        dtype_gdal = REGRESSION_DATATYPE_GDAL if chunk.predictedlayer.classifier.is_regressor else CLASSIFICATION_DATATYPE_GDAL
-        # TF keras cant handle unit16.
-        if chunk.predictedlayer.classifier.is_keras:
-            data = data.astype(KERAS_TRAIN_TYPE)
-        # Predict classes.
-        predicted = chunk.predictedlayer.classifier.clf.predict(data)
-        # If the model is a Keras model and not a Sklearn Pipeline, the prediction
-        # is a probability matrix and needs to be converted to a predicted array.
-        # This also assumes 1-N indexing of classes in digital numbers (DN),
-        # i.e. classi DN are sequential and start with 1.
-        nr_of_bands = 1
-        nodata_value = SENTINEL_NODATA_VALUE
-        if not isinstance(chunk.predictedlayer.classifier.clf, Pipeline) and not chunk.predictedlayer.classifier.is_regressor:
-            if chunk.predictedlayer.store_class_probabilities:
-                # Store the predicted probabilities separate bands.
-                predicted = [numpy.ascontiguousarray(255 * probability, dtype=dtype) for probability in predicted.swapaxes(0, 1)]
-                # Specify the number of bands to write as number of classes.
-                nr_of_bands = len(predicted)
-                nodata_value = None
-            else:
-                # Convert predicted into category index numbers.
-                predicted = numpy.argmax(predicted, axis=1) + 1
-                # Enforce correct dtype.
-                predicted = predicted.astype(dtype)
-        # Write predicted pixels into a tile.
-        write_raster_tile(
-            chunk.predictedlayer.rasterlayer_id,
-            predicted,
-            tilez,
-            tilex,
-            tiley,
-            nodata_value=nodata_value,
-            datatype=dtype_gdal,
-            merge_with_existing=False,
-            nr_of_bands=nr_of_bands,
-        )
-
-    # Log progress, update chunks done count.
+            # Predict classes for all tiles of the batch at once.
+            predicted = clf.predict(data, **predict_kwargs)
+            # Split the prediction into the tiles.
+            pixels = len(data) // len(batch_tiles)
+            for index, (tilex, tiley, tilez) in enumerate(batch_tiles):
+                write_predicted_tile(chunk.predictedlayer, predicted[index * pixels:(index + 1) * pixels], tilex, tiley, tilez, dtype, dtype_gdal, writer)
+                written.append((tilex, tiley))
+
+    duration = time.perf_counter() - start_time
+    logger.info('Predicted {} of {} tiles of chunk {} in {:.1f}s, {:.2f} tiles per second.'.format(len(written), len(tiles), chunk.id, duration, len(predict_tiles) / duration))
+
+    # Record the written tiles for the pyramid, update chunks done count.
+    save_tile_manifest(chunk.written_tiles, 'predictedlayerchunk-written-tiles-{}.npy'.format(chunk.id), written, save=False)
     chunk.status = PredictedLayerChunk.FINISHED
     chunk.save()
 
@@ -814,57 +1101,112 @@ def predict_sentinel_chunk(chunk_id):
         ecs.build_predicted_pyramid(chunk.predictedlayer.id)
 
 
+def write_predicted_tile(pred, predicted, tilex, tiley, tilez, dtype, dtype_gdal, writer):
+    """
+    Convert the prediction of one tile into the output format and write it.
+    """
+    # If the model is a Keras model and not a Sklearn Pipeline, the prediction
+    # is a probability matrix and needs to be converted to a predicted array.
+    # This also assumes 1-N indexing of classes in digital numbers (DN),
+    # i.e. classi DN are sequential and start with 1.
+    nr_of_bands = 1
+    nodata_value = SENTINEL_NODATA_VALUE
+    if not isinstance(pred.classifier.clf, Pipeline) and not pred.classifier.is_regressor:
+        if pred.store_class_probabilities:
+            # Store the predicted probabilities separate bands.
+            predicted = [numpy.ascontiguousarray(255 * probability, dtype=dtype) for probability in predicted.swapaxes(0, 1)]
+            # Specify the number of bands to write as number of classes.
+            nr_of_bands = len(predicted)
+            nodata_value = None
+        else:
+            # Convert predicted into category index numbers.
+            predicted = numpy.argmax(predicted, axis=1) + 1
+            # Enforce correct dtype.
+            predicted = predicted.astype(dtype)
+    # Write predicted pixels into a tile.
+    writer.submit(
+        write_raster_tile,
+        pred.rasterlayer_id,
+        predicted,
+        tilez,
+        tilex,
+        tiley,
+        nodata_value=nodata_value,
+        datatype=dtype_gdal,
+        merge_with_existing=False,
+        nr_of_bands=nr_of_bands,
+    )
+
+
+@use_tile_cache()
+@use_tile_index()
+def sieve_tile_block(pred, tiles):
+    """
+    Sieve a block of tiles as one mosaic. The mosaic covers the block plus a
+    halo of one tile, so that regions crossing the block boundary are sieved
+    with their neighbouring pixels. The sieved tiles of the block are cut out
+    of the mosaic and written to the predicted layer.
+    """
+    tilez = tiles[0][2]
+    block = {(tilex, tiley) for tilex, tiley, tilez in tiles}
+    # The parent tiles of the block and its direct neighbours.
+    indices = sorted({(tilex + i, tiley + j) for tilex, tiley in block for i in (-1, 0, 1) for j in (-1, 0, 1)})
+    parent_tiles = get_raster_tiles(
+        [(pred.sieve_parent.rasterlayer_id, tilez, tilex, tiley) for tilex, tiley in indices],
+        look_up=False,
+    )
+    # Assemble the mosaic, with blank pixels for missing tiles.
+    minx = min(tilex for tilex, tiley in indices)
+    miny = min(tiley for tilex, tiley in indices)
+    width = max(tilex for tilex, tiley in indices) - minx + 1
+    height = max(tiley for tilex, tiley in indices) - miny + 1
+    mosaic = numpy.zeros((height * WEB_MERCATOR_TILESIZE, width * WEB_MERCATOR_TILESIZE), CLASSIFICATION_DATATYPE)
+    for (tilex, tiley), tile in zip(indices, parent_tiles):
+        if tile:
+            row = (tiley - miny) * WEB_MERCATOR_TILESIZE
+            col = (tilex - minx) * WEB_MERCATOR_TILESIZE
+            mosaic[row:row + WEB_MERCATOR_TILESIZE, col:col + WEB_MERCATOR_TILESIZE] = tile.bands[0].data()
+    # Sieve the mosaic once, masking nodata pixels.
+    sieved = sieve(mosaic, pred.sieve_threshold, mask=mosaic != CLASSIFICATION_NODATA, connectivity=pred.sieve_connectivity)
+    with TileWriter() as writer:
+        for tilex, tiley in sorted(block):
+            row = (tiley - miny) * WEB_MERCATOR_TILESIZE
+            col = (tilex - minx) * WEB_MERCATOR_TILESIZE
+            writer.submit(
+                write_raster_tile,
+                layer_id=pred.rasterlayer_id,
+                result=sieved[row:row + WEB_MERCATOR_TILESIZE, col:col + WEB_MERCATOR_TILESIZE].astype(CLASSIFICATION_DATATYPE),
+                tilez=tilez,
+                tilex=tilex,
+                tiley=tiley,
+                nodata_value=CLASSIFICATION_NODATA,
+                datatype=CLASSIFICATION_DATATYPE_GDAL,
+                merge_with_existing=False,
+            )
+
+
+@use_tile_cache()
+@use_tile_index()
 def sieve_sentinel_chunk(chunk_id):
     """
-    Sieve a group of tiles.
+    Sieve a group of tiles, block by block.
     """
     # Get chunk.
     chunk = PredictedLayerChunk.objects.get(id=chunk_id)
     # Update chunk status.
     chunk.status = PredictedLayerChunk.PROCESSING
     chunk.save()
-    # Get global tile range.
-    tiles = list(get_prediction_index_range(chunk.predictedlayer))
-    # Prefetch all parent tiles for this chunk.
-    all_tiles = {}
-    for tilex, tiley, tilez in tiles[chunk.from_index:chunk.to_index]:
-        tile = get_raster_tile(chunk.predictedlayer.sieve_parent.rasterlayer_id, tilez=tilez, tilex=tilex, tiley=tiley, look_up=False)
-        if tile:
-            all_tiles[(tilex, tiley)] = tile.bands[0].data()
-    # Create blank array.
-    blank = numpy.zeros((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), CLASSIFICATION_DATATYPE)
-    # Sieve by constructing tile plus surrounding tiles.
-    for tilex, tiley, tilez in tiles[chunk.from_index:chunk.to_index]:
-        # Construct pixel area around center tile.
-        data = []
-        for i in [-1, 0, 1]:
-            column = []
-            for j in [-1, 0, 1]:
-                tile = all_tiles.get((tilex + i, tiley + j), blank)
-                column.append(tile)
-            data.append(numpy.vstack(column))
-        data = numpy.hstack(data)
-        # Construct mask for sieving.
-        mask = data != CLASSIFICATION_NODATA
-        # Sieve raster.
-        sieved = sieve(data, chunk.predictedlayer.sieve_threshold, mask=mask, connectivity=chunk.predictedlayer.sieve_connectivity)
-        # Extract center pixels.
-        result = sieved[WEB_MERCATOR_TILESIZE:(2 * WEB_MERCATOR_TILESIZE), WEB_MERCATOR_TILESIZE:(2 * WEB_MERCATOR_TILESIZE)]
-        # Convert to classification datatype.
-        result = result.astype(CLASSIFICATION_DATATYPE)
-        # Write tile.
-        write_raster_tile(
-            layer_id=chunk.predictedlayer.rasterlayer_id,
-            result=result,
-            tilez=tilez,
-            tilex=tilex,
-            tiley=tiley,
-            nodata_value=CLASSIFICATION_NODATA,
-            datatype=CLASSIFICATION_DATATYPE_GDAL,
-            merge_with_existing=False,
-        )
-
-    # Log progress.
+    # Get the tiles of this chunk and group them into the sieve blocks.
+    tiles = read_prediction_tile_manifest(chunk.predictedlayer, chunk.from_index, chunk.to_index)
+    block_size = get_sieve_block_size(chunk.predictedlayer)
+    blocks = {}
+    for tile in tiles:
+        blocks.setdefault((tile[0] // block_size, tile[1] // block_size), []).append(tile)
+    for block in blocks.values():
+        sieve_tile_block(chunk.predictedlayer, block)
+
+    # Record the written tiles for the pyramid, log progress.
+    save_tile_manifest(chunk.written_tiles, 'predictedlayerchunk-written-tiles-{}.npy'.format(chunk.id), [(tilex, tiley) for tilex, tiley, tilez in tiles], save=False)
     chunk.status = PredictedLayerChunk.FINISHED
     chunk.save()
 
@@ -874,6 +1216,8 @@ def sieve_sentinel_chunk(chunk_id):
         ecs.build_predicted_pyramid(chunk.predictedlayer.id)
 
 
+@use_tile_cache()
+@use_tile_index()
 def build_predicted_pyramid(predicted_layer_id):
     """
     Build an overview stack over a predicted layer.
@@ -887,44 +1231,120 @@ def build_predicted_pyramid(predicted_layer_id):
     dtype = REGRESSION_DATATYPE if is_regressor else CLASSIFICATION_DATATYPE
     dtype_gdal = REGRESSION_DATATYPE_GDAL if is_regressor else CLASSIFICATION_DATATYPE_GDAL
 
-    # Loop through the tiles in each zoom level, bottom up.
-    for tilez in range(ZOOM - 1, -1, -1):
-        pred.write('Building pyramid at zoom level {}'.format(tilez))
-
-        for tilex, tiley, tilez in get_prediction_index_range(pred, tilez):
-            # Get tile data.
-            tiles = [
-                get_raster_tile(pred.rasterlayer_id, tilez=tilez + 1, tilex=tilex * 2, tiley=tiley * 2, look_up=False),
-                get_raster_tile(pred.rasterlayer_id, tilez=tilez + 1, tilex=tilex * 2 + 1, tiley=tiley * 2, look_up=False),
-                get_raster_tile(pred.rasterlayer_id, tilez=tilez + 1, tilex=tilex * 2, tiley=tiley * 2 + 1, look_up=False),
-                get_raster_tile(pred.rasterlayer_id, tilez=tilez + 1, tilex=tilex * 2 + 1, tiley=tiley * 2 + 1, look_up=False),
-            ]
-            # Continue if no tiles were found.
-            if not len([tile for tile in tiles if tile is not None]):
-                continue
-            # Extract pixel values.
-            tile_data = [
-                numpy.zeros((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)).astype(dtype) if tile is None else tile.bands[0].data() for tile in tiles
-            ]
-            # Combine data to larger tile.
-            tile_data = numpy.concatenate([
-                numpy.concatenate(tile_data[:2], axis=1),
-                numpy.concatenate(tile_data[2:], axis=1),
-            ])
-            # Aggregate tile to lower resolution using rasterio resampling.
-            tile_data_rescaled = aggregate_tile(tile_data, target_dtype=tile_data.dtype, discrete=tile_data.dtype is CLASSIFICATION_DATATYPE)
-            # Write tile.
-            write_raster_tile(
-                layer_id=pred.rasterlayer_id,
-                result=tile_data_rescaled,
-                tilez=tilez,
-                tilex=tilex,
-                tiley=tiley,
-                nodata_value=CLASSIFICATION_NODATA,
-                datatype=dtype_gdal,
+    # Loop through the zoom levels bottom up, only visiting parent tiles
+    # with at least one written child tile. The parent tiles of a level are
+    # built concurrently in batches.
+    tiles = get_pyramid_base_tiles(pred)
+    # Incremental predictions only write the changed tiles, their unchanged
+    # siblings exist from earlier predictions. So all four children of the
+    # visited parents are fetched.
+    incremental = pred.incremental and bool(pred.tile_fingerprints)
+    workers = settings.PYRAMID_WORKERS
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pyramid') if workers > 1 else None
+    try:
+        for tilez in range(ZOOM - 1, -1, -1):
+            children = set(map(tuple, tiles.tolist()))
+            parents = numpy.unique(tiles // 2, axis=0).tolist()
+            pred.write('Building pyramid at zoom level {} with {} tiles'.format(tilez, len(parents)))
+            batches = [parents[start:start + PYRAMID_PREFETCH_SIZE] for start in range(0, len(parents), PYRAMID_PREFETCH_SIZE)]
+            results = (executor.map if executor else map)(
+                lambda batch: _build_predicted_pyramid_batch(pred, batch, tilez, None if incremental else children, dtype, dtype_gdal),
+                batches,
             )
+            tiles = numpy.array([tile for written in results for tile in written], dtype=TILE_MANIFEST_DATATYPE).reshape(-1, 2)
+    finally:
+        if executor:
+            executor.shutdown()
+
+    # Store the input fingerprints once the pyramid is complete.
+    if pred.incremental:
+        update_prediction_tile_fingerprints(pred)
 
     pred.write('Finished building pyramid, prediction task completed.', pred.FINISHED)
 
     # Push report job.
     push_reports('predictedlayer', pred.id)
+
+
+def get_pyramid_base_tiles(pred):
+    """
+    Return the tiles written at full resolution as sorted array of (tilex,
+    tiley) rows. The tiles are recorded by the prediction and sieve chunks.
+    For predictions started before, the tiles of the tile manifest or the
+    prediction index range are used.
+    """
+    chunks = list(pred.predictedlayerchunk_set.all())
+    if chunks and all(chunk.written_tiles for chunk in chunks):
+        tiles = [read_array_file(chunk.written_tiles) for chunk in chunks]
+    elif pred.tile_manifest:
+        tiles = [read_array_file(pred.tile_manifest)]
+    else:
+        tiles = [[(tilex, tiley) for tilex, tiley, tilez in get_prediction_index_range(pred, ZOOM)]]
+    tiles = [numpy.asarray(tile, dtype=TILE_MANIFEST_DATATYPE).reshape(-1, 2) for tile in tiles]
+    return numpy.unique(numpy.concatenate(tiles), axis=0)
+
+
+def _build_predicted_pyramid_batch(pred, parents, tilez, children, dtype, dtype_gdal):
+    """
+    Build the pyramid tiles for a batch of parent tiles. Only the child tiles
+    in the set of children of the level below are fetched, all child tiles
+    if the set is None. Returns the parent tiles that were written.
+    """
+    requests = []
+    quadrants = []
+    for tilex, tiley in parents:
+        quadrant = [
+            (tilex * 2, tiley * 2),
+            (tilex * 2 + 1, tiley * 2),
+            (tilex * 2, tiley * 2 + 1),
+            (tilex * 2 + 1, tiley * 2 + 1),
+        ]
+        exists = [children is None or child in children for child in quadrant]
+        requests += [(pred.rasterlayer_id, tilez + 1, childx, childy) for (childx, childy), flag in zip(quadrant, exists) if flag]
+        quadrants.append(exists)
+    fetched = iter(get_raster_tiles(requests, look_up=False))
+    written = []
+    for (tilex, tiley), quadrant in zip(parents, quadrants):
+        tiles = [next(fetched) if exists else None for exists in quadrant]
+        if _build_predicted_pyramid_tile(pred, tilex, tiley, tilez, tiles, dtype, dtype_gdal):
+            written.append((tilex, tiley))
+    return written
+
+
+def _build_predicted_pyramid_tile(pred, tilex, tiley, tilez, tiles, dtype, dtype_gdal):
+    """
+    Aggregate the four child tiles into their parent pyramid tile. Returns
+    False if none of the child tiles exist.
+    """
+    # Skip if no tiles were found.
+    if not len([tile for tile in tiles if tile is not None]):
+        return False
+    # Extract pixel values.
+    tile_data = [
+        numpy.zeros((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)).astype(dtype) if tile is None else tile.bands[0].data() for tile in tiles
+    ]
+    # Combine data to larger tile.
+    tile_data = numpy.concatenate([
+        numpy.concatenate(tile_data[:2], axis=1),
+        numpy.concatenate(tile_data[2:], axis=1),
+    ])
+    # Aggregate tile to lower resolution, using the most frequent class for
+    # classifications.
+    discrete = tile_data.dtype == CLASSIFICATION_DATATYPE and not pred.store_class_probabilities
+    tile_data_rescaled = aggregate_tile(
+        tile_data,
+        target_dtype=tile_data.dtype,
+        nodata=CLASSIFICATION_NODATA,
+        method=AGGREGATE_MODE if discrete else AGGREGATE_MEAN,
+    )
+    # Write tile.
+    write_raster_tile(
+        layer_id=pred.rasterlayer_id,
+        result=tile_data_rescaled,
+        tilez=tilez,
+        tilex=tilex,
+        tiley=tiley,
+        nodata_value=CLASSIFICATION_NODATA,
+        datatype=dtype_gdal,
+    )
+    return True
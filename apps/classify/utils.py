@@ -1,19 +1,29 @@
 import math
+from tempfile import TemporaryFile
 
 import numpy
 from sklearn.base import TransformerMixin
 from sklearn.preprocessing import RobustScaler
-from sklearn.utils import shuffle
 from tensorflow.keras.callbacks import Callback
-from tensorflow.keras.utils import Sequence
+from tensorflow.keras.utils import Sequence, to_categorical
+
+from classify.dataset import read_rows
 
 
 class RNNRobustScaler(TransformerMixin):
     """
     Robust scaler for 3D inputs.
     https://stackoverflow.com/questions/50125844/how-to-standard-scale-a-3d-matrix
+
+    The input can also be an on-disk array, it is read in blocks of rows. The
+    scaler is fitted on a random selection of at most fit_rows rows.
     """
 
+    # Maximum number of rows used to fit the scaler.
+    fit_rows = 1000000
+    # Number of rows transformed at once.
+    chunk_rows = 100000
+
     def __init__(self, *args, **kwargs):
         self._scaler = RobustScaler(*args, **kwargs)
         self._orig_features = None
@@ -26,16 +36,21 @@ class RNNRobustScaler(TransformerMixin):
             raise ValueError('RNNRobustScaler only works for 3D arrays.')
         self._orig_features = X.shape[2]
         self._orig_timesteps = X.shape[1]
-        X = self._flatten(X)
+        if len(X) > self.fit_rows:
+            X = read_rows(X, numpy.sort(numpy.random.choice(len(X), self.fit_rows, replace=False)))
+        X = self._flatten(numpy.asarray(X[:]))
         self._scaler.fit(X, *args, **kwargs)
         return self
 
     def transform(self, X, *args, **kwargs):
-        X = numpy.array(X)
-        X = self._flatten(X)
-        X = self._scaler.transform(X, *args, **kwargs)
-        X = self._reshape(X)
-        return X
+        if not hasattr(X, 'shape'):
+            X = numpy.array(X)
+        # Transform blocks of rows to limit the size of the flattened copies.
+        result = []
+        for start in range(0, max(len(X), 1), self.chunk_rows):
+            chunk = self._flatten(numpy.array(X[start:start + self.chunk_rows]))
+            result.append(self._reshape(self._scaler.transform(chunk, *args, **kwargs)))
+        return numpy.concatenate(result)
 
     def _flatten(self, X):
         X = X.reshape(X.shape[0] * self._orig_timesteps, self._orig_features)
@@ -48,28 +63,148 @@ class RNNRobustScaler(TransformerMixin):
         return X
 
 
+class TrainingMatrixAccumulator(object):
+    """
+    Growable column store to collect training data in chunks of rows. The
+    chunks of each column are concatenated once when the arrays are requested,
+    so appending rows does not copy the rows collected before.
+
+    If a spill size is given, the chunks are written to temporary files once
+    the collected data exceeds that size, and the arrays are memory mapped from
+    those files.
+    """
+
+    def __init__(self, columns, spill_bytes=None):
+        """
+        The columns are a list of (dtype, row shape) tuples.
+        """
+        self.empty = [numpy.empty((0, ) + tuple(shape), dtype=dtype) for dtype, shape in columns]
+        self.spill_bytes = spill_bytes
+        self.nbytes = 0
+        self.rows = []
+        self.chunks = []
+        self.files = None
+
+    def __len__(self):
+        return sum(self.rows)
+
+    @property
+    def spilled(self):
+        return self.files is not None
+
+    def append(self, *arrays):
+        """
+        Add a chunk of rows, with one array per column.
+        """
+        if len(arrays) != len(self.empty):
+            raise ValueError('Expected {} columns, got {}.'.format(len(self.empty), len(arrays)))
+        rows = len(arrays[0])
+        if not rows:
+            return
+        self.rows.append(rows)
+        self.nbytes += sum(array.nbytes for array in arrays)
+        if self.spilled:
+            self._spill(arrays)
+        elif self.spill_bytes is not None and self.nbytes > self.spill_bytes:
+            # Fix the data types of the columns and move the collected chunks
+            # to disk.
+            self.empty = [empty.astype(numpy.result_type(empty, *[chunk[index] for chunk in self.chunks + [arrays]])) for index, empty in enumerate(self.empty)]
+            self.files = [TemporaryFile() for empty in self.empty]
+            for chunk in self.chunks:
+                self._spill(chunk)
+            self.chunks = None
+            self._spill(arrays)
+        else:
+            self.chunks.append(arrays)
+
+    def _spill(self, arrays):
+        for fl, empty, array in zip(self.files, self.empty, arrays):
+            if not numpy.can_cast(array.dtype, empty.dtype):
+                raise ValueError('Can not store {} data in a {} column.'.format(array.dtype, empty.dtype))
+            fl.write(numpy.ascontiguousarray(array, dtype=empty.dtype).tobytes())
+
+    def arrays(self, reverse=False):
+        """
+        Return the collected data as one array per column. With reverse, the
+        chunks are combined in the reverse order of appending.
+        """
+        if not self.spilled:
+            chunks = self.chunks[::-1] if reverse else self.chunks
+            return [numpy.concatenate([empty] + [chunk[index] for chunk in chunks]) for index, empty in enumerate(self.empty)]
+
+        total = len(self)
+        result = []
+        for fl, empty in zip(self.files, self.empty):
+            fl.flush()
+            data = numpy.memmap(fl, dtype=empty.dtype, mode='r', shape=(total, ) + empty.shape[1:])
+            if reverse:
+                # Copy the chunks in reverse order into a new file.
+                reversed_data = numpy.memmap(TemporaryFile(), dtype=empty.dtype, mode='w+', shape=data.shape)
+                start = total
+                offset = 0
+                for rows in self.rows:
+                    start -= rows
+                    reversed_data[start:start + rows] = data[offset:offset + rows]
+                    offset += rows
+                data = reversed_data
+            result.append(data)
+        return result
+
+
 class PixelSequence(Sequence):
     """
     A batch generator for fitting Keras models.
+
+    The data can be numpy arrays, memory maps or HDF5 datasets, only the rows
+    of one batch are read at a time. The indices optionally select a subset of
+    the x rows, the y values and sample weights are given for the selected
+    rows only. Shuffling permutes blocks of chunk size consecutive rows, and
+    then shuffles the rows within windows of buffer chunks consecutive blocks.
+    The batches are read from a few contiguous blocks of on-disk data, while
+    each batch mixes rows of all blocks in its window. The chunk size defaults
+    to the HDF5 chunk rows, and to single rows otherwise.
+
+    If the number of classes is given, the y values are class numbers starting
+    with 1, they are converted to one-hot-encoding for each batch. The x values
+    are converted to dtype for each batch if specified.
     """
-    def __init__(self, x_set, y_set=None, batch_size=32, shuffle=True, sample_weights=None):
+    def __init__(self, x_set, y_set=None, batch_size=32, shuffle=True, sample_weights=None, indices=None, chunk_size=None, buffer_chunks=16, num_classes=None, dtype=None):
         self.x = x_set
         self.y = y_set
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.sample_weights = sample_weights
+        self.indices = indices
+        self.num_classes = num_classes
+        self.dtype = dtype
+        if chunk_size is None:
+            # HDF5 datasets have a chunk shape, arrays do not.
+            chunks = getattr(x_set, 'chunks', None)
+            chunk_size = chunks[0] if chunks else 1
+        self.chunk_size = chunk_size
+        self.buffer_chunks = buffer_chunks
+        self.size = len(x_set) if indices is None else len(indices)
+        self.order = numpy.arange(self.size)
         self.on_epoch_end()
 
     def __len__(self):
-        return math.ceil(len(self.x) / self.batch_size)
+        return math.ceil(self.size / self.batch_size)
 
     def __getitem__(self, idx):
         start = idx * self.batch_size
         end = start + self.batch_size
 
-        batch_x = self.x[start:end]
-        batch_y = self.y[start:end] if self.y is not None else None
-        sample_weights = self.sample_weights[start:end] if self.sample_weights is not None else None
+        # Read the rows of this batch in ascending order.
+        positions = numpy.sort(self.order[start:end])
+        rows = positions if self.indices is None else self.indices[positions]
+
+        batch_x = read_rows(self.x, rows)
+        if self.dtype is not None:
+            batch_x = batch_x.astype(self.dtype)
+        batch_y = read_rows(self.y, positions) if self.y is not None else None
+        if batch_y is not None and self.num_classes is not None:
+            batch_y = to_categorical(batch_y - 1, num_classes=self.num_classes)
+        sample_weights = read_rows(self.sample_weights, positions) if self.sample_weights is not None else None
 
         if batch_y is None and sample_weights is None:
             return batch_x
@@ -80,10 +215,16 @@ class PixelSequence(Sequence):
 
     def on_epoch_end(self):
         if self.shuffle is True and self.y is not None:
-            if self.sample_weights is None:
-                self.x, self.y = shuffle(self.x, self.y)
-            else:
-                self.x, self.y, self.sample_weights = shuffle(self.x, self.y, self.sample_weights)
+            # Permute the chunks of rows.
+            chunks = numpy.random.permutation(math.ceil(self.size / self.chunk_size))
+            order = (chunks[:, numpy.newaxis] * self.chunk_size + numpy.arange(self.chunk_size)).ravel()
+            order = order[order < self.size]
+            # Shuffle the rows within windows of consecutive chunks, chunks
+            # are usually larger than batches.
+            buffer_size = self.buffer_chunks * self.chunk_size
+            for start in range(0, len(order), buffer_size):
+                numpy.random.shuffle(order[start:start + buffer_size])
+            self.order = order
 
 
 class LogCallback(Callback):
@@ -34,6 +34,7 @@ def get_batch_job_base():
                 {'name': 'DB_HOST', 'value': os.environ.get('DB_HOST')},
                 {'name': 'DB_NAME', 'value': os.environ.get('DB_NAME')},
                 {'name': 'TESSELO_GPU', 'value': 'True'},
+                {'name': 'COMPOSITE_WORKERS', 'value': str(settings.COMPOSITE_WORKERS)},
             ]
         },
         'retryStrategy': {
@@ -128,7 +129,10 @@ def process_l2a(scene_id):
 
 
 def process_compositetile(compositetile_id):
-    job = run_ecs_command(['process_compositetile', compositetile_id])
+    # Memory for the decoded tile cache, plus the scene tiles of the current and
+    # the prefetched 20m tile and the stacks of each pixel selection worker.
+    memory = 1024 + settings.TILE_CACHE_MAX_BYTES // 1024 ** 2 + 512 * settings.COMPOSITE_WORKERS
+    job = run_ecs_command(['process_compositetile', compositetile_id], vcpus=settings.COMPOSITE_WORKERS, memory=memory)
     return track_job('sentinel', 'compositetile', compositetile_id, job)
 
 
@@ -191,6 +195,10 @@ def populate_report(aggregationlayer_id, composite_id, formula_id, predictedlaye
     return run_ecs_command(['populate_report', aggregationlayer_id, composite_id, formula_id, predictedlayer_id], retry=1, vcpus=2, memory=int(1024 * 14.5), queue='tesselo-{stage}-process-l2a')
 
 
+def populate_reports(aggregationlayer_id, *task_ids):
+    return run_ecs_command(['populate_reports', aggregationlayer_id] + list(task_ids), retry=1, vcpus=2, memory=int(1024 * 14.5), queue='tesselo-{stage}-process-l2a')
+
+
 def parse_aggregationlayer(pk):
     job = run_ecs_command(['parse_aggregationlayer', pk])
     return track_job('raster_aggregation', 'aggregationlayer', pk, job)
@@ -29,7 +29,7 @@ class Command(BaseCommand):
             train_sentinel_classifier
         )
         from naip.tasks import ingest_naip_manifest
-        from report.tasks import populate_report
+        from report.tasks import populate_report, populate_reports
         from sentinel.tasks import (
             clear_composite, clear_sentineltile, composite_build_callback, drive_sentinel_bucket_parser,
             process_compositetile, process_l2a, push_scheduled_composite_builds, sync_sentinel_bucket_utm_zone
@@ -52,6 +52,7 @@ class Command(BaseCommand):
             'ingest_naip_manifest': ingest_naip_manifest,
             'push_scheduled_composite_builds': push_scheduled_composite_builds,
             'populate_report': populate_report,
+            'populate_reports': populate_reports,
             'parse_aggregationlayer': aggregation_layer_parser,
             'parse_s3_sentinel_1_inventory': parse_s3_sentinel_1_inventory,
             'snap_terrain_correction': snap_terrain_correction,
@@ -1,3 +1,7 @@
 ALLOWED_LINEAR_UNITS = ['meter', 'metre']
 
 REPORT_ZOOM = 14
+
+# Maximum number of tiles that are mosaicked into one array when aggregating
+# an area. Larger areas are aggregated by tile column.
+REPORT_MOSAIC_MAX_TILES = 256
@@ -2,6 +2,8 @@ import datetime
 
 from django.contrib.postgres.fields import JSONField
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Concat
 from django.db.models.signals import post_delete, pre_save
 from django.dispatch import receiver
 from raster.tiles.const import WEB_MERCATOR_SRID
@@ -65,10 +67,14 @@ class ReportScheduleTask(models.Model):
 
     def write(self, data, status=None):
         now = '[{0}] '.format(datetime.datetime.now().strftime('%Y-%m-%d %T'))
-        self.log += now + str(data) + '\n'
+        line = now + str(data) + '\n'
+        self.log += line
+        # Append the line in the database, without sending the whole log.
+        update = {'log': Concat('log', Value(line))}
         if status:
             self.status = status
-        self.save()
+            update['status'] = status
+        ReportScheduleTask.objects.filter(id=self.id).update(**update)
 
 
 class ReportAggregation(models.Model):
@@ -119,7 +125,7 @@ class ReportAggregation(models.Model):
             dat += ' | Pred {}'.format(self.predictedlayer.id)
         return dat
 
-    def get_valuecount(self):
+    def get_valuecount(self, delete_existing=True):
         # Get data for valuecount result update.
         if self.composite:
             formula = self.formula.formula
@@ -143,7 +149,7 @@ class ReportAggregation(models.Model):
             raise ValueError('Specify Composite or PredictedLayer.')
 
         # Remove existing valuecounts.
-        if hasattr(self, 'valuecountresult') and self.valuecountresult is not None:
+        if delete_existing and hasattr(self, 'valuecountresult') and self.valuecountresult is not None:
             self.valuecountresult.delete()
 
         # Choose grouping.
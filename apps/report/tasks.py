@@ -1,10 +1,14 @@
 import datetime
 
+import sentry_sdk
 from raster_aggregation.models import AggregationLayer
 
 from jobs import ecs
 from report.models import WEB_MERCATOR_SRID, ReportAggregation, ReportSchedule, ReportScheduleTask
-from report.utils import populate_vc
+from report.utils import aggregate_zonal, populate_vc, populate_vc_zonal, zonal_aggregation_supported
+from report.writer import ReportAggregationWriter
+from sentinel.tilecache import use_tile_cache
+from sentinel.tileindex import use_tile_index
 
 
 def push_reports(model, pk):
@@ -69,9 +73,10 @@ def push_reports(model, pk):
             if hasattr(formula, 'composite') and formula.composite is not None:
                 combos.append((agg, formula.composite, formula, None))
 
-    # Push each combination as an async task.
+    # Get report schedule task trackers for each combination, grouped by
+    # aggregation layer.
+    tasks = {}
     for combo in combos:
-        # Get report schedule task tracker.
         task, created = ReportScheduleTask.objects.get_or_create(
             aggregationlayer_id=combo[0],
             composite_id=combo[1],
@@ -81,12 +86,17 @@ def push_reports(model, pk):
         # Skip if this task is already running.
         if task.status in [ReportScheduleTask.PENDING, ReportScheduleTask.PROCESSING]:
             continue
-
-        # Schedule report task for this combo.
         task.write('Scheduled report task.', ReportScheduleTask.PENDING)
-        ecs.populate_report(*combo)
+        tasks.setdefault(combo[0], []).append(task.id)
+
+    # Push one async task per aggregation layer, that computes all of its
+    # combinations in one pass over the tiles.
+    for aggregationlayer_id, task_ids in tasks.items():
+        ecs.populate_reports(aggregationlayer_id, *task_ids)
 
 
+@use_tile_cache()
+@use_tile_index()
 def populate_report(aggregationlayer_id, composite_id, formula_id, predictedlayer_id):
     """
     Run populate script for this report schedule.
@@ -119,6 +129,27 @@ def populate_report(aggregationlayer_id, composite_id, formula_id, predictedlaye
     if task.status == ReportScheduleTask.PROCESSING:
         return
 
+    populate_reports(aggregationlayer_id, task.id)
+
+
+@use_tile_cache()
+@use_tile_index()
+def populate_reports(aggregationlayer_id, *task_ids):
+    """
+    Run populate script for multiple report schedule tasks on one aggregation
+    layer. The tasks that can be aggregated zonally are computed in one pass
+    over the tiles, so that band tiles shared by multiple formulas and
+    composites are only read once.
+    """
+    # Do not run aggregations if they are already in progress.
+    tasks = ReportScheduleTask.objects.filter(
+        id__in=[int(task_id) for task_id in task_ids],
+        aggregationlayer_id=int(aggregationlayer_id),
+    ).exclude(status=ReportScheduleTask.PROCESSING).order_by('id')
+    tasks = list(tasks)
+    if not tasks:
+        return
+
     # Get aggregation layer.
     aggregationlayer = AggregationLayer.objects.get(id=aggregationlayer_id)
 
@@ -129,46 +160,85 @@ def populate_report(aggregationlayer_id, composite_id, formula_id, predictedlaye
         srid = WEB_MERCATOR_SRID
 
     # Initiate progress log.
-    total_jobs = aggregationlayer.aggregationarea_set.all().count()
-    task.write('Started aggregation task for {} areas using SRID {}.'.format(total_jobs, srid), ReportScheduleTask.PROCESSING)
-
-    # Loop through all aggregation areas for this layer.
-    counter = 0
-    for agg in aggregationlayer.aggregationarea_set.all():
-        counter += 1
-        # Retrieve current aggregation or create a new one.
-        try:
-            rep = ReportAggregation.objects.get(aggregationarea=agg, **lookup)
-        except ReportAggregation.DoesNotExist:
-            rep = ReportAggregation(aggregationarea=agg, **lookup)
-
-        # Create valuecount result object, configured using the report agg
-        # settings.
-        vc = rep.get_valuecount()
-
-        # Update the aggregation values, with minimal DB interactions.
-        vc = populate_vc(vc, srid)
-
-        # Store valuecount link.
-        rep.valuecountresult = vc
-
-        # Copy valuecount results into searchable fields.
-        rep.copy_valuecount()
-
-        # Compute percentage covered.
-        if rep.stats_cumsum_t0:
-            rep.stats_percentage_covered = (rep.stats_cumsum_t0 * vc.pixel_size_m2) / agg.geom.transform(srid, clone=True).area
-        else:
-            rep.stats_percentage_covered = 0
-
-        # Store srid used.
-        rep.srid = srid
-
-        # Save data.
-        rep.save()
-
-        # Log progress.
-        if counter % 250 == 0:
-            task.write('Completed {}/{} aggregations.'.format(counter, total_jobs))
+    areas = list(aggregationlayer.aggregationarea_set.all())
+    total_jobs = len(areas)
+    for task in tasks:
+        task.write('Started aggregation task for {} areas using SRID {}.'.format(total_jobs, srid), ReportScheduleTask.PROCESSING)
+
+    # Lookups of the report aggregations for each task.
+    lookups = {
+        task.id: {
+            'aggregationlayer_id': task.aggregationlayer_id,
+            'composite_id': task.composite_id,
+            'formula_id': task.formula_id,
+            'predictedlayer_id': task.predictedlayer_id,
+        } for task in tasks
+    }
 
-    task.write('Finished aggregation task.', ReportScheduleTask.FINISHED)
+    # Compute the valuecounts of all tasks that support it in one pass over
+    # the tiles, the others are computed area by area below. If the zonal
+    # aggregation fails, its tasks are computed area by area as well.
+    zonal = {}
+    if areas:
+        configs = {}
+        for task in tasks:
+            try:
+                configs[task.id] = ReportAggregation(aggregationarea=areas[0], **lookups[task.id]).get_valuecount()
+            except Exception:
+                # Invalid configurations fail their task in the loop below.
+                continue
+        zonal_tasks = [task for task in tasks if task.id in configs and zonal_aggregation_supported(configs[task.id], srid)]
+        if zonal_tasks:
+            results = aggregate_zonal([configs[task.id] for task in zonal_tasks], [agg.geom for agg in areas])
+            for task, stats in zip(zonal_tasks, results):
+                if stats is None:
+                    task.write('Failed computing valuecounts in one pass over the tiles, aggregating area by area.')
+                else:
+                    zonal[task.id] = stats
+                    task.write('Computed valuecounts for {} areas in one pass over the tiles.'.format(total_jobs))
+
+    # Run the tasks one by one, a failing task is marked as failed and does
+    # not stop the remaining tasks.
+    for task in tasks:
+        try:
+            writer = ReportAggregationWriter(lookups[task.id])
+            counter = 0
+            for index, agg in enumerate(areas):
+                counter += 1
+                # Retrieve current aggregation or create a new one, with a new
+                # valuecount result object.
+                rep, vc = writer.get(agg)
+
+                # Update the aggregation values, the results are stored in bulk.
+                if task.id in zonal:
+                    vc = populate_vc_zonal(vc, zonal[task.id], index, save=False)
+                else:
+                    vc = populate_vc(vc, srid, save=False)
+
+                # Store valuecount link.
+                rep.valuecountresult = vc
+
+                # Copy valuecount results into searchable fields.
+                rep.copy_valuecount()
+
+                # Compute percentage covered.
+                if rep.stats_cumsum_t0:
+                    rep.stats_percentage_covered = (rep.stats_cumsum_t0 * vc.pixel_size_m2) / agg.geom.transform(srid, clone=True).area
+                else:
+                    rep.stats_percentage_covered = 0
+
+                # Store srid used.
+                rep.srid = srid
+
+                # Save data.
+                writer.add(rep, vc)
+
+                # Log progress.
+                if counter % 250 == 0:
+                    task.write('Completed {}/{} aggregations.'.format(counter, total_jobs))
+
+            writer.flush()
+            task.write('Finished aggregation task.', ReportScheduleTask.FINISHED)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            task.write('Failed aggregation task: {}'.format(e), ReportScheduleTask.FAILED)
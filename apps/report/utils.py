@@ -9,8 +9,8 @@ from django.contrib.gis.gdal import OGRGeometry
 from raster.algebra.parser import FormulaParser, RasterAlgebraParser
 from raster.exceptions import RasterAggregationException
 from raster.models import Legend
-from raster.tiles.const import WEB_MERCATOR_SRID
-from raster.tiles.utils import tile_index_range
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
 from raster.valuecount import Aggregator
 from rasterio import Affine
 from rasterio.crs import CRS
@@ -18,11 +18,28 @@ from rasterio.features import bounds, rasterize
 from rasterio.io import MemoryFile
 from rasterio.warp import Resampling, calculate_default_transform, reproject
 
-from report.const import ALLOWED_LINEAR_UNITS, REPORT_ZOOM
-from sentinel.utils import get_raster_tile
+from report.const import ALLOWED_LINEAR_UNITS, REPORT_MOSAIC_MAX_TILES, REPORT_ZOOM
+from sentinel.utils import TileRasterizer, get_raster_tile, get_raster_tiles
 
 VALUECOUNT_ROUNDING_DIGITS = 7
 
+# Number of layer tiles fetched at once by the zonal aggregator.
+ZONAL_FETCH_SIZE = 256
+
+
+def format_value_count(results, pixel_size_m2):
+    """
+    Transform the pixel counts of a value count into hectares, with string
+    keys.
+    """
+    scaling_factor = 1
+    if len(results):
+        scaling_factor = pixel_size_m2 / 10000
+    return {
+        str(int(k) if type(k) == numpy.float64 and int(k) == k else k):
+        v * scaling_factor for k, v in results.items()
+    }
+
 
 class AggregatorProjection(Aggregator):
 
@@ -57,12 +74,17 @@ class AggregatorProjection(Aggregator):
         if not self.tilerange:
             return
         algebra_parser = RasterAlgebraParser()
+        layer_items = list(self.layer_dict.items())
+        tileys = range(self.tilerange[1], self.tilerange[3] + 1)
         for tilex in range(self.tilerange[0], self.tilerange[2] + 1):
-            for tiley in range(self.tilerange[1], self.tilerange[3] + 1):
+            # Fetch the tiles of all layers for this column at once.
+            column = get_raster_tiles([
+                (layerid, self.zoom, tilex, tiley) for tiley in tileys for name, layerid in layer_items
+            ])
+            for index, tiley in enumerate(tileys):
                 # Prepare a data dictionary with named tiles for algebra evaluation
                 data = {}
-                for name, layerid in self.layer_dict.items():
-                    tile = self.get_raster_tile(layerid, self.zoom, tilex, tiley)
+                for (name, layerid), tile in zip(layer_items, column[index * len(layer_items):(index + 1) * len(layer_items)]):
                     if tile:
                         data[name] = tile
                     else:
@@ -78,19 +100,12 @@ class AggregatorProjection(Aggregator):
                 # Convert to uint8 if discrete.
                 yield tilex, tiley, result
 
-    def value_count(self):
-        # Instantiate counter dict for value counts.
-        results = Counter({})
-        self._clear_stats()
-
-        # Set the destination crs to the one from the input geometry.
-        dst_crs = CRS.from_epsg(self.geom.srid)
-
-        # Perform a sanity check on target crs.
-        if dst_crs.linear_units.lower() not in ALLOWED_LINEAR_UNITS:
-            raise RasterAggregationException('Units of dst crs need to be in meters, found {}.'.format(dst_crs.linear_units))
-
-        # Combine all tiles into one big array.
+    def column_mosaics(self):
+        """
+        Generator that yields the creation args, the stacked data and the
+        validity mask of each tile column in the aggregator's tile range.
+        Columns with missing tiles are skipped, so the mask is always None.
+        """
         col_length = self.tilerange[3] - self.tilerange[1] + 1
         col = []
         origins = []
@@ -118,73 +133,182 @@ class AggregatorProjection(Aggregator):
                     'crs': 'EPSG:{}'.format(rst.srid),
                     'transform': transform,
                 }
-                # Warp raster data and clip to geometry.
-                self.pixel_size_m2, result_data = warp_and_clip(creation_args, col, self.geom)
-
-                # For the resulting array, compute the statistics.
-                if self.grouping == 'discrete':
-                    # Compute unique counts for discrete input data
-                    unique_counts = numpy.unique(result_data, return_counts=True)
-                    # Add counts to results
-                    values = dict(zip(unique_counts[0], unique_counts[1]))
-
-                elif self.grouping == 'continuous':
-                    if self.memory_efficient and not self.hist_range:
-                        raise RasterAggregationException(
-                            'Secify a histogram range for memory efficient continuous aggregation.'
-                        )
-
-                    # Handle continuous case - compute histogram on masked data
-                    counts, bins = numpy.histogram(result_data, range=self.hist_range)
-
-                    # Create dictionary with bins as keys and histogram counts as values
-                    values = {}
-                    for i in range(len(bins) - 1):
-                        values[(bins[i], bins[i + 1])] = counts[i]
-
-                else:
-                    # If input is not a legend, interpret input as legend json data
-                    if not isinstance(self.grouping, Legend):
-                        self.grouping = Legend(json=self.grouping)
-
-                    # Try getting a colormap from the input
-                    try:
-                        colormap = self.grouping.colormap
-                    except Exception as e:
-                        sentry_sdk.capture_exception(e)
-                        raise RasterAggregationException(
-                            'Invalid grouping value found for valuecount.'
-                        )
-
-                    # Use colormap to compute value counts
-                    formula_parser = FormulaParser()
-                    values = {}
-                    for key, color in colormap.items():
-                        try:
-                            # Try to use the key as number directly
-                            selector = result_data == float(key)
-                        except ValueError:
-                            # Otherwise use it as numpy expression directly
-                            selector = formula_parser.evaluate({'x': result_data}, key)
-                        values[key] = numpy.sum(selector)
-
-                # Add counts to results.
-                results.update(Counter(values))
-                # Push statistics.
-                self._push_stats(result_data)
+                yield creation_args, col, None
                 # Reset the col and origins.
                 col = []
                 origins = []
 
-        # Transform pixel count to hectares.
-        scaling_factor = 1
-        if len(results):
-            scaling_factor = self.pixel_size_m2 / 10000
-        results = {
-            str(int(k) if type(k) == numpy.float64 and int(k) == k else k):
-            v * scaling_factor for k, v in results.items()
-        }
-        return results
+    def area_mosaic(self):
+        """
+        Generator that yields the creation args, data and validity mask of a
+        single mosaic of all tiles in the aggregator's tile range. The mosaic is
+        preallocated and missing tiles are filled with nodata. Without nodata
+        value, the validity mask marks the pixels of the available tiles, it is
+        None otherwise.
+        """
+        data = None
+        valid = None
+        for tilex, tiley, rst in self.tiles():
+            band = rst.bands[0]
+            tile_data = band.data()
+            if data is None:
+                # Create the mosaic from the first tile.
+                nodata = band.nodata_value
+                data = numpy.full(
+                    (
+                        (self.tilerange[3] - self.tilerange[1] + 1) * WEB_MERCATOR_TILESIZE,
+                        (self.tilerange[2] - self.tilerange[0] + 1) * WEB_MERCATOR_TILESIZE,
+                    ),
+                    0 if nodata is None else nodata,
+                    dtype=tile_data.dtype,
+                )
+                bounds = tile_bounds(self.tilerange[0], self.tilerange[1], self.zoom)
+                creation_args = {
+                    'driver': 'GTiff',
+                    'dtype': band.datatype(as_string=True).split('GDT_')[1].lower(),
+                    'nodata': nodata,
+                    'width': data.shape[1],
+                    'height': data.shape[0],
+                    'count': 1,
+                    'crs': 'EPSG:{}'.format(rst.srid),
+                    'transform': Affine(rst.scale.x, rst.skew.x, bounds[0], rst.skew.y, rst.scale.y, bounds[3]),
+                }
+                # Missing tiles can not be told apart by their value.
+                if nodata is None:
+                    valid = numpy.zeros(data.shape, dtype='bool')
+            row = (tiley - self.tilerange[1]) * WEB_MERCATOR_TILESIZE
+            col = (tilex - self.tilerange[0]) * WEB_MERCATOR_TILESIZE
+            data[row:row + WEB_MERCATOR_TILESIZE, col:col + WEB_MERCATOR_TILESIZE] = tile_data
+            if valid is not None:
+                valid[row:row + WEB_MERCATOR_TILESIZE, col:col + WEB_MERCATOR_TILESIZE] = True
+
+        if data is not None:
+            if valid is not None and valid.all():
+                valid = None
+            yield creation_args, data, valid
+
+    def value_count(self):
+        # Instantiate counter dict for value counts.
+        results = Counter({})
+        self._clear_stats()
+
+        # Set the destination crs to the one from the input geometry.
+        dst_crs = CRS.from_epsg(self.geom.srid)
+
+        # Perform a sanity check on target crs.
+        if dst_crs.linear_units.lower() not in ALLOWED_LINEAR_UNITS:
+            raise RasterAggregationException('Units of dst crs need to be in meters, found {}.'.format(dst_crs.linear_units))
+
+        # Combine the tiles into one mosaic for the area, and fall back to one
+        # mosaic per tile column for large areas to limit memory usage.
+        if not self.tilerange:
+            mosaics = []
+        elif (self.tilerange[2] - self.tilerange[0] + 1) * (self.tilerange[3] - self.tilerange[1] + 1) <= REPORT_MOSAIC_MAX_TILES:
+            mosaics = self.area_mosaic()
+        else:
+            mosaics = self.column_mosaics()
+
+        for creation_args, data, valid in mosaics:
+            if self.geom.srid == WEB_MERCATOR_SRID:
+                # The tiles are in the target projection, clip them directly.
+                transform = creation_args['transform']
+                self.pixel_size_m2 = abs(transform[0] * transform[4])
+                result_data = clip(data, transform, creation_args['nodata'], self.geom, valid)
+            else:
+                # Warp raster data and clip to geometry.
+                self.pixel_size_m2, result_data = warp_and_clip(creation_args, data, self.geom, valid)
+            # Add counts to results.
+            results.update(Counter(self._count_values(result_data)))
+            # Push statistics.
+            self._push_stats(result_data)
+
+        return format_value_count(results, getattr(self, 'pixel_size_m2', None))
+
+    def _count_values(self, result_data):
+        # For the resulting array, compute the statistics.
+        if self.grouping == 'discrete':
+            # Compute unique counts for discrete input data
+            unique_counts = numpy.unique(result_data, return_counts=True)
+            # Add counts to results
+            return dict(zip(unique_counts[0], unique_counts[1]))
+
+        elif self.grouping == 'continuous':
+            if self.memory_efficient and not self.hist_range:
+                raise RasterAggregationException(
+                    'Secify a histogram range for memory efficient continuous aggregation.'
+                )
+
+            # Handle continuous case - compute histogram on masked data
+            counts, bins = numpy.histogram(result_data, range=self.hist_range)
+
+            # Create dictionary with bins as keys and histogram counts as values
+            values = {}
+            for i in range(len(bins) - 1):
+                values[(bins[i], bins[i + 1])] = counts[i]
+            return values
+
+        keys, numeric_keys, numeric_values, expressions = self._legend_lookup()
+        values = {}
+
+        # Count the pixels of all numeric keys from the unique values of the
+        # data, by looking up the keys in the sorted unique values.
+        if numeric_keys:
+            uniques, counts = numpy.unique(result_data, return_counts=True)
+            # Compare floating point data in its own precision, like the
+            # comparison of an array with a python float.
+            if numpy.issubdtype(uniques.dtype, numpy.floating):
+                numeric_values = numeric_values.astype(uniques.dtype)
+            if uniques.size:
+                index = numpy.minimum(numpy.searchsorted(uniques, numeric_values), uniques.size - 1)
+                key_counts = numpy.where(uniques[index] == numeric_values, counts[index], 0)
+            else:
+                key_counts = numpy.zeros(len(numeric_keys), dtype='int64')
+            values.update(zip(numeric_keys, key_counts))
+
+        # Evaluate the other keys as numpy expressions.
+        if expressions:
+            formula_parser = FormulaParser()
+            for key in expressions:
+                values[key] = numpy.count_nonzero(formula_parser.evaluate({'x': result_data}, key))
+
+        # Keep the order of the legend.
+        return {key: values[key] for key in keys}
+
+    def _legend_lookup(self):
+        """
+        Split the legend grouping into numeric keys and expression keys. The
+        lookup is compiled once per aggregator and reused for every mosaic.
+        """
+        if getattr(self, '_legend', None) is not None:
+            return self._legend
+
+        # If input is not a legend, interpret input as legend json data
+        if not isinstance(self.grouping, Legend):
+            self.grouping = Legend(json=self.grouping)
+
+        # Try getting a colormap from the input
+        try:
+            colormap = self.grouping.colormap
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            raise RasterAggregationException(
+                'Invalid grouping value found for valuecount.'
+            )
+
+        numeric_keys = []
+        numeric_values = []
+        expressions = []
+        for key in colormap:
+            try:
+                # Try to use the key as number directly
+                numeric_values.append(float(key))
+                numeric_keys.append(key)
+            except ValueError:
+                # Otherwise use it as numpy expression directly
+                expressions.append(key)
+
+        self._legend = (list(colormap), numeric_keys, numpy.array(numeric_values), expressions)
+        return self._legend
 
     def _push_stats(self, data):
         # Stop if entire data was masked
@@ -236,12 +360,247 @@ class AggregatorProjection(Aggregator):
         return (self._stats_min_value, self._stats_max_value, mean, std)
 
 
-def populate_vc(vc, srid):
+class ZonalStatistics(object):
+    """
+    Value counts and statistics of the aggregation areas for one formula,
+    accumulated by area with bincounts.
+    """
+
+    def __init__(self, layer_dict, formula, size, pixel_size_m2, grouping='discrete', hist_range=None):
+        if grouping not in ('discrete', 'continuous'):
+            raise RasterAggregationException('Zonal aggregation requires discrete or continuous grouping.')
+        if grouping == 'continuous' and not hist_range:
+            raise RasterAggregationException('Specify a histogram range for zonal continuous aggregation.')
+        self.layer_dict = layer_dict
+        self.formula = formula
+        self.pixel_size_m2 = pixel_size_m2
+        self.grouping = grouping
+        self.hist_range = hist_range
+
+        # Accumulators by area.
+        self._covered = numpy.zeros(size, dtype='bool')
+        self._counts = [Counter() for index in range(size)]
+        # The histogram bins are created from the first data, their type
+        # depends on the data type like in numpy.histogram.
+        self._bins = None
+        self._histograms = None
+        self._stats_t0 = numpy.zeros(size, dtype='int64')
+        self._stats_t1 = numpy.zeros(size)
+        self._stats_t2 = numpy.zeros(size)
+        self._stats_min_value = numpy.full(size, numpy.inf)
+        self._stats_max_value = numpy.full(size, -numpy.inf)
+
+    def push(self, areas, labels, pixels, band):
+        """
+        Add the algebra result band of one tile. The labels are the area
+        indices of the flat pixel indices.
+        """
+        self._covered[areas] = True
+        values = band.data().ravel()[pixels]
+        # Remove nodata values.
+        if band.nodata_value is not None:
+            valid = values != band.nodata_value
+            labels = labels[valid]
+            values = values[valid]
+        if not values.size:
+            return
+        self._push_counts(labels, values)
+        self._push_stats(labels, values)
+
+    def _push_counts(self, labels, values):
+        if self.grouping == 'discrete':
+            # Sort by label and value, and count the pixels of each group.
+            order = numpy.lexsort((values, labels))
+            labels = labels[order]
+            values = values[order]
+            starts = numpy.flatnonzero(numpy.concatenate([[True], (labels[1:] != labels[:-1]) | (values[1:] != values[:-1])]))
+            counts = numpy.diff(numpy.append(starts, len(values)))
+            for label, value, count in zip(labels[starts], values[starts], counts):
+                self._counts[label][value] += count
+        else:
+            if self._bins is None:
+                self._bins = numpy.histogram_bin_edges(values[:0], range=self.hist_range)
+                self._histograms = numpy.zeros((len(self._stats_t0), len(self._bins) - 1), dtype='int64')
+            # Compute the bins like numpy.histogram, where the last bin
+            # includes the upper edge.
+            inside = (values >= self._bins[0]) & (values <= self._bins[-1])
+            nbins = len(self._bins) - 1
+            bins = numpy.minimum(numpy.searchsorted(self._bins, values[inside], side='right') - 1, nbins - 1)
+            self._histograms += numpy.bincount(
+                labels[inside] * nbins + bins,
+                minlength=self._histograms.size,
+            ).reshape(self._histograms.shape)
+
+    def _push_stats(self, labels, values):
+        # Filter data by histogram range.
+        if self.hist_range:
+            inside = (values >= self.hist_range[0]) & (values <= self.hist_range[1])
+            labels = labels[inside]
+            values = values[inside]
+
+        values = values.astype('float64')
+        self._stats_t0 += numpy.bincount(labels, minlength=len(self._stats_t0))
+        self._stats_t1 += numpy.bincount(labels, weights=values, minlength=len(self._stats_t1))
+        self._stats_t2 += numpy.bincount(labels, weights=numpy.square(values), minlength=len(self._stats_t2))
+        numpy.minimum.at(self._stats_min_value, labels, values)
+        numpy.maximum.at(self._stats_max_value, labels, values)
+
+    def value_count(self, index):
+        """
+        Return the value count of one area, in the format of the
+        AggregatorProjection value counts.
+        """
+        if self.grouping == 'discrete':
+            results = self._counts[index]
+        elif self._covered[index] and self._bins is not None:
+            results = {(self._bins[i], self._bins[i + 1]): self._histograms[index, i] for i in range(len(self._bins) - 1)}
+        else:
+            results = {}
+        return format_value_count(results, self.pixel_size_m2)
+
+    def statistics(self, index):
+        """
+        Compute statistics for one area. Returns (min, max, mean, std).
+        """
+        t0 = self._stats_t0[index]
+        if t0 == 0:
+            return (None, None, None, None)
+        t1 = self._stats_t1[index]
+        t2 = self._stats_t2[index]
+        mean = t1 / t0
+        std = numpy.sqrt(t0 * t2 - t1 * t1) / t0
+        return (self._stats_min_value[index], self._stats_max_value[index], mean, std)
+
+    def cumsums(self, index):
+        return self._stats_t0[index], self._stats_t1[index], self._stats_t2[index]
+
+
+class ZonalAggregator(object):
+    """
+    Compute value counts and statistics for many aggregation areas and
+    formulas in one pass over the tiles.
+
+    The layer tiles touched by the areas are fetched once and shared by all
+    formulas. All areas over a tile are burned into labels once, and the
+    results of each formula are accumulated by label. The tiles are used in
+    the web mercator projection without warping, so the results correspond to
+    the AggregatorProjection in that projection.
+    """
+
+    def __init__(self, geoms, zoom=REPORT_ZOOM):
+        self.zoom = zoom
+        self.size = len(geoms)
+        self.rasterizer = TileRasterizer([geom.transform(WEB_MERCATOR_SRID, clone=True) for geom in geoms], zoom, False)
+        self.pixel_size_m2 = tile_scale(zoom) ** 2
+        self.targets = []
+
+    def add(self, layer_dict, formula, grouping='discrete', hist_range=None):
+        """
+        Add a formula to aggregate, returns its zonal statistics.
+        """
+        target = ZonalStatistics(layer_dict, formula, self.size, self.pixel_size_m2, grouping, hist_range)
+        self.targets.append(target)
+        return target
+
+    def tiles(self):
+        """
+        Generator that yields a dictionary with the tiles of all layers by
+        layer id, for each tile touched by the areas. Missing tiles are None.
+        """
+        layer_ids = sorted({layerid for target in self.targets for layerid in target.layer_dict.values()})
+        if not layer_ids:
+            return
+        indices = self.rasterizer.tiles()
+        batch_size = max(1, ZONAL_FETCH_SIZE // len(layer_ids))
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            tiles = get_raster_tiles([
+                (layerid, self.zoom, tilex, tiley) for tilex, tiley in batch for layerid in layer_ids
+            ])
+            for index, (tilex, tiley) in enumerate(batch):
+                yield tilex, tiley, dict(zip(layer_ids, tiles[index * len(layer_ids):(index + 1) * len(layer_ids)]))
+
+    def aggregate(self):
+        algebra_parser = RasterAlgebraParser()
+        for tilex, tiley, tiles in self.tiles():
+            burned = None
+            for target in self.targets:
+                # Ignore this tile if it is missing in any of the input layers.
+                data = {name: tiles[layerid] for name, layerid in target.layer_dict.items()}
+                if not all(data.values()):
+                    continue
+                # Burn the areas once for all formulas.
+                if burned is None:
+                    pixels = self.rasterizer.burn(tilex, tiley)
+                    if not pixels:
+                        break
+                    burned = (
+                        list(pixels),
+                        numpy.concatenate([numpy.full(len(pix), index) for index, pix in pixels.items()]),
+                        numpy.concatenate(list(pixels.values())),
+                    )
+                result = algebra_parser.evaluate_raster_algebra(data, target.formula)
+                target.push(*burned, result.bands[0])
+
+
+def zonal_aggregation_supported(vc, srid):
+    """
+    Check if a valuecount configuration can be computed with the zonal
+    aggregator. Other configurations require warping or data dependent bins.
+    """
+    if srid != WEB_MERCATOR_SRID:
+        return False
+    if vc.grouping == 'discrete':
+        return True
+    return vc.grouping == 'continuous' and get_hist_range(vc) is not None
+
+
+def get_hist_range(vc):
     # Compute range for valuecounts if provided.
     if vc.range_min is not None and vc.range_max is not None:
-        hist_range = (vc.range_min, vc.range_max)
-    else:
-        hist_range = None
+        return (vc.range_min, vc.range_max)
+
+
+def aggregate_zonal(vcs, geoms):
+    """
+    Compute the zonal statistics of the geometries for multiple valuecount
+    configurations in one pass over the tiles. Returns the zonal statistics of
+    each configuration, or a list of None if the aggregation failed.
+    """
+    try:
+        agg = ZonalAggregator(geoms, zoom=vcs[0].zoom)
+        for vc in vcs:
+            agg.add(vc.layer_names, vc.formula, vc.grouping, get_hist_range(vc))
+        agg.aggregate()
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return [None] * len(vcs)
+    return agg.targets
+
+
+def populate_vc_zonal(vc, stats, index, save=True):
+    """
+    Populate a valuecount from the zonal statistics of its area.
+    """
+    if stats is None:
+        vc.status = vc.FAILED
+        if save:
+            vc.save()
+        return vc
+
+    vc.stats_min, vc.stats_max, vc.stats_avg, vc.stats_std = stats.statistics(index)
+    vc.stats_cumsum_t0, vc.stats_cumsum_t1, vc.stats_cumsum_t2 = stats.cumsums(index)
+    vc.pixel_size_m2 = stats.pixel_size_m2
+    vc.value = {k: str(round(v, VALUECOUNT_ROUNDING_DIGITS)) for k, v in stats.value_count(index).items()}
+    vc.status = vc.FINISHED
+    if save:
+        vc.save()
+
+    return vc
+
+
+def populate_vc(vc, srid, save=True):
+    hist_range = get_hist_range(vc)
 
     try:
         # Compute aggregate result.
@@ -275,7 +634,8 @@ def populate_vc(vc, srid):
         sentry_sdk.capture_exception(e)
         vc.status = vc.FAILED
 
-    vc.save()
+    if save:
+        vc.save()
 
     return vc
 
@@ -319,9 +679,10 @@ def gdalraster_to_rasterio(rst):
     return creation_args, band.data()
 
 
-def warp_and_clip(creation_args, data, geom):
+def warp_and_clip(creation_args, data, geom, valid=None):
     """
     Warp a data matrix into new creation args, and clip against the geometry.
+    The optional validity mask is warped along with the data.
     """
     # Set the destination crs to the one from the input geometry.
     dst_crs = CRS.from_epsg(geom.srid)
@@ -358,23 +719,48 @@ def warp_and_clip(creation_args, data, geom):
                         dst_crs=dst_crs,
                         resampling=Resampling.nearest,
                     )
+                    # Warp the validity mask on the same grid.
+                    if valid is not None:
+                        dst_valid = numpy.zeros((height, width), dtype='uint8')
+                        reproject(
+                            source=valid.astype('uint8'),
+                            destination=dst_valid,
+                            src_transform=src.transform,
+                            src_crs=src.crs,
+                            dst_transform=dst_transform,
+                            dst_crs=dst_crs,
+                            resampling=Resampling.nearest,
+                        )
+                        valid = dst_valid == 1
                     # Compute size in m2 of the pixels in the image.
                     pixel_size_m2 = abs(dst.transform[0] * dst.transform[4])
-                    # Rasterize the geometry and use the mask on all bands.
-                    geom_rasterized = rasterize(
-                        [json.loads(geom.geojson)],
-                        out_shape=(dst.height, dst.width),
-                        fill=dst.nodata,
-                        transform=dst.transform,
-                        all_touched=False,
-                        default_value=1,
-                        dtype='uint8',
-                    )
-                    # Convert the rasterized geometry into a boolean array.
-                    geom_rasterized = geom_rasterized == 1
-                    # Mask the destination raster using the rasterized geometry.
-                    masked = dst.read(1)[geom_rasterized].ravel()
-                    # Remove nodata values.
-                    masked = masked[masked != dst.nodata]
                     # Return result.
-                    return pixel_size_m2, masked
+                    return pixel_size_m2, clip(dst.read(1), dst.transform, dst.nodata, geom, valid)
+
+
+def clip(data, transform, nodata, geom, valid=None):
+    """
+    Clip a data matrix against the geometry, and remove nodata values and the
+    pixels outside of the optional validity mask. The geometry is expected in
+    the coordinate system of the transform.
+    """
+    # Rasterize the geometry.
+    geom_rasterized = rasterize(
+        [json.loads(geom.geojson)],
+        out_shape=data.shape,
+        fill=0,
+        transform=transform,
+        all_touched=False,
+        default_value=1,
+        dtype='uint8',
+    )
+    # Convert the rasterized geometry into a boolean array.
+    geom_rasterized = geom_rasterized == 1
+    if valid is not None:
+        geom_rasterized &= valid
+    # Mask the data using the rasterized geometry.
+    masked = data[geom_rasterized].ravel()
+    # Remove nodata values.
+    if nodata is not None:
+        masked = masked[masked != nodata]
+    return masked
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.db import transaction
+from raster_aggregation.models import ValueCountResult
+
+from report.models import ReportAggregation, auto_set_valuecountresult_min_max_dates
+
+# Valuecount fields that are the same for all areas of a report task.
+VALUECOUNT_CONFIG_FIELDS = ('layer_names', 'formula', 'range_min', 'range_max', 'zoom', 'units', 'grouping')
+
+# Report aggregation fields that are updated when storing new results.
+REPORT_AGGREGATION_UPDATE_FIELDS = (
+    'valuecountresult', 'min_date', 'max_date', 'value', 'value_percentage', 'stats_min', 'stats_max', 'stats_avg',
+    'stats_std', 'stats_cumsum_t0', 'stats_cumsum_t1', 'stats_cumsum_t2', 'stats_percentage_covered', 'srid',
+)
+
+
+class ReportAggregationWriter(object):
+    """
+    Buffer the report aggregations of one report task and store them with
+    their valuecounts using bulk queries, in one transaction per batch.
+
+    The existing aggregations are loaded in one query, and the valuecount
+    configuration and the date range are computed once for all areas. Old
+    valuecounts are deleted after the aggregations point to the new ones.
+    """
+
+    def __init__(self, lookup, batch_size=None):
+        self.lookup = lookup
+        self.batch_size = batch_size or settings.REPORT_WRITE_BATCH_SIZE
+        self.existing = {rep.aggregationarea_id: rep for rep in ReportAggregation.objects.filter(**lookup)}
+        self.config = None
+        self.min_date = None
+        self.max_date = None
+        # Ids of the valuecounts replaced by new ones, by area.
+        self.replaced = {}
+        self.buffer = []
+
+    def get(self, area):
+        """
+        Return the report aggregation of an area, and a new unsaved valuecount
+        configured using the report agg settings.
+        """
+        rep = self.existing.get(area.id)
+        if rep is None:
+            rep = ReportAggregation(aggregationarea=area, **self.lookup)
+        elif rep.valuecountresult_id:
+            self.replaced[area.id] = rep.valuecountresult_id
+        if self.config is None:
+            vc = rep.get_valuecount(delete_existing=False)
+            self.config = {field: getattr(vc, field) for field in VALUECOUNT_CONFIG_FIELDS}
+            # The bulk queries do not send the pre save signal, compute the
+            # date range once instead.
+            auto_set_valuecountresult_min_max_dates(ReportAggregation, rep)
+            self.min_date = rep.min_date
+            self.max_date = rep.max_date
+        return rep, ValueCountResult(aggregationarea=area, **self.config)
+
+    def add(self, rep, vc):
+        self.buffer.append((rep, vc))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with transaction.atomic():
+            old_vc_ids = [self.replaced.pop(rep.aggregationarea_id) for rep, vc in self.buffer if rep.aggregationarea_id in self.replaced]
+            ValueCountResult.objects.bulk_create([vc for rep, vc in self.buffer])
+            for rep, vc in self.buffer:
+                rep.valuecountresult = vc
+                rep.min_date = self.min_date
+                rep.max_date = self.max_date
+            ReportAggregation.objects.bulk_update(
+                [rep for rep, vc in self.buffer if rep.pk],
+                REPORT_AGGREGATION_UPDATE_FIELDS,
+            )
+            ReportAggregation.objects.bulk_create([rep for rep, vc in self.buffer if not rep.pk])
+            # Remove the replaced valuecounts, no aggregation points to them
+            # anymore.
+            ValueCountResult.objects.filter(id__in=old_vc_ids).delete()
+        self.buffer = []
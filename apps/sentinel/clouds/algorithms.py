@@ -1,7 +1,7 @@
 import numpy
 
 from sentinel import const
-from sentinel.clouds.utils import nodata_mask, scale_array
+from sentinel.clouds.utils import BandStack, minmax_scale, nodata_mask, scale_array, spatial_filter_size
 
 
 class Clouds(object):
@@ -34,6 +34,12 @@ class Clouds(object):
             self.cloud_version = ctile.cloud_version
 
     def clouds(self, stack):
+        """
+        Compute the cloud probabilities for a scene band stack. The stack is
+        either a dictionary with the band arrays of one scene, or a BandStack
+        over the stack array of multiple scenes. In the latter case the cloud
+        probabilities of all scenes are computed at once.
+        """
         if self.classifier:
             # Convert stack data into input for classifier.
             bands = ['{}.jp2'.format(bnd) for bnd in self.classifier.band_names.split(',')]
@@ -46,6 +52,35 @@ class Clouds(object):
         else:
             return getattr(self, 'clouds_v{}'.format(self.cloud_version))(stack)
 
+    def composite(self, stacks):
+        """
+        Merge the band stacks of the scenes available for a tile into composite
+        band arrays, selecting the pixels with the lowest cloud probability.
+        The stacks are given as one array with the shape (scenes, bands, rows,
+        cols) and the bands ordered as in const.ALL_BANDS. Returns a dictionary
+        with the composite pixels for each band.
+        """
+        # Compute the cloud probabilities for all scenes at once.
+        cloud_probs = self.clouds(BandStack(stacks))
+
+        # Compute an array of scene indices with the lowest cloud probability.
+        selector_index = numpy.argmin(cloud_probs, axis=0)
+
+        # Compute mask for pixels where all stacks are over the exclude value.
+        exclude = numpy.min(cloud_probs, axis=0) >= const.EXCLUDE_VALUE
+
+        # Construct composite arrays of all bands from the selector index.
+        composite_data = numpy.take_along_axis(stacks, selector_index[numpy.newaxis, numpy.newaxis], axis=0)[0]
+
+        # Exclude bad pixels.
+        composite_data[:, exclude] = const.SENTINEL_NODATA_VALUE
+
+        # Ensure datatype.
+        return {
+            key: composite_data[index].astype('uint8' if key == const.SCL else 'uint16')
+            for index, key in enumerate(const.ALL_BANDS)
+        }
+
     def clouds_v7(self, stack):
         """
         Scene class pixels ranked by preference. The rank is flattened out so
@@ -68,7 +103,7 @@ class Clouds(object):
         )
 
         # Use SCL layer to select pixel ranks.
-        cloud_probs = numpy.choose(stack[const.SCL], SCENE_CLASS_RANK_FLAT)
+        cloud_probs = numpy.array(SCENE_CLASS_RANK_FLAT)[stack[const.SCL]]
 
         # Ensure nodata pixels have the exclude value.
         cloud_probs[nodata_mask(stack)] = const.EXCLUDE_VALUE
@@ -115,7 +150,7 @@ class Clouds(object):
         )
 
         # Use SCL layer to select pixel ranks.
-        cloud_probs = numpy.choose(stack[const.SCL], SCENE_CLASS_RANK)
+        cloud_probs = numpy.array(SCENE_CLASS_RANK)[stack[const.SCL]]
 
         # Ensure nodata pixels have the exclude value.
         cloud_probs[nodata_mask(stack)] = const.EXCLUDE_VALUE
@@ -139,7 +174,7 @@ class Clouds(object):
 
         return cloud_probs
 
-    def clouds_v5(stack=None):
+    def clouds_v5(self, stack):
         """
         Scene class pixels are divided into three categories. In high and low
         priority, and into a category that is always excluded. Within each
@@ -157,7 +192,7 @@ class Clouds(object):
         cloud_probs = keep + depreoritize + exclude
 
         # Add a maximum filter, to buffer cloudy pixels along the edge by 100m.
-        cloud_probs = maximum_filter(cloud_probs, (10, 10))
+        cloud_probs = maximum_filter(cloud_probs, spatial_filter_size(cloud_probs, (10, 10)))
 
         # Ensure nodata pixels have the exclude value.
         cloud_probs[nodata_mask(stack)] = const.EXCLUDE_VALUE
@@ -200,7 +235,7 @@ class Clouds(object):
         SHADOW_LOW = 800  # Certainly shadow.
         SHADOW_HIGH = 2000  # Certainly not shadow.
         shadow = 1 - scale_array(
-            minimum_filter(stack[const.BD11], size=FILTER_SIZE_20),
+            minimum_filter(stack[const.BD11], size=spatial_filter_size(stack[const.BD11], FILTER_SIZE_20)),
             SHADOW_LOW,
             SHADOW_HIGH
         )
@@ -209,7 +244,7 @@ class Clouds(object):
         THICK_CLOUD_LOW = 1600  # Certainly not cloud.
         THICK_CLOUD_HIGH = 3000  # Certainly cloud.
         thick_cloud = scale_array(
-            maximum_filter(stack[const.BD1], FILTER_SIZE_60),
+            maximum_filter(stack[const.BD1], spatial_filter_size(stack[const.BD1], FILTER_SIZE_60)),
             THICK_CLOUD_LOW,
             THICK_CLOUD_HIGH,
         )
@@ -218,7 +253,7 @@ class Clouds(object):
         CIRRUS_LOW = 20  # Certainly not cirrus.
         CIRRUS_HIGH = 100  # Certainly cirrus.
         cirrus_cloud = scale_array(
-            maximum_filter(stack[const.BD10], FILTER_SIZE_60),
+            maximum_filter(stack[const.BD10], spatial_filter_size(stack[const.BD10], FILTER_SIZE_60)),
             CIRRUS_LOW,
             CIRRUS_HIGH,
         )
@@ -241,8 +276,6 @@ class Clouds(object):
         An index is constructed from the cirrus band and one atmospheric
         sensitive infrared band. With a cutoff on band 11.
         """
-        from sklearn.preprocessing import minmax_scale
-
         # Select minimum sum of thick cloud and cirrus cloud bands.
         index = minmax_scale(stack[const.BD1]) + minmax_scale(stack[const.BD10])
         index[(stack[const.BD11] < 900)] = 3
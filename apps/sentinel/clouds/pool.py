@@ -0,0 +1,108 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy
+
+# Cloud algorithm of the worker processes, inherited from the parent process.
+_clouds = None
+
+
+def stacks_to_shared_memory(stacks):
+    """
+    Copy the scene stack array of a tile into a shared memory block. Returns
+    the shared memory block, shape and dtype.
+    """
+    shm = SharedMemory(create=True, size=stacks.nbytes)
+    numpy.ndarray(stacks.shape, dtype=stacks.dtype, buffer=shm.buf)[:] = stacks
+    return shm, stacks.shape, stacks.dtype
+
+
+def _composite_buffer(buffer, shape, dtype):
+    return _clouds.composite(numpy.ndarray(shape, dtype=dtype, buffer=buffer))
+
+
+def _composite_shared_memory(name, shape, dtype):
+    """
+    Compute the composite pixels of a tile from the stacks in a shared memory
+    block. Runs in the worker processes.
+    """
+    shm = SharedMemory(name=name)
+    # The views on the shared memory are released when the helper returns, so
+    # the block can be closed afterwards.
+    result = _composite_buffer(shm.buf, shape, dtype)
+    shm.close()
+    return result
+
+
+class CloudSelectionPool(object):
+    """
+    Process pool to compute the composite pixels of multiple tiles in parallel.
+
+    The worker processes are forked, so they inherit the cloud algorithm. The
+    algorithm must not require database access, so a cloud classifier is loaded
+    before the workers are started. The stacks are handed to the workers
+    through shared memory, the composite results are returned to the parent.
+    """
+
+    def __init__(self, clouds, workers):
+        self.clouds = clouds
+        self.workers = workers
+        # Limit the number of tiles held in shared memory at once.
+        self.max_pending = 2 * workers
+        self.executor = None
+
+    def __enter__(self):
+        global _clouds
+        # Load the classifier in the parent process.
+        if self.clouds.classifier:
+            self.clouds.classifier.clf
+        _clouds = self.clouds
+        # Share the resource tracker of the parent with the workers, otherwise
+        # each worker tracks the shared memory blocks it attaches to.
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+        # The worker processes are started on the first submission. Start them
+        # right away, before any tile fetching threads are running.
+        self.executor.submit(int).result()
+        return self
+
+    def __exit__(self, *args):
+        global _clouds
+        self.executor.shutdown()
+        _clouds = None
+
+    def imap(self, tiles):
+        """
+        Compute the composite pixels for an iterable of (tilex, tiley, stacks)
+        tuples. Yields (tilex, tiley, result) tuples in order of completion.
+        """
+        pending = {}
+        try:
+            for tilex, tiley, stacks in tiles:
+                shm, shape, dtype = stacks_to_shared_memory(stacks)
+                future = self.executor.submit(_composite_shared_memory, shm.name, shape, dtype)
+                pending[future] = (tilex, tiley, shm)
+                if len(pending) >= self.max_pending:
+                    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._finish(pending, future)
+            while pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self._finish(pending, future)
+        finally:
+            # Release the shared memory of unfinished tiles.
+            for future, (tilex, tiley, shm) in pending.items():
+                future.cancel()
+                shm.close()
+                shm.unlink()
+
+    def _finish(self, pending, future):
+        tilex, tiley, shm = pending.pop(future)
+        try:
+            return tilex, tiley, future.result()
+        finally:
+            shm.close()
+            shm.unlink()
@@ -32,18 +32,67 @@ def sun(time, lat, lon):
     return float(sun.alt), float(sun.az)
 
 
+class BandStack(object):
+    """
+    Band lookup on a scene stack array with the shape (scenes, bands, rows,
+    cols) and the bands ordered as in const.ALL_BANDS. Indexing by band name
+    returns a (scenes, rows, cols) view, so that the cloud algorithms evaluate
+    all scenes of a tile at once.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, key):
+        return self.array[:, const.ALL_BANDS_INDEX[key]]
+
+
+def stack_array(stacks):
+    """
+    Combine a list of scene stack dictionaries into one scene stack array.
+    """
+    dtype = numpy.result_type(*{stack[key].dtype for stack in stacks for key in const.ALL_BANDS})
+    array = numpy.empty((len(stacks), len(const.ALL_BANDS)) + stacks[0][const.SCL].shape, dtype=dtype)
+    for index, stack in enumerate(stacks):
+        for key in const.ALL_BANDS:
+            array[index, const.ALL_BANDS_INDEX[key]] = stack[key]
+    return array
+
+
 def nodata_mask(stack):
     """
     Compute mask that indicates nodata pixels over all bands. This mask can be
     used to avoid selecting nodata pixels in composites.
     """
-    return numpy.any([
-        stack[const.BD2] == const.SENTINEL_NODATA_VALUE,  # 10m
-        stack[const.BD12] == const.SENTINEL_NODATA_VALUE,  # 20m
-        stack[const.BD1] == const.SENTINEL_NODATA_VALUE,  # 60m
-    ], axis=0)
+    return (
+        (stack[const.BD2] == const.SENTINEL_NODATA_VALUE)  # 10m
+        | (stack[const.BD12] == const.SENTINEL_NODATA_VALUE)  # 20m
+        | (stack[const.BD1] == const.SENTINEL_NODATA_VALUE)  # 60m
+    )
 
 
 def scale_array(arr, vmin, vmax):
     arr = numpy.clip(arr, vmin, vmax)
     return (arr - vmin) / (vmax - vmin)
+
+
+def minmax_scale(arr):
+    """
+    Scale the columns of each scene to the range [0, 1], equivalent to the
+    sklearn minmax_scale function applied to every scene separately.
+    """
+    arr = arr.astype('float64')
+    vmin = arr.min(axis=-2, keepdims=True)
+    vrange = arr.max(axis=-2, keepdims=True) - vmin
+    # Constant columns are scaled to zero.
+    vrange[vrange == 0] = 1
+    scale = 1 / vrange
+    return arr * scale + (0 - vmin * scale)
+
+
+def spatial_filter_size(arr, size):
+    """
+    Extend a 2D filter size with the leading scene axis of stack arrays, so
+    that spatial filters do not mix the values of different scenes.
+    """
+    return (1,) * (arr.ndim - len(size)) + tuple(size)
@@ -117,6 +117,8 @@ BANDS_10M = [BD2, BD3, BD4, BD8, ]
 BANDS_20M = [BD5, BD6, BD7, BD8A, BD11, BD12, ]
 BANDS_60M = [BD1, BD9, BD10, ]
 ALL_BANDS = [BD1, BD2, BD3, BD4, BD5, BD6, BD7, BD8, BD8A, BD9, BD10, BD11, BD12, SCL]
+# Position of the bands in scene stack arrays.
+ALL_BANDS_INDEX = {band: index for index, band in enumerate(ALL_BANDS)}
 
 BANDS_COUNT_BY_RES = {
     ZOOM_LEVEL_10M: len(BANDS_10M),
@@ -7,6 +7,7 @@ import pathlib
 import shutil
 import subprocess
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import numpy
@@ -28,12 +29,19 @@ from jobs import ecs
 from report.tasks import push_reports
 from sentinel import const
 from sentinel.clouds.algorithms import Clouds
+from sentinel.clouds.pool import CloudSelectionPool
 from sentinel.clouds.utils import sun
 from sentinel.models import (
     BucketParseLog, Composite, CompositeBuild, CompositeBuildSchedule, CompositeTile, MGRSTile, SentinelTile,
     SentinelTileAggregationLayer, SentinelTileBand, SentinelTileSceneClass
 )
-from sentinel.utils import aggregate_tile, disaggregate_tile, get_raster_tile, locally_parse_raster, write_raster_tile
+from sentinel.tilecache import use_tile_cache
+from sentinel.tileindex import get_tile_index, use_tile_index
+from sentinel.tilestore import get_tile_store, layer_prefix
+from sentinel.utils import (
+    AGGREGATE_MEAN, AGGREGATE_MODE, TileMosaic, TileWriter, aggregate_tile, get_raster_tile, get_raster_tiles,
+    locally_parse_raster, write_raster_tile, write_raster_tiles
+)
 from sentinel_1 import const as s1const
 from sentinel_1.models import Sentinel1Tile
 
@@ -221,39 +229,142 @@ def trigger_scene_ingestion(sender, instance, **kwargs):
 
 def get_range_tiles(sentineltiles, tilex, tiley, tilez):
     """
-    Return a RasterTile queryset of tiles for the given indices.
+    Return the tiles of all scenes for the given indices as tuples of scene,
+    band number and pixel values.
     """
-    if tilez == const.ZOOM_LEVEL_60M:
-        bnds = const.BANDS_60M
-    elif tilez == const.ZOOM_LEVEL_20M:
-        bnds = const.BANDS_20M
-    else:
-        bnds = const.BANDS_10M
-
-    # Return data as tuples of scene, band number and pixel values.
-    tiles = []
-    for sentineltile in sentineltiles:
-        for sentineltileband in sentineltile.sentineltileband_set.filter(band__in=bnds):
-            tile = get_raster_tile(sentineltileband.layer_id, tilez, tilex, tiley)
-            if not tile:
-                continue
-            tiles.append((sentineltile.prefix, sentineltileband.band, tile.bands[0].data()))
+    return get_range_tiles_batch(sentineltiles, [(tilex, tiley, tilez)])[0]
+
+
+def get_range_tiles_batch(sentineltiles, indices):
+    """
+    Fetch the tiles of all scenes for a list of (tilex, tiley, tilez) indices
+    at once. Returns the get_range_tiles result for each index.
+    """
+    # Collect tile requests for all indices, scenes and bands.
+    keys = []
+    requests = []
+    for index, (tilex, tiley, tilez) in enumerate(indices):
+        if tilez == const.ZOOM_LEVEL_60M:
+            bnds = const.BANDS_60M
+        elif tilez == const.ZOOM_LEVEL_20M:
+            bnds = const.BANDS_20M
+        else:
+            bnds = const.BANDS_10M
+
+        for sentineltile in sentineltiles:
+            for sentineltileband in sentineltile.sentineltileband_set.all():
+                if sentineltileband.band not in bnds:
+                    continue
+                keys.append((index, sentineltile.prefix, sentineltileband.band))
+                requests.append((sentineltileband.layer_id, tilez, tilex, tiley))
+
+            if tilez == const.ZOOM_LEVEL_20M and hasattr(sentineltile, 'sentineltilesceneclass'):
+                keys.append((index, sentineltile.prefix, const.SCL))
+                requests.append((sentineltile.sentineltilesceneclass.layer_id, tilez, tilex, tiley))
+
+    # Fetch all tiles at once and group the data as tuples of scene, band
+    # number and pixel values.
+    tiles = [[] for index in indices]
+    for (index, prefix, band), tile in zip(keys, get_raster_tiles(requests)):
+        if not tile:
+            continue
+        tiles[index].append((prefix, band, tile.bands[0].data()))
+
+    return tiles
+
+
+def get_compositetile_parent_tiles(sentineltiles, tilex60, tiley60, tilex20, tiley20):
+    """
+    Fetch the scene tiles for a 20m tile, its 60m parent and its 10m children.
+    Returns a dictionary with the get_range_tiles result for each index.
+    """
+    indices = [(tilex60, tiley60, const.ZOOM_LEVEL_60M), (tilex20, tiley20, const.ZOOM_LEVEL_20M)]
+    for tilex10 in range(tilex20 * const.M12, (tilex20 + 1) * const.M12):
+        for tiley10 in range(tiley20 * const.M12, (tiley20 + 1) * const.M12):
+            indices.append((tilex10, tiley10, const.ZOOM_LEVEL_10M))
+    return dict(zip(indices, get_range_tiles_batch(sentineltiles, indices)))
+
+
+def compositetile_parent_stacks(tilex60, tiley60, tilex20, tiley20, parent_tiles):
+    """
+    Iterator to provide scene level band stacks for all 10m tiles within a 20m
+    tile, from the prefetched parent tiles. The stacks of a tile are yielded as
+    one array with the shape (scenes, bands, rows, cols).
+    """
+    tiles60 = parent_tiles[(tilex60, tiley60, const.ZOOM_LEVEL_60M)]
+    if not len(tiles60):
+        return
 
-        if tilez == const.ZOOM_LEVEL_20M:
-            if not hasattr(sentineltile, 'sentineltilesceneclass'):
+    tiles20 = parent_tiles[(tilex20, tiley20, const.ZOOM_LEVEL_20M)]
+    if not len(tiles20):
+        return
+
+    # Size of the 60m tile section covered by a 20m tile.
+    size60 = WEB_MERCATOR_TILESIZE // const.M26
+
+    # Warp the 60m and 20m rasters to the 10m level once for all children of
+    # the 20m tile. The children take slices of the upsampled arrays.
+    offset60x = (tilex20 - const.M26 * tilex60) * size60
+    offset60y = (tiley20 - const.M26 * tiley60) * size60
+    tiles60_warped = []
+    for scene, band, tile in tiles60:
+        tile = tile.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)[offset60y:(offset60y + size60), offset60x:(offset60x + size60)]
+        tiles60_warped.append((scene, band, tile.repeat(const.M16, axis=0).repeat(const.M16, axis=1)))
+    tiles20_warped = []
+    for scene, band, tile in tiles20:
+        tile = tile.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)
+        tiles20_warped.append((scene, band, tile.repeat(const.M12, axis=0).repeat(const.M12, axis=1)))
+
+    # Loop through children tiles at 10m.
+    for tilex10 in range(tilex20 * const.M12, (tilex20 + 1) * const.M12):
+        for tiley10 in range(tiley20 * const.M12, (tiley20 + 1) * const.M12):
+
+            tiles10 = parent_tiles[(tilex10, tiley10, const.ZOOM_LEVEL_10M)]
+            if not len(tiles10):
                 continue
-            tile = get_raster_tile(sentineltile.sentineltilesceneclass.layer_id, tilez, tilex, tiley)
-            if not tile:
+
+            # Slice the upsampled rasters for this tile.
+            offsetx = (tilex10 - const.M12 * tilex20) * WEB_MERCATOR_TILESIZE
+            offsety = (tiley10 - const.M12 * tiley20) * WEB_MERCATOR_TILESIZE
+            children = [
+                (x[0], x[1], x[2][offsety:(offsety + WEB_MERCATOR_TILESIZE), offsetx:(offsetx + WEB_MERCATOR_TILESIZE)])
+                for x in tiles60_warped + tiles20_warped
+            ]
+
+            # Group the band tiles by scene.
+            scenes = {}
+            for scene, band, tile in (children + tiles10):
+                scenes.setdefault(scene, {})[band] = tile
+
+            # Drop incomplete stacks, total number of bands plus SCL layer.
+            scenes = [bands for bands in scenes.values() if len(bands) == const.NR_OF_BANDS + 1]
+
+            # Skp if no complete stack is available for this tile.
+            if not len(scenes):
                 continue
-            tiles.append((sentineltile.prefix, const.SCL, tile.bands[0].data()))
 
-    return tiles
+            # Combine the stacks into one array with the shape
+            # (scenes, bands, rows, cols), the scene id is no longer
+            # relevant after this.
+            dtype = numpy.result_type(*{tile.dtype for bands in scenes for tile in bands.values()})
+            stacks = numpy.empty((len(scenes), len(const.ALL_BANDS), WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), dtype=dtype)
+            for index, bands in enumerate(scenes):
+                for band, tile in bands.items():
+                    stacks[index, const.ALL_BANDS_INDEX[band]] = tile.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)
+
+            yield tilex10, tiley10, stacks
 
 
 def compositetile_stacks(ctile):
     """
     Iterator to provide scene level band stacks for all xyz tiles that
     are within one CompositeTile.
+
+    The scene tiles are fetched for one 20m tile and its 60m parent and 10m
+    children at a time. The tiles of the next 20m tile are fetched in the
+    background while the current one is processed, so at most two 20m tiles
+    are held in memory. The 60m tiles are read from the tile cache after the
+    first 20m child.
     """
     logger.info('Creating Tiles for Layer "{0}" at {1}/{2}/{3}'.format(
         ctile.composite.name,
@@ -267,7 +378,10 @@ def compositetile_stacks(ctile):
     # Compute indexrange for this higher level tile.
     indexrange = ctile.index_range(const.ZOOM_LEVEL_60M)
 
-    # Loop through tiles at 60m that intersect with bounding box.
+    # Get the scenes overlapping with each tile at 60m that intersects with the
+    # bounding box. The querysets are evaluated here, so that the prefetching
+    # thread does not need database access.
+    parents = []
     for tilex60 in range(indexrange[0], indexrange[2] + 1):
         for tiley60 in range(indexrange[1], indexrange[3] + 1):
             # Limit sentineltiles to those overlapping with the 60m tile.
@@ -278,62 +392,40 @@ def compositetile_stacks(ctile):
             sentineltiles60 = sentineltiles.filter(tile_data_geom__intersects=bounds60).only('prefix')
             # Prefetch related objects.
             sentineltiles60 = sentineltiles60.select_related('sentineltilesceneclass').prefetch_related('sentineltileband_set')
-
-            tiles60 = get_range_tiles(sentineltiles60, tilex60, tiley60, const.ZOOM_LEVEL_60M)
-            if not len(tiles60):
+            sentineltiles60 = list(sentineltiles60)
+            if not len(sentineltiles60):
                 continue
-
             # Loop through children tiles at 20m.
             for tilex20 in range(tilex60 * const.M26, (tilex60 + 1) * const.M26):
                 for tiley20 in range(tiley60 * const.M26, (tiley60 + 1) * const.M26):
+                    parents.append((tilex60, tiley60, tilex20, tiley20, sentineltiles60))
+
+    if not settings.COMPOSITE_STACK_PREFETCH:
+        for tilex60, tiley60, tilex20, tiley20, sentineltiles60 in parents:
+            parent_tiles = get_compositetile_parent_tiles(sentineltiles60, tilex60, tiley60, tilex20, tiley20)
+            yield from compositetile_parent_stacks(tilex60, tiley60, tilex20, tiley20, parent_tiles)
+        return
+
+    if not parents:
+        return
 
-                    tiles20 = get_range_tiles(sentineltiles60, tilex20, tiley20, const.ZOOM_LEVEL_20M)
-                    if not len(tiles20):
-                        continue
-
-                    # Loop through children tiles at 10m.
-                    for tilex10 in range(tilex20 * const.M12, (tilex20 + 1) * const.M12):
-                        for tiley10 in range(tiley20 * const.M12, (tiley20 + 1) * const.M12):
-
-                            tiles10 = get_range_tiles(sentineltiles60, tilex10, tiley10, const.ZOOM_LEVEL_10M)
-                            if not len(tiles10):
-                                continue
-
-                            # Warp larger 60m and 20m rasters to 10m level.
-                            offset60x = (tilex10 - const.M16 * tilex60) * WEB_MERCATOR_TILESIZE / const.M16
-                            offset60y = (tiley10 - const.M16 * tiley60) * WEB_MERCATOR_TILESIZE / const.M16
-                            tiles60_warped = [(x[0], x[1], disaggregate_tile(x[2], const.M16, offset60x, offset60y)) for x in tiles60]
-
-                            offset20x = (tilex10 - const.M12 * tilex20) * WEB_MERCATOR_TILESIZE / const.M12
-                            offset20y = (tiley10 - const.M12 * tiley20) * WEB_MERCATOR_TILESIZE / const.M12
-                            tiles20_warped = [(x[0], x[1], disaggregate_tile(x[2], const.M12, offset20x, offset20y)) for x in tiles20]
-
-                            # Create a stack for each scene.
-                            stacks = {}
-                            stacks_length = {}
-                            for scene, band, tile in (tiles60_warped + tiles20_warped + tiles10):
-                                if scene not in stacks:
-                                    stacks[scene] = {}
-                                    stacks_length[scene] = 1
-                                else:
-                                    stacks_length[scene] += 1
-                                stacks[scene][band] = tile
-
-                            # Drop incomplete stacks, total number of bands plus SCL layer.
-                            for key, count in stacks_length.items():
-                                if count != const.NR_OF_BANDS + 1:
-                                    del stacks[key]
-
-                            # Skp if no complete stack is available for this tile.
-                            if not len(stacks):
-                                continue
-
-                            # Return stacks as list the scene id is no longer
-                            # relevant after this.
-                            yield tilex10, tiley10, list(stacks.values())
-
-
-def process_compositetile_s1(ctile, rasterlayer_lookup):
+    def prefetch(parent):
+        tilex60, tiley60, tilex20, tiley20, sentineltiles60 = parent
+        return prefetcher.submit(get_compositetile_parent_tiles, sentineltiles60, tilex60, tiley60, tilex20, tiley20)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='stackprefetch') as prefetcher:
+        future = prefetch(parents[0])
+        for index, (tilex60, tiley60, tilex20, tiley20, sentineltiles60) in enumerate(parents):
+            parent_tiles = future.result()
+            # Start fetching the next parent tile.
+            if index + 1 < len(parents):
+                future = prefetch(parents[index + 1])
+            yield from compositetile_parent_stacks(tilex60, tiley60, tilex20, tiley20, parent_tiles)
+            # Release the tiles before waiting for the next parent tile.
+            del parent_tiles
+
+
+def process_compositetile_s1(ctile, rasterlayer_lookup, mosaic=None):
     """
     Construct max zoom level raster tiles for S1 input.
     """
@@ -399,6 +491,8 @@ def process_compositetile_s1(ctile, rasterlayer_lookup):
                     datatype=s1const.SENTINEL_1_DATA_TYPE,
                     merge_with_existing=False,
                 )
+                if mosaic is not None:
+                    mosaic.add(band, tilex, tiley, data)
 
             # Log progress.
             counter += 1
@@ -406,9 +500,28 @@ def process_compositetile_s1(ctile, rasterlayer_lookup):
                 ctile.write('{count} S1 Tiles Created, currently at ({x}, {y}).'.format(count=counter, x=tilex, y=tiley))
 
 
-def process_compositetile_s2(ctile, rasterlayer_lookup):
+def write_compositetile_s2_tile(rasterlayer_lookup, tilex, tiley, result):
+    """
+    Write the composite pixels of all S2 bands for one max zoom level tile.
+    """
+    for key, composite_data in result.items():
+        write_raster_tile(
+            rasterlayer_lookup[key],
+            composite_data,
+            const.ZOOM_LEVEL_10M,
+            tilex,
+            tiley,
+            datatype=1 if key == const.SCL else 2,
+            merge_with_existing=False,
+        )
+
+
+def process_compositetile_s2(ctile, rasterlayer_lookup, mosaic=None):
     """
     Construct max zoom level raster tiles for S2 input.
+
+    If more than one composite worker is configured, the pixel selection runs
+    in a process pool. The tiles are encoded and written in the background.
     """
     # Get cloud algorithm.
     clouds = Clouds(ctile)
@@ -416,47 +529,30 @@ def process_compositetile_s2(ctile, rasterlayer_lookup):
 
     # Loop over all TMS tiles in a given zone and get band stacks for available
     # scenes in that tile.
-    counter = 0
-    for x, y, stacks in compositetile_stacks(ctile):
-        # Compute the cloud probabilities for each avaiable scene band stack.
-        cloud_probs = [clouds.clouds(stack) for stack in stacks]
-
-        # Compute an array of scene indices with the lowest cloud probability.
-        selector_index = numpy.argmin(cloud_probs, axis=0)
-
-        # Compute mask for pixels where all stacks are over the exclude value.
-        exclude = numpy.min(cloud_probs, axis=0) >= const.EXCLUDE_VALUE
-
-        # Loop over all bands.
-        for key in const.ALL_BANDS:
-            # Merge scene tiles for this band into a composite tile using the selector index.
-            bnds = numpy.array([stack[key] for stack in stacks])
-
-            # Construct final composite band array from selector index.
-            composite_data = bnds[selector_index, const.CLOUD_IDX1, const.CLOUD_IDX2]
+    with TileWriter() as writer:
+        if settings.COMPOSITE_WORKERS > 1:
+            with CloudSelectionPool(clouds, settings.COMPOSITE_WORKERS) as pool:
+                write_compositetile_s2_results(ctile, rasterlayer_lookup, pool.imap(compositetile_stacks(ctile)), writer, mosaic)
+        else:
+            # Select the pixels with the lowest cloud probability.
+            results = ((x, y, clouds.composite(stacks)) for x, y, stacks in compositetile_stacks(ctile))
+            write_compositetile_s2_results(ctile, rasterlayer_lookup, results, writer, mosaic)
 
-            # Exclude bad pixels.
-            composite_data[exclude] = const.SENTINEL_NODATA_VALUE
 
-            # Ensure datatype.
-            if key == const.SCL:
-                datatype = 1
-                composite_data = composite_data.astype('uint8')
-            else:
-                datatype = 2
-                composite_data = composite_data.astype('uint16')
+def write_compositetile_s2_results(ctile, rasterlayer_lookup, results, writer, mosaic=None):
+    """
+    Write the composite pixels of S2 tiles from an iterable of (tilex, tiley,
+    result) tuples with the tile writer.
 
-            # Update results dict with data, using a random name for the in
-            # memory raster.
-            write_raster_tile(
-                rasterlayer_lookup[key],
-                composite_data,
-                const.ZOOM_LEVEL_10M,
-                x,
-                y,
-                datatype=datatype,
-                merge_with_existing=False,
-            )
+    The mosaic is filled in the calling thread, only the encoding and writing
+    of the tiles runs in the writer threads.
+    """
+    counter = 0
+    for x, y, result in results:
+        if mosaic is not None:
+            for key, composite_data in result.items():
+                mosaic.add(key, x, y, composite_data)
+        writer.submit(write_compositetile_s2_tile, rasterlayer_lookup, x, y, result)
 
         # Log progress.
         counter += 1
@@ -464,6 +560,83 @@ def process_compositetile_s2(ctile, rasterlayer_lookup):
             ctile.write('{count} S2 Tiles Created, currently at ({x}, {y}).'.format(count=counter, x=x, y=y))
 
 
+def composite_band_spec(band_name):
+    """
+    Return the numpy dtype, nodata value, GDAL datatype and aggregation method
+    of a composite band.
+    """
+    if band_name in s1const.POLARIZATION_DV_BANDS:
+        return numpy.float32, s1const.SENTINEL_1_NODATA_VALUE, 6, AGGREGATE_MEAN
+    elif band_name == const.SCL:
+        # The scene class is categorical.
+        return numpy.uint8, const.SENTINEL_NODATA_VALUE, 1, AGGREGATE_MODE
+    else:
+        return numpy.uint16, const.SENTINEL_NODATA_VALUE, 2, AGGREGATE_MEAN
+
+
+def build_compositetile_pyramid(ctile, rasterlayer_lookup, mosaic):
+    """
+    Build the pyramid of a composite tile from its full resolution mosaic.
+
+    The zoom levels down to the composite tile level are only covered by this
+    composite tile. They are aggregated from the mosaic in memory and uploaded
+    in parallel. The lower zoom levels are shared with neighbouring composite
+    tiles, so the sibling tiles are read and the result is merged with the
+    existing tiles.
+    """
+    block = ((0, 0), (1, 0), (0, 1), (1, 1))
+    for band_name, rasterlayer_id in rasterlayer_lookup.items():
+        if band_name not in mosaic.filled:
+            continue
+        dtype, nodata_value, datatype, method = composite_band_spec(band_name)
+        ctile.write('Creating World Pyramid for band {0}.'.format(band_name))
+        data = mosaic.array(band_name)
+        # Aggregate the levels within the composite tile.
+        for zoom in range(mosaic.zoom - 1, ctile.tilez - 1, -1):
+            data = aggregate_tile(data, target_dtype=dtype, nodata=nodata_value, method=method)
+            size = data.shape[0] // WEB_MERCATOR_TILESIZE
+            tiles = []
+            for row in range(size):
+                for col in range(size):
+                    tiles.append((
+                        rasterlayer_id,
+                        numpy.ascontiguousarray(data[
+                            row * WEB_MERCATOR_TILESIZE:(row + 1) * WEB_MERCATOR_TILESIZE,
+                            col * WEB_MERCATOR_TILESIZE:(col + 1) * WEB_MERCATOR_TILESIZE,
+                        ]),
+                        zoom,
+                        ctile.tilex * size + col,
+                        ctile.tiley * size + row,
+                    ))
+            write_raster_tiles(tiles, nodata_value=nodata_value, datatype=datatype, merge_with_existing=False)
+
+        # Aggregate the shared levels, combining this composite tile's data
+        # with the sibling tiles from storage.
+        tilex, tiley = ctile.tilex, ctile.tiley
+        for zoom in range(ctile.tilez - 1, -1, -1):
+            parentx, parenty = tilex // 2, tiley // 2
+            siblings = get_raster_tiles(
+                [(rasterlayer_id, zoom + 1, parentx * 2 + dat[0], parenty * 2 + dat[1]) for dat in block],
+                look_up=False,
+            )
+            result = []
+            for dat, tile in zip(block, siblings):
+                if (parentx * 2 + dat[0], parenty * 2 + dat[1]) == (tilex, tiley):
+                    result.append(data)
+                elif tile:
+                    result.append(tile.bands[0].data().astype(dtype))
+                else:
+                    result.append(numpy.full((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), nodata_value, dtype=dtype))
+            # Combine the tiles to a new full tile and aggregate it.
+            result = numpy.vstack([numpy.hstack(result[:2]), numpy.hstack(result[2:])])
+            data = aggregate_tile(result, target_dtype=dtype, nodata=nodata_value, method=method)
+            # Writing merges the existing pixels into the data array in place.
+            write_raster_tile(rasterlayer_id, data, zoom, parentx, parenty, nodata_value, datatype)
+            tilex, tiley = parentx, parenty
+
+
+@use_tile_cache()
+@use_tile_index()
 def process_compositetile(compositetile_id):
     """
     Build a cloud free unified base layer for a given areas of interest and for
@@ -477,83 +650,21 @@ def process_compositetile(compositetile_id):
     # Get the list of master layers for all 13 bands.
     rasterlayer_lookup = ctile.composite.rasterlayer_lookup
 
-    if ctile.include_sentinel_1:
-        rasterlayer_lookup_s1 = {key: val for key, val in rasterlayer_lookup.items() if key in s1const.POLARIZATION_DV_BANDS}
-        process_compositetile_s1(ctile, rasterlayer_lookup_s1)
-
-    if ctile.include_sentinel_2:
-        rasterlayer_lookup_s2 = {key: val for key, val in rasterlayer_lookup.items() if key in const.ALL_BANDS}
-        process_compositetile_s2(ctile, rasterlayer_lookup_s2)
-
-    # Start pyramid building phase.
-    ctile.write('Finished building composite tile at max zoom level, starting Pyramid.')
-
-    # Loop over all zoom levels to construct pyramid.
-    zoomrange = reversed(range(1, const.ZOOM_LEVEL_10M + 1))
-    for zoom in zoomrange:
-        # Compute index range for the zone of interest.
-        factor = 2 ** (zoom - const.ZOOM_LEVEL_60M)
-        indexrange = [int(idx * factor) for idx in ctile.index_range(const.ZOOM_LEVEL_60M)]
-        if zoom > const.ZOOM_LEVEL_60M:
-            indexrange[2] += factor - 1
-            indexrange[3] += factor - 1
-
-        # Make sure the index ranges start with a multiple of 2 to avoid edge
-        # effects when aggregating.
-        if indexrange[0] % 2 == 1:
-            indexrange[0] -= 1
-
-        if indexrange[1] % 2 == 1:
-            indexrange[1] -= 1
-
-        msg = 'Creating World Pyramid at Zoom {0} for Index Range {1}.'.format(
-            zoom - 1,
-            [idx // 2 for idx in indexrange],
-        )
-        ctile.write(msg)
-
-        # Loop over composite band tiles in blocks of four.
-        for tilex in range(indexrange[0], indexrange[2] + 1, 2):
-            for tiley in range(indexrange[1], indexrange[3] + 1, 2):
-                # Aggregate tiles for each composite band.
-                for band_name, rasterlayer_id in rasterlayer_lookup.items():
-                    result = []
-                    none_found = True
-                    is_S1 = band_name in s1const.POLARIZATION_DV_BANDS
-                    # Determine data type.
-                    if is_S1:
-                        dtype = numpy.float32
-                    elif band_name == const.SCL:
-                        dtype = numpy.uint8
-                    else:
-                        dtype = numpy.uint16
-                    # Read each tile in the block of 2x2.
-                    for idx, dat in enumerate(((0, 0), (1, 0), (0, 1), (1, 1))):
-                        tile = get_raster_tile(rasterlayer_id, zoom, tilex + dat[0], tiley + dat[1])
-                        if tile:
-                            none_found = False
-                            agg = tile.bands[0].data()
-                        else:
-                            agg = numpy.zeros((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), dtype=dtype)
-                        result.append(agg)
-                    # Continue if no tile could be found for this 2x2 block.
-                    if none_found:
-                        continue
-                    # Combine the tiles to a new full tile.
-                    upper = numpy.append(result[0], result[1], axis=1)
-                    lower = numpy.append(result[2], result[3], axis=1)
-                    result = numpy.append(upper, lower, axis=0)
-                    # Aggregate tile by a factor of two to match lower zoom level.
-                    result = aggregate_tile(result, target_dtype=dtype)
-                    # Write pixels into a tile, using dtype and nodata specs of
-                    # each satellite system.
-                    if is_S1:
-                        nodata_value = s1const.SENTINEL_1_NODATA_VALUE
-                        datatype = 6
-                    else:
-                        nodata_value = const.SENTINEL_NODATA_VALUE
-                        datatype = 1 if band_name == const.SCL else 2
-                    write_raster_tile(rasterlayer_id, result, zoom - 1, tilex // 2, tiley // 2, nodata_value, datatype)
+    # Collect the max zoom level tiles in a mosaic for building the pyramid.
+    bands = {band_name: composite_band_spec(band_name)[:2] for band_name in rasterlayer_lookup}
+    with TileMosaic(ctile.tilex, ctile.tiley, ctile.tilez, const.ZOOM_LEVEL_10M, bands) as mosaic:
+
+        if ctile.include_sentinel_1:
+            rasterlayer_lookup_s1 = {key: val for key, val in rasterlayer_lookup.items() if key in s1const.POLARIZATION_DV_BANDS}
+            process_compositetile_s1(ctile, rasterlayer_lookup_s1, mosaic)
+
+        if ctile.include_sentinel_2:
+            rasterlayer_lookup_s2 = {key: val for key, val in rasterlayer_lookup.items() if key in const.ALL_BANDS}
+            process_compositetile_s2(ctile, rasterlayer_lookup_s2, mosaic)
+
+        # Start pyramid building phase.
+        ctile.write('Finished building composite tile at max zoom level, starting Pyramid.')
+        build_compositetile_pyramid(ctile, rasterlayer_lookup, mosaic)
 
     ctile.end = timezone.now()
     ctile.write('Finished building composite tile.', CompositeTile.FINISHED)
@@ -980,23 +1091,15 @@ def clear_sentineltile(sentineltile_id):
     tile = SentinelTile.objects.get(id=sentineltile_id)
     # Write process log and update status.
     tile.write('Clearing this sentineltile.', SentinelTile.PROCESSING)
-    # Create S3 resource.
-    s3 = boto3.resource('s3')
-    # Get bucket if name is provided (this makes the clearing testable without
-    # patching S3).
-    if hasattr(settings, 'AWS_STORAGE_BUCKET_NAME_MEDIA'):
-        bucket = s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME_MEDIA)
-    else:
-        bucket = None
-    # Set delete batch size to boto3 delete_objects limit of 1000 objects.
-    BATCH_SIZE = 1000
+    # Get tile store, the local backend makes the clearing testable without
+    # patching S3.
+    store = get_tile_store()
     # Loop through bands.
     for band in tile.sentineltileband_set.all():
         tile.write('Clearing band {}.'.format(band.band))
-        # Delete all tiles for this band from S3.
-        prefix = 'tiles/{}/'.format(band.layer_id)
-        if bucket:
-            bucket.objects.page_size(BATCH_SIZE).filter(Prefix=prefix).delete()
+        # Delete all tiles for this band from storage.
+        store.delete_prefix(layer_prefix(band.layer_id))
+        get_tile_index().drop_layer(band.layer_id)
         # Unregister tiles from DB.
         qs = band.layer.rastertile_set.all()
         qs._raw_delete(qs.db)
@@ -1004,10 +1107,9 @@ def clear_sentineltile(sentineltile_id):
     # Remove SCL if present.
     if hasattr(tile, 'sentineltilesceneclass'):
         tile.write('Clearing SCL.')
-        # Delete all tiles for this band from S3.
-        prefix = 'tiles/{}/'.format(tile.sentineltilesceneclass.layer_id)
-        if bucket:
-            bucket.objects.page_size(BATCH_SIZE).filter(Prefix=prefix).delete()
+        # Delete all tiles for this band from storage.
+        store.delete_prefix(layer_prefix(tile.sentineltilesceneclass.layer_id))
+        get_tile_index().drop_layer(tile.sentineltilesceneclass.layer_id)
         # Unregister tiles from DB.
         qs = tile.sentineltilesceneclass.layer.rastertile_set.all()
         qs._raw_delete(qs.db)
@@ -1022,22 +1124,14 @@ def clear_composite(composite_id):
     """
     # Get composite.
     composite = Composite.objects.get(id=composite_id)
-    # Create S3 resource.
-    s3 = boto3.resource('s3')
-    # Get bucket if name is provided (this makes the clearing testable without
-    # patching S3).
-    if hasattr(settings, 'AWS_STORAGE_BUCKET_NAME_MEDIA'):
-        bucket = s3.Bucket(settings.AWS_STORAGE_BUCKET_NAME_MEDIA)
-    else:
-        bucket = None
-    # Set delete batch size to boto3 delete_objects limit of 1000 objects.
-    BATCH_SIZE = 1000
+    # Get tile store, the local backend makes the clearing testable without
+    # patching S3.
+    store = get_tile_store()
     # Loop through bands.
     for band in composite.compositeband_set.all():
-        # Delete all tiles for this band from S3.
-        prefix = 'tiles/{}/'.format(band.rasterlayer_id)
-        if bucket:
-            bucket.objects.page_size(BATCH_SIZE).filter(Prefix=prefix).delete()
+        # Delete all tiles for this band from storage.
+        store.delete_prefix(layer_prefix(band.rasterlayer_id))
+        get_tile_index().drop_layer(band.rasterlayer_id)
         # Unregister tiles from DB.
         qs = band.rasterlayer.rastertile_set.all()
         qs._raw_delete(qs.db)
@@ -0,0 +1,127 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import structlog
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+
+logger = structlog.get_logger('django_structlog')
+
+
+class TileCache(object):
+    """
+    Memory-bounded LRU cache of decoded raster tiles, keyed by (layer_id, tilez,
+    tilex, tiley). The pixel arrays are stored together with the raster
+    metadata, a new GDALRaster is created in memory for every hit so that
+    callers can not modify the cached data.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+        }
+
+    def get(self, key):
+        """
+        Return the cached tile as GDALRaster or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return
+            self._entries.move_to_end(key)
+            self.hits += 1
+        meta, bands, nbytes = entry
+        return GDALRaster(dict(meta, bands=[{'nodata_value': nodata, 'data': data} for nodata, data in bands]))
+
+    def put(self, key, tile):
+        """
+        Decode the pixel values of the tile and add them to the cache. The least
+        recently used tiles are evicted to stay within the byte size limit.
+        """
+        meta = {
+            'driver': 'MEM',
+            'width': tile.width,
+            'height': tile.height,
+            'origin': tuple(tile.origin),
+            'scale': tuple(tile.scale),
+            'skew': tuple(tile.skew),
+            'srid': tile.srid,
+            'datatype': tile.bands[0].datatype(),
+        }
+        bands = [(band.nodata_value, band.data()) for band in tile.bands]
+        nbytes = sum(data.nbytes for nodata, data in bands)
+        # Tiles larger than the cache are not stored.
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous[2]
+            self._entries[key] = (meta, bands, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted[2]
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Remove a tile from the cache, used when the tile is written.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    """
+    Return the active tile cache, or None if no job enabled the cache.
+    """
+    return _tile_cache
+
+
+@contextmanager
+def use_tile_cache(max_bytes=None):
+    """
+    Enable the process-wide tile cache for the duration of a job. Can be used
+    as decorator on job functions. The cache is dropped when the job finishes,
+    so that long-running processes do not accumulate tiles. Nested uses share
+    the cache of the outermost job.
+    """
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is not None:
+            outermost = False
+        else:
+            outermost = True
+            _tile_cache = TileCache(max_bytes or settings.TILE_CACHE_MAX_BYTES)
+        cache = _tile_cache
+    try:
+        yield cache
+    finally:
+        if outermost:
+            logger.info('Tile cache statistics: {}'.format(cache.stats))
+            with _tile_cache_lock:
+                _tile_cache = None
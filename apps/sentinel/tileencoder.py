@@ -0,0 +1,279 @@
+import struct
+import threading
+import uuid
+
+import numpy
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
+
+try:
+    # Use the libdeflate bindings if installed, they are considerably faster
+    # than zlib.
+    from deflate import zlib_compress as deflate_compress
+except ImportError:
+    from zlib import compress as deflate_compress
+
+# Codecs available for tile compression.
+CODEC_DEFLATE = 'deflate'
+CODEC_ZSTD = 'zstd'
+CODEC_LZW = 'lzw'
+
+# Default compression levels of the codecs, matching the GDAL defaults.
+DEFAULT_CODEC_LEVELS = {
+    CODEC_DEFLATE: 6,
+    CODEC_ZSTD: 9,
+    CODEC_LZW: None,
+}
+
+# Numpy dtypes and TIFF sample formats of the GDAL datatypes.
+GDAL_DATATYPES = {
+    1: (numpy.dtype('<u1'), 1),
+    2: (numpy.dtype('<u2'), 1),
+    3: (numpy.dtype('<i2'), 2),
+    4: (numpy.dtype('<u4'), 1),
+    5: (numpy.dtype('<i4'), 2),
+    6: (numpy.dtype('<f4'), 3),
+    7: (numpy.dtype('<f8'), 3),
+}
+
+# TIFF compression tag values of the codecs.
+TIFF_COMPRESSION = {
+    CODEC_DEFLATE: 8,
+    CODEC_ZSTD: 50000,
+}
+
+# TIFF field types.
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_DOUBLE = 12
+
+TIFF_FIELD_FORMATS = {
+    TIFF_SHORT: 'H',
+    TIFF_LONG: 'I',
+    TIFF_DOUBLE: 'd',
+}
+
+TIFF_FIELD_SIZES = {
+    TIFF_ASCII: 1,
+    TIFF_SHORT: 2,
+    TIFF_LONG: 4,
+    TIFF_DOUBLE: 8,
+}
+
+
+class TileEncoder(object):
+    """
+    Encoder that converts the pixel arrays of a web mercator tile into GeoTIFF
+    bytes. Subclasses implement the encoding for a codec and compression level.
+    """
+
+    def __init__(self, codec=None, level=None):
+        self.codec = codec or CODEC_DEFLATE
+        if self.codec not in DEFAULT_CODEC_LEVELS:
+            raise ValueError('Unknown tile codec "{}".'.format(self.codec))
+        self.level = DEFAULT_CODEC_LEVELS[self.codec] if level is None else level
+
+    def encode(self, bands, origin, scale, datatype, nodata_value=None):
+        """
+        Return the GeoTIFF bytes of a tile with the given band arrays. The
+        origin is the upper left corner of the tile, the scale the pixel size.
+        """
+        raise NotImplementedError
+
+
+class GDALTileEncoder(TileEncoder):
+    """
+    Encoder writing the tile through a GDALRaster in the virtual file system.
+    """
+
+    def encode(self, bands, origin, scale, datatype, nodata_value=None):
+        options = {
+            'compress': self.codec,
+            'predictor': 2,
+        }
+        if self.codec == CODEC_DEFLATE:
+            options['zlevel'] = self.level
+        elif self.codec == CODEC_ZSTD:
+            options['zstd_level'] = self.level
+        dest = GDALRaster({
+            'name': '/vsimem/{}'.format(uuid.uuid4()),
+            'driver': 'tif',
+            'origin': origin,
+            'width': WEB_MERCATOR_TILESIZE,
+            'height': WEB_MERCATOR_TILESIZE,
+            'scale': [scale, -scale],
+            'srid': WEB_MERCATOR_SRID,
+            'datatype': datatype,
+            'papsz_options': options,
+            'bands': [{'nodata_value': nodata_value, 'data': band} for band in bands],
+        })
+        return bytes(dest.vsi_buffer)
+
+
+class TiffTileEncoder(TileEncoder):
+    """
+    Encoder writing the GeoTIFF structure directly. All tags except the strip
+    offsets and the georeference are equal for tiles with the same datatype,
+    band count and nodata value, so the tag layout is prepared once and reused
+    as a template. Each band is compressed as a single strip with horizontal
+    differencing, as in the GDAL driver with predictor 2.
+    """
+
+    codecs = (CODEC_DEFLATE, CODEC_ZSTD)
+
+    def __init__(self, codec=None, level=None):
+        super().__init__(codec, level)
+        if self.codec not in self.codecs:
+            raise ValueError('The tiff encoder does not support the "{}" codec.'.format(self.codec))
+        if self.codec == CODEC_ZSTD:
+            # The zstandard package is optional, only import it when used.
+            import zstandard  # noqa: F401
+        self._templates = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def compress(self, data):
+        if self.codec == CODEC_DEFLATE:
+            return deflate_compress(data, self.level)
+        # Zstd compressors can not be shared between threads.
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            import zstandard
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+    def template(self, datatype, band_count, nodata_value):
+        """
+        Return the static tags for tiles with the given format, as a list of
+        (tag, field type, values) tuples.
+        """
+        key = (datatype, band_count, nodata_value)
+        template = self._templates.get(key)
+        if template is None:
+            dtype, sample_format = GDAL_DATATYPES[datatype]
+            template = [
+                (256, TIFF_LONG, [WEB_MERCATOR_TILESIZE]),  # ImageWidth
+                (257, TIFF_LONG, [WEB_MERCATOR_TILESIZE]),  # ImageLength
+                (258, TIFF_SHORT, [8 * dtype.itemsize] * band_count),  # BitsPerSample
+                (259, TIFF_SHORT, [TIFF_COMPRESSION[self.codec]]),  # Compression
+                (262, TIFF_SHORT, [1]),  # PhotometricInterpretation, min is black
+                (277, TIFF_SHORT, [band_count]),  # SamplesPerPixel
+                (278, TIFF_LONG, [WEB_MERCATOR_TILESIZE]),  # RowsPerStrip
+                (284, TIFF_SHORT, [2 if band_count > 1 else 1]),  # PlanarConfiguration
+                (317, TIFF_SHORT, [2]),  # Predictor, horizontal differencing
+                (339, TIFF_SHORT, [sample_format] * band_count),  # SampleFormat
+                # Projected web mercator with pixel is area raster type.
+                (34735, TIFF_SHORT, [1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, WEB_MERCATOR_SRID]),  # GeoKeyDirectory
+            ]
+            if band_count > 1:
+                template.append((338, TIFF_SHORT, [0] * (band_count - 1)))  # ExtraSamples
+            if nodata_value is not None:
+                template.append((42113, TIFF_ASCII, '{}\0'.format(nodata_value).encode()))  # GDAL_NODATA
+            with self._lock:
+                self._templates[key] = template
+        return template
+
+    def encode(self, bands, origin, scale, datatype, nodata_value=None):
+        dtype, sample_format = GDAL_DATATYPES[datatype]
+        # Compress each band as one strip with horizontal differencing, on the
+        # unsigned integer representation of the pixel values.
+        udtype = numpy.dtype('<u{}'.format(dtype.itemsize))
+        strips = []
+        for band in bands:
+            data = numpy.asarray(band).astype(dtype, copy=False).reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE).view(udtype)
+            diff = numpy.empty_like(data)
+            diff[:, 0] = data[:, 0]
+            numpy.subtract(data[:, 1:], data[:, :-1], out=diff[:, 1:])
+            strips.append(self.compress(diff.tobytes()))
+
+        # The header is followed by the tag directory, the tag values that do
+        # not fit into the directory entries and the compressed strips. The
+        # size of the tag values does not depend on the strip offsets, so the
+        # offsets are computed before packing the tags.
+        tags = self.template(datatype, len(bands), nodata_value) + [
+            (33550, TIFF_DOUBLE, [scale, scale, 0.0]),  # ModelPixelScale
+            (33922, TIFF_DOUBLE, [0.0, 0.0, 0.0, origin[0], origin[1], 0.0]),  # ModelTiepoint
+            (279, TIFF_LONG, [len(strip) for strip in strips]),  # StripByteCounts
+        ]
+        values_offset = 8 + 2 + 12 * (len(tags) + 1) + 4
+        values_size = sum(pack_size(field_type, tag_values) for tag, field_type, tag_values in tags)
+        values_size += pack_size(TIFF_LONG, bands)
+        strip_offsets = []
+        offset = values_offset + values_size
+        for strip in strips:
+            strip_offsets.append(offset)
+            offset += len(strip)
+        tags.append((273, TIFF_LONG, strip_offsets))  # StripOffsets
+        tags.sort(key=lambda tag: tag[0])
+
+        directory = bytearray(struct.pack('<2sHIH', b'II', 42, 8, len(tags)))
+        values = bytearray()
+        for tag, field_type, tag_values in tags:
+            packed = pack_values(field_type, tag_values)
+            if len(packed) > 4:
+                directory += struct.pack('<HHII', tag, field_type, len(tag_values), values_offset + len(values))
+                values += packed.ljust(pack_size(field_type, tag_values), b'\0')
+            else:
+                directory += struct.pack('<HHI', tag, field_type, len(tag_values)) + packed.ljust(4, b'\0')
+        directory += struct.pack('<I', 0)
+        return b''.join([directory, values] + strips)
+
+
+def pack_values(field_type, values):
+    """
+    Pack the values of a tiff tag in little endian byte order.
+    """
+    if field_type == TIFF_ASCII:
+        return values
+    return struct.pack('<{}{}'.format(len(values), TIFF_FIELD_FORMATS[field_type]), *values)
+
+
+def pack_size(field_type, values):
+    """
+    Size of the tag values outside of the tag directory, padded to word
+    boundaries. Values of up to four bytes are stored in the directory.
+    """
+    size = len(values) * TIFF_FIELD_SIZES[field_type]
+    if size <= 4:
+        return 0
+    return size + size % 2
+
+
+_tile_encoder = None
+_tile_encoder_lock = threading.Lock()
+
+
+def get_tile_encoder():
+    """
+    Return the process-wide tile encoder. The direct tiff encoder is used if
+    it is configured and supports the codec, otherwise the GDAL encoder.
+    """
+    global _tile_encoder
+    if _tile_encoder is None:
+        with _tile_encoder_lock:
+            if _tile_encoder is None:
+                if settings.TILE_ENCODER == 'tiff' and settings.TILE_CODEC in TiffTileEncoder.codecs:
+                    _tile_encoder = TiffTileEncoder(settings.TILE_CODEC, settings.TILE_CODEC_LEVEL)
+                else:
+                    _tile_encoder = GDALTileEncoder(settings.TILE_CODEC, settings.TILE_CODEC_LEVEL)
+    return _tile_encoder
+
+
+def reset_tile_encoder():
+    """
+    Drop the process-wide tile encoder, it will be re-created from the settings
+    on the next access.
+    """
+    global _tile_encoder
+    with _tile_encoder_lock:
+        _tile_encoder = None
+
+
+@receiver(setting_changed, dispatch_uid='reset_tile_encoder_on_setting_changed')
+def reset_tile_encoder_on_setting_changed(setting, **kwargs):
+    if setting in ('TILE_ENCODER', 'TILE_CODEC', 'TILE_CODEC_LEVEL'):
+        reset_tile_encoder()
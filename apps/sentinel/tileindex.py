@@ -0,0 +1,211 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from sentinel.tilestore import get_tile_store, tile_key
+
+# Pattern to extract tile indices from tile store keys.
+TILE_KEY_REGEX = re.compile(r'^tiles/(?P<layer_id>\d+)/(?P<tilez>\d+)/(?P<tilex>\d+)/(?P<tiley>\d+)\.tif$')
+
+
+def column_prefix(layer_id, tilez, tilex):
+    """
+    Storage prefix holding all tiles of a raster layer in one tile column.
+    """
+    return 'tiles/{}/{}/{}/'.format(layer_id, tilez, tilex)
+
+
+class TileIndex(object):
+    """
+    In-process tile existence index with a time to live for all entries.
+
+    Two structures are kept. A negative cache of tile keys that were not found
+    in the tile store, so that repeated misses are resolved in memory. And a
+    per layer, zoom level and tile column set of existing tile rows, built from
+    a listing of the column prefix in the tile store. The latter is used to find
+    the ancestor zoom level that holds a tile, without probing every level with
+    a request. Listing single columns keeps the listings small, a column holds
+    at most the rows of the layer extent at its zoom level.
+
+    The negative cache holds at most max_missing keys, the oldest entries are
+    dropped first. Listings run outside of the index lock, concurrent requests
+    for the same column wait for the listing in flight.
+    """
+
+    def __init__(self, ttl=None, max_missing=None):
+        self.ttl = settings.TILE_INDEX_TTL if ttl is None else ttl
+        self.max_missing = settings.TILE_INDEX_MAX_MISSING if max_missing is None else max_missing
+        self._missing = OrderedDict()
+        self._columns = {}
+        # Listings in flight by layer, zoom level and column, with an event that is set
+        # when the listing is done and the tiles written in the meantime.
+        self._listing = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def is_missing(self, layer_id, tilez, tilex, tiley):
+        """
+        Returns True if the tile is known not to exist.
+        """
+        if not self.enabled:
+            return False
+        key = tile_key(layer_id, tilez, tilex, tiley)
+        with self._lock:
+            expires = self._missing.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._missing[key]
+                return False
+            return True
+
+    def add_missing(self, layer_id, tilez, tilex, tiley):
+        """
+        Register a tile that was not found in the tile store.
+        """
+        if not self.enabled:
+            return
+        key = tile_key(layer_id, tilez, tilex, tiley)
+        with self._lock:
+            self._missing[key] = time.monotonic() + self.ttl
+            self._missing.move_to_end(key)
+            while len(self._missing) > self.max_missing:
+                self._missing.popitem(last=False)
+
+    def add(self, layer_id, tilez, tilex, tiley):
+        """
+        Register a tile that was written to the tile store.
+        """
+        with self._lock:
+            self._missing.pop(tile_key(layer_id, tilez, tilex, tiley), None)
+            entry = self._columns.get((layer_id, tilez, tilex))
+            if entry is not None:
+                entry[1].add(tiley)
+            listing = self._listing.get((layer_id, tilez, tilex))
+            if listing is not None:
+                listing[1].add(tiley)
+
+    def drop_layer(self, layer_id):
+        """
+        Forget all entries of a layer, used when the tiles of a layer are removed.
+        """
+        prefix = 'tiles/{}/'.format(layer_id)
+        with self._lock:
+            self._missing = OrderedDict((key, expires) for key, expires in self._missing.items() if not key.startswith(prefix))
+            for key in [key for key in self._columns if key[0] == layer_id]:
+                del self._columns[key]
+
+    def column_tiles(self, layer_id, tilez, tilex):
+        """
+        Return the set of tiley indices that exist for a layer in a tile column
+        at a zoom level. The set is built from a listing of the column in the
+        tile store on first access and re-built after the time to live expired.
+        """
+        key = (layer_id, tilez, tilex)
+        while True:
+            with self._lock:
+                entry = self._columns.get(key)
+                if entry is not None and entry[0] >= time.monotonic():
+                    return entry[1]
+                listing = self._listing.get(key)
+                if listing is None:
+                    listing = (threading.Event(), set())
+                    self._listing[key] = listing
+                    break
+            # Wait for the listing of another thread and look again.
+            listing[0].wait()
+        try:
+            tiles = set()
+            for tile in get_tile_store().list(column_prefix(layer_id, tilez, tilex)):
+                match = TILE_KEY_REGEX.match(tile)
+                if match:
+                    tiles.add(int(match.group('tiley')))
+            with self._lock:
+                # Tiles written during the listing might not be part of it.
+                tiles |= listing[1]
+                self._columns[key] = (time.monotonic() + self.ttl, tiles)
+            return tiles
+        finally:
+            with self._lock:
+                del self._listing[key]
+            listing[0].set()
+
+    def find_zoom(self, layer_id, tilez, tilex, tiley, zoomrange):
+        """
+        Return the first zoom level from the zoom range that has a tile covering
+        the requested tile, or None if there is none. Only the column of the
+        covering tile is listed at each zoom level.
+        """
+        for zoom in zoomrange:
+            multiplier = 2 ** (tilez - zoom)
+            if tiley // multiplier in self.column_tiles(layer_id, zoom, tilex // multiplier):
+                return zoom
+
+
+_tile_index = None
+_tile_index_lock = threading.Lock()
+_job_tile_index = None
+
+
+def get_tile_index():
+    """
+    Return the tile existence index of the active job. Outside of jobs, a
+    process-wide index is returned that is disabled unless a time to live is
+    configured.
+    """
+    global _tile_index
+    if _job_tile_index is not None:
+        return _job_tile_index
+    if _tile_index is None:
+        with _tile_index_lock:
+            if _tile_index is None:
+                _tile_index = TileIndex(ttl=0)
+    return _tile_index
+
+
+def reset_tile_index():
+    """
+    Drop the process-wide tile index, it will be re-created on the next access.
+    """
+    global _tile_index
+    with _tile_index_lock:
+        _tile_index = None
+
+
+@contextmanager
+def use_tile_index(ttl=None):
+    """
+    Enable the tile existence index for the duration of a job. Can be used as
+    decorator on job functions. The index is dropped when the job finishes, so
+    that tiles written by other processes are seen by the next job. Nested uses
+    share the index of the outermost job.
+    """
+    global _job_tile_index
+    with _tile_index_lock:
+        if _job_tile_index is not None:
+            outermost = False
+        else:
+            outermost = True
+            _job_tile_index = TileIndex(ttl)
+        index = _job_tile_index
+    try:
+        yield index
+    finally:
+        if outermost:
+            with _tile_index_lock:
+                _job_tile_index = None
+
+
+@receiver(setting_changed, dispatch_uid='reset_tile_index_on_setting_changed')
+def reset_tile_index_on_setting_changed(setting, **kwargs):
+    if setting in ('MEDIA_ROOT', 'AWS_STORAGE_BUCKET_NAME_MEDIA', 'TILE_INDEX_TTL'):
+        reset_tile_index()
@@ -0,0 +1,226 @@
+import os
+import shutil
+import threading
+import uuid
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Maximum number of keys accepted by a single S3 delete_objects call.
+S3_DELETE_BATCH_SIZE = 1000
+
+
+def tile_key(layer_id, tilez, tilex, tiley):
+    """
+    Storage key of a raster tile, following the structured file name scheme.
+    """
+    return 'tiles/{}/{}/{}/{}.tif'.format(layer_id, tilez, tilex, tiley)
+
+
+def layer_prefix(layer_id):
+    """
+    Storage prefix holding all tiles of a raster layer.
+    """
+    return 'tiles/{}/'.format(layer_id)
+
+
+class TileStore(object):
+    """
+    Process-wide tile I/O backend. Subclasses implement the raw byte storage,
+    keys follow the tile_key naming scheme.
+    """
+
+    def get(self, key):
+        """
+        Return the bytes stored under the key or None if the key does not exist.
+        """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """
+        Store the bytes under the given key, overwriting existing data.
+        """
+        raise NotImplementedError
+
+    def version(self, key):
+        """
+        Return a string that changes whenever the data under the key is
+        overwritten, or None if the key does not exist. The data itself is
+        not read.
+        """
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """
+        Iterate over all keys starting with the prefix.
+        """
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        """
+        Remove all keys starting with the prefix.
+        """
+        raise NotImplementedError
+
+
+class S3TileStore(TileStore):
+    """
+    Tile store backed by an S3 bucket. A single boto3 client with a
+    configurable connection pool is shared by all threads of the process, so
+    that HTTP connections are kept alive across tile reads and writes.
+    """
+
+    def __init__(self, bucket, max_pool_connections=None):
+        self.bucket = bucket
+        self.max_pool_connections = max_pool_connections or settings.TILE_STORE_MAX_POOL_CONNECTIONS
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Boto3 clients are thread safe but can not be shared across forked
+        # processes, so the client is re-created if the process id changed.
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._lock:
+                if self._client is None or self._client_pid != pid:
+                    self._client = boto3.session.Session().client(
+                        's3',
+                        config=Config(
+                            max_pool_connections=self.max_pool_connections,
+                            retries={'max_attempts': 5, 'mode': 'standard'},
+                        ),
+                    )
+                    self._client_pid = pid
+        return self._client
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def version(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response['ETag']
+
+    def list(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def delete_prefix(self, prefix):
+        batch = []
+        for key in self.list(prefix):
+            batch.append({'Key': key})
+            if len(batch) == S3_DELETE_BATCH_SIZE:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+                batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+
+
+class LocalTileStore(TileStore):
+    """
+    Tile store backed by a local directory, used when no media bucket is
+    configured. Allows building composites and running tests without S3.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as fl:
+                return fl.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partially written tile.
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+        with open(tmp_path, 'wb') as fl:
+            fl.write(data)
+        os.replace(tmp_path, path)
+
+    def version(self, key):
+        try:
+            stat = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    def list(self, prefix):
+        base = self.path(prefix)
+        # Walk the directory that contains the prefix and filter by full key.
+        directory = base if base.endswith(os.sep) else os.path.dirname(base)
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root)
+                if key.startswith(prefix) and not filename.endswith('.tmp'):
+                    yield key
+
+    def delete_prefix(self, prefix):
+        if prefix.endswith('/'):
+            shutil.rmtree(self.path(prefix), ignore_errors=True)
+        else:
+            for key in list(self.list(prefix)):
+                os.remove(self.path(key))
+
+
+_tile_store = None
+_tile_store_lock = threading.Lock()
+
+
+def get_tile_store():
+    """
+    Return the process-wide tile store. The S3 backend is used if a media
+    bucket is configured, otherwise tiles are stored in the media root.
+    """
+    global _tile_store
+    if _tile_store is None:
+        with _tile_store_lock:
+            if _tile_store is None:
+                bucket = getattr(settings, 'AWS_STORAGE_BUCKET_NAME_MEDIA', None)
+                if bucket is not None:
+                    _tile_store = S3TileStore(bucket)
+                else:
+                    _tile_store = LocalTileStore(settings.MEDIA_ROOT)
+    return _tile_store
+
+
+def reset_tile_store():
+    """
+    Drop the process-wide tile store, it will be re-created from the settings
+    on the next access.
+    """
+    global _tile_store
+    with _tile_store_lock:
+        _tile_store = None
+
+
+@receiver(setting_changed, dispatch_uid='reset_tile_store_on_setting_changed')
+def reset_tile_store_on_setting_changed(setting, **kwargs):
+    if setting in ('MEDIA_ROOT', 'AWS_STORAGE_BUCKET_NAME_MEDIA', 'TILE_STORE_MAX_POOL_CONNECTIONS'):
+        reset_tile_store()
@@ -1,31 +1,103 @@
-import io
+import json
+import os
 import shutil
+import tempfile
+import threading
 import traceback
-import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import numpy
 import sentry_sdk
 from django.conf import settings
 from django.contrib.gis.gdal import GDALRaster, SpatialReference
-from django.core.files.storage import default_storage
 from raster.models import RasterLayerParseStatus
 from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE, WEB_MERCATOR_WORLDSIZE
 from raster.tiles.parser import RasterLayerParser
 from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
 from rasterio import Affine
+from rasterio.features import rasterize as rasterize_shapes
 from rasterio.io import MemoryFile
 from rasterio.warp import Resampling
 
 from sentinel import const
+from sentinel.tilecache import get_tile_cache
+from sentinel.tileencoder import get_tile_encoder
+from sentinel.tileindex import get_tile_index
+from sentinel.tilestore import get_tile_store, tile_key
 
 
-def aggregate_tile(tile, target_dtype=None, discrete=False):
+# Methods to aggregate blocks of 2x2 pixels.
+AGGREGATE_MEAN = 'mean'
+AGGREGATE_NEAREST = 'nearest'
+AGGREGATE_MODE = 'mode'
+
+
+def aggregate_tile(tile, target_dtype=None, discrete=False, nodata=None, method=None):
+    """
+    Halve the resolution of input numpy arrays by aggregating blocks of 2x2
+    pixels. The last two axes are the pixel rows and columns, any leading axes
+    are aggregated in the same call, so that a batch of tiles or bands can be
+    processed at once.
+
+    By default, continuous data is averaged and discrete data takes the value
+    of the nearest pixel, matching the gdal resampling. The mode method returns
+    the most frequent value of each block instead. If a nodata value is given,
+    nodata pixels are ignored and blocks without data are set to nodata.
+    """
+    tile = numpy.asarray(tile)
+    if method is None:
+        method = AGGREGATE_NEAREST if discrete else AGGREGATE_MEAN
+    target_dtype = numpy.dtype(target_dtype or tile.dtype)
+    # Stack the pixels of each 2x2 block on a new last axis. The first pixel is
+    # the one gdal picks for nearest neighbor resampling, the others follow in
+    # order of preference for replacing nodata.
+    blocks = numpy.stack([
+        tile[..., 1::2, 1::2],
+        tile[..., 1::2, ::2],
+        tile[..., ::2, 1::2],
+        tile[..., ::2, ::2],
+    ], axis=-1)
+
+    if method == AGGREGATE_MEAN:
+        if nodata is None:
+            result = blocks.mean(axis=-1)
+        else:
+            valid = blocks != nodata
+            count = valid.sum(axis=-1)
+            total = numpy.where(valid, blocks, 0).sum(axis=-1, dtype='float64')
+            result = numpy.where(count > 0, total / numpy.maximum(count, 1), nodata)
+        # Round half up for integer targets, as gdal does.
+        if target_dtype.kind in 'iu':
+            result = numpy.floor(result + 0.5)
+        return result.astype(target_dtype)
+
+    if method == AGGREGATE_NEAREST:
+        if nodata is None:
+            return blocks[..., 0].astype(target_dtype)
+        # Use the first pixel in order of preference that has data.
+        index = numpy.argmax(blocks != nodata, axis=-1)
+    elif method == AGGREGATE_MODE:
+        # Count the occurrence of each block value within its block. Nodata
+        # values are never selected, unless the block is empty. Ties are
+        # resolved by the order of preference.
+        counts = (blocks[..., :, numpy.newaxis] == blocks[..., numpy.newaxis, :]).sum(axis=-1)
+        if nodata is not None:
+            counts[blocks == nodata] = 0
+        index = numpy.argmax(counts, axis=-1)
+    else:
+        raise ValueError('Unknown aggregation method {}.'.format(method))
+
+    return numpy.take_along_axis(blocks, index[..., numpy.newaxis], axis=-1)[..., 0].astype(target_dtype)
+
+
+def aggregate_tile_gdal(tile, target_dtype=None, discrete=False):
     """
     Use the gdal resampling algorithm to do aggregation of input numpy arrays.
 
     By default, bilinear resampling will be used. If the discrete flag is set,
-    nearest neighbor resampling will be used.
+    nearest neighbor resampling will be used. This is the reference for the
+    aggregate_tile function, used in tests and benchmarks.
     """
     resampling = Resampling.nearest if discrete else Resampling.bilinear
     # Create arbitrary affine. These values do not matter for a simple resampling
@@ -112,6 +184,58 @@ def get_sentinel_tile_indices(sentineltile, zoom=const.ZOOM_LEVEL_10M):
             yield tilex, tiley, zoom
 
 
+def _fetch_tile(layer_id, tilez, tilex, tiley):
+    """
+    Read a single tile from the tile store and decode it into a GDALRaster.
+    Returns None if the tile does not exist or can not be decoded.
+    """
+    # Use the decoded tile if the tile cache is enabled for this job.
+    cache = get_tile_cache()
+    if cache is not None:
+        tile = cache.get((layer_id, tilez, tilex, tiley))
+        if tile is not None:
+            return tile
+    # Resolve known misses without touching the tile store.
+    index = get_tile_index()
+    if index.is_missing(layer_id, tilez, tilex, tiley):
+        return
+    data = get_tile_store().get(tile_key(layer_id, tilez, tilex, tiley))
+    if data is None:
+        index.add_missing(layer_id, tilez, tilex, tiley)
+        return
+    # Convert tile data into a GDALRaster.
+    try:
+        tile = GDALRaster(data)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        return
+    if cache is not None:
+        cache.put((layer_id, tilez, tilex, tiley), tile)
+    return tile
+
+
+def _candidate_zooms(layer_id, tilez, tilex, tiley, look_up):
+    """
+    Yield the zoom levels to probe for a tile. The requested zoom level comes
+    first. If asked for, lower zoom levels are added as source candidates. With
+    the tile index enabled, the ancestor zoom level that holds the tile is added
+    first. The remaining lower zoom levels are probed in turn if the index has
+    no answer or the listed tile is gone, the index might be older than tiles
+    written or removed by other jobs.
+    """
+    yield tilez
+    if not look_up:
+        return
+    zooms = range(tilez - 1, -1, -1)
+    index = get_tile_index()
+    if index.enabled:
+        zoom = index.find_zoom(layer_id, tilez, tilex, tiley, zooms)
+        if zoom is not None:
+            yield zoom
+            zooms = range(zoom - 1, -1, -1)
+    yield from zooms
+
+
 def get_raster_tile(layer_id, tilez, tilex, tiley, look_up=True):
     """
     Bypass the database to fetch files using structured file name scheme. If the
@@ -119,46 +243,17 @@ def get_raster_tile(layer_id, tilez, tilex, tiley, look_up=True):
     level tile is found, it is warped to the requested zoom level. This ensures
     that a tile can be requested at any zoom level.
     """
-    # If asked for, add lower zoom levels as source candidates. Upper tiles are
-    # then down-scaled to the higher zoom levels.
-    if look_up:
-        zoomrange = range(tilez, -1, -1)
-    else:
-        zoomrange = [tilez]
-
-    # Loop through zoom levels to search for a tile
-    for zoom in zoomrange:
+    # Loop through zoom levels to search for a tile. Upper tiles are down-scaled
+    # to the higher zoom levels.
+    for zoom in _candidate_zooms(layer_id, tilez, tilex, tiley, look_up):
 
         # Compute multiplier to find parent raster
         multiplier = 2 ** (tilez - zoom)
 
-        # Get object from s3 if exists. Otherwise continue looking "upwards" to
-        # find higher level tiles.
-        filename = 'tiles/{}/{}/{}/{}.tif'.format(
-            layer_id,
-            zoom,
-            int(tilex / multiplier),
-            int(tiley / multiplier),
-        )
-
-        if hasattr(settings, 'AWS_STORAGE_BUCKET_NAME_MEDIA') and settings.AWS_STORAGE_BUCKET_NAME_MEDIA is not None:
-            s3 = boto3.client('s3')
-            try:
-                tile = s3.get_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME_MEDIA, Key=filename)
-            except s3.exceptions.NoSuchKey:
-                continue
-            tile = tile['Body']
-        else:
-            if default_storage.exists(filename):
-                tile = default_storage.open(filename)
-            else:
-                continue
-
-        # Convert tile data into a GDALRaster.
-        try:
-            tile = GDALRaster(tile.read())
-        except Exception as e:
-            sentry_sdk.capture_exception(e)
+        # Get tile from storage if exists. Otherwise continue looking "upwards"
+        # to find higher level tiles.
+        tile = _fetch_tile(layer_id, zoom, int(tilex / multiplier), int(tiley / multiplier))
+        if tile is None:
             continue
 
         # If the tile is a parent of the original, warp it to the
@@ -180,6 +275,137 @@ def get_raster_tile(layer_id, tilez, tilex, tiley, look_up=True):
         return tile
 
 
+def get_tile_version(layer_id, tilez, tilex, tiley, look_up=True):
+    """
+    Return the version of the tile that get_raster_tile would read for the
+    request, prefixed with the zoom level of the source tile. Returns None if
+    no tile exists. Only the tile metadata is requested from the tile store.
+    """
+    index = get_tile_index()
+    for zoom in _candidate_zooms(layer_id, tilez, tilex, tiley, look_up):
+        multiplier = 2 ** (tilez - zoom)
+        parentx, parenty = int(tilex / multiplier), int(tiley / multiplier)
+        if index.is_missing(layer_id, zoom, parentx, parenty):
+            continue
+        version = get_tile_store().version(tile_key(layer_id, zoom, parentx, parenty))
+        if version is None:
+            index.add_missing(layer_id, zoom, parentx, parenty)
+            continue
+        return '{}/{}'.format(zoom, version)
+
+
+_tile_executor = None
+_tile_executor_pid = None
+_tile_executor_lock = threading.Lock()
+
+
+def _get_tile_executor():
+    """
+    Return the process-wide thread pool used for concurrent tile reads. The
+    pool is re-created in forked processes, where the parent threads are gone.
+    """
+    global _tile_executor, _tile_executor_pid
+    pid = os.getpid()
+    if _tile_executor is None or _tile_executor_pid != pid:
+        with _tile_executor_lock:
+            if _tile_executor is None or _tile_executor_pid != pid:
+                _tile_executor = ThreadPoolExecutor(max_workers=settings.TILE_FETCH_WORKERS, thread_name_prefix='tilefetch')
+                _tile_executor_pid = pid
+    return _tile_executor
+
+
+def get_raster_tiles(requests, look_up=True):
+    """
+    Fetch multiple tiles concurrently on a bounded thread pool. The requests are
+    (layer_id, tilez, tilex, tiley) tuples. Returns a list with the decoded
+    GDALRaster for each request in the order of the requests, with None for
+    tiles that do not exist.
+    """
+    requests = list(requests)
+    # Avoid the thread pool overhead for single tiles.
+    if len(requests) < 2:
+        return [get_raster_tile(*request, look_up=look_up) for request in requests]
+    return list(_get_tile_executor().map(lambda request: get_raster_tile(*request, look_up=look_up), requests))
+
+
+def get_tile_versions(requests, look_up=True):
+    """
+    Get the versions of multiple tiles concurrently on the tile thread pool.
+    The requests are (layer_id, tilez, tilex, tiley) tuples.
+    """
+    requests = list(requests)
+    if len(requests) < 2:
+        return [get_tile_version(*request, look_up=look_up) for request in requests]
+    return list(_get_tile_executor().map(lambda request: get_tile_version(*request, look_up=look_up), requests))
+
+
+def write_raster_tiles(tiles, **kwargs):
+    """
+    Write multiple tiles concurrently on the tile thread pool. The tiles are
+    (layer_id, result, tilez, tilex, tiley) tuples, the keyword arguments are
+    passed to write_raster_tile for all tiles.
+    """
+    tiles = list(tiles)
+    # Avoid the thread pool overhead for single tiles.
+    if len(tiles) < 2:
+        for tile in tiles:
+            write_raster_tile(*tile, **kwargs)
+        return
+    list(_get_tile_executor().map(lambda tile: write_raster_tile(*tile, **kwargs), tiles))
+
+
+class TileWriter(object):
+    """
+    Context manager to write tiles on a background thread pool, so that the
+    encoding and upload of tiles overlaps with the computation of the next
+    tiles. The number of pending writes is bounded to limit memory use, errors
+    of the writes are raised in the calling thread. Without workers, the writes
+    run synchronously.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = settings.TILE_WRITE_WORKERS if workers is None else workers
+        self.max_pending = 2 * self.workers
+        self.executor = None
+        self.pending = deque()
+
+    def __enter__(self):
+        if self.workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tilewrite')
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.executor is None:
+            return
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run a tile writing function in the background.
+        """
+        if self.executor is None:
+            func(*args, **kwargs)
+            return
+        self.pending.append(self.executor.submit(func, *args, **kwargs))
+        # Raise errors of finished writes early and wait for the oldest writes
+        # if too many are pending.
+        while self.pending and (len(self.pending) > self.max_pending or self.pending[0].done()):
+            self.pending.popleft().result()
+
+    def wait(self):
+        """
+        Wait for all pending writes to finish.
+        """
+        while self.pending:
+            self.pending.popleft().result()
+
+
 def write_raster_tile(layer_id, result, tilez, tilex, tiley, nodata_value=const.SENTINEL_NODATA_VALUE, datatype=2, merge_with_existing=True, nr_of_bands=1):
     """
     Commit a rastertile into the DB and storage.
@@ -190,23 +416,6 @@ def write_raster_tile(layer_id, result, tilez, tilex, tiley, nodata_value=const.
     # Compute bounds and scale for the target tile.
     bounds = tile_bounds(tilex, tiley, tilez)
     scale = tile_scale(tilez)
-    filename = 'tiles/{}/{}/{}/{}.tif'.format(layer_id, tilez, tilex, tiley)
-
-    # Instantiate target GDALRaster dict.
-    result_dict = {
-        'name': '/vsimem/{}'.format(uuid.uuid4()),
-        'driver': 'tif',
-        'origin': (bounds[0], bounds[3]),
-        'width': WEB_MERCATOR_TILESIZE,
-        'height': WEB_MERCATOR_TILESIZE,
-        'scale': [scale, -scale],
-        'srid': WEB_MERCATOR_SRID,
-        'datatype': datatype,
-        'papsz_options': {
-            'compress': 'deflate',
-            'predictor': 2,
-        },
-    }
 
     # Try getting tile from S3.
     if merge_with_existing:
@@ -225,23 +434,182 @@ def write_raster_tile(layer_id, result, tilez, tilex, tiley, nodata_value=const.
             result_nodata = result == nodata_value
             result[result_nodata] = current[result_nodata]
 
-    # Add result to target dictionary.
+    # Encode the tile.
     if nr_of_bands > 1:
-        for index in range(nr_of_bands):
-            result_dict['bands'] = [{'nodata_value': None, 'data': result[index]} for index in range(nr_of_bands)]
-    else:
-        result_dict['bands'] = [{'nodata_value': nodata_value, 'data': result}]
-
-    # Instanciate GDALRaster.
-    dest = GDALRaster(result_dict)
-    # Convert GDALRaster to file-like object.
-    dest = io.BytesIO(dest.vsi_buffer)
-    # Upload merged tile to s3.
-    if hasattr(settings, 'AWS_STORAGE_BUCKET_NAME_MEDIA') and settings.AWS_STORAGE_BUCKET_NAME_MEDIA is not None:
-        s3 = boto3.client('s3')
-        s3.upload_fileobj(dest, settings.AWS_STORAGE_BUCKET_NAME_MEDIA, filename)
+        data = get_tile_encoder().encode([result[index] for index in range(nr_of_bands)], (bounds[0], bounds[3]), scale, datatype)
     else:
-        default_storage.save(filename)
+        data = get_tile_encoder().encode([result], (bounds[0], bounds[3]), scale, datatype, nodata_value)
+    # Upload merged tile to the tile store.
+    get_tile_store().put(tile_key(layer_id, tilez, tilex, tiley), data)
+    get_tile_index().add(layer_id, tilez, tilex, tiley)
+    cache = get_tile_cache()
+    if cache is not None:
+        cache.invalidate((layer_id, tilez, tilex, tiley))
+
+
+class TileMosaic(object):
+    """
+    Full resolution mosaic of all tiles within a parent tile, with one memory
+    mapped array per band stored in a temporary directory. This allows building
+    the pyramid of the parent tile without reading the tiles back from storage.
+
+    The band arrays are created under a lock, so tiles of different bands can
+    be added from multiple threads.
+    """
+
+    def __init__(self, tilex, tiley, tilez, zoom, bands):
+        """
+        The bands argument is a dictionary with the numpy dtype and the nodata
+        value for each band name.
+        """
+        self.tilex = tilex
+        self.tiley = tiley
+        self.tilez = tilez
+        self.zoom = zoom
+        self.bands = bands
+        # Number of tiles along each side of the mosaic and its tile offset.
+        self.size = 2 ** (zoom - tilez)
+        self.xmin = tilex * self.size
+        self.ymin = tiley * self.size
+        self.filled = set()
+        self._arrays = {}
+        self._lock = threading.Lock()
+        self._tmpdir = tempfile.mkdtemp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._arrays = {}
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def array(self, band):
+        """
+        Return the mosaic array of a band, created as nodata on first access.
+        """
+        with self._lock:
+            if band not in self._arrays:
+                dtype, nodata_value = self.bands[band]
+                # The file name is the position of the band, which is unique.
+                array = numpy.memmap(
+                    os.path.join(self._tmpdir, '{}.dat'.format(list(self.bands).index(band))),
+                    dtype=dtype,
+                    mode='w+',
+                    shape=(self.size * WEB_MERCATOR_TILESIZE, self.size * WEB_MERCATOR_TILESIZE),
+                )
+                # New memory maps are filled with zeros.
+                if nodata_value:
+                    array[:] = nodata_value
+                self._arrays[band] = array
+            return self._arrays[band]
+
+    def add(self, band, tilex, tiley, data):
+        """
+        Place the data of a tile in the mosaic, tiles outside of the mosaic are
+        ignored.
+        """
+        col = tilex - self.xmin
+        row = tiley - self.ymin
+        if not (0 <= col < self.size and 0 <= row < self.size):
+            return
+        self.array(band)[
+            row * WEB_MERCATOR_TILESIZE:(row + 1) * WEB_MERCATOR_TILESIZE,
+            col * WEB_MERCATOR_TILESIZE:(col + 1) * WEB_MERCATOR_TILESIZE,
+        ] = data.reshape(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)
+        with self._lock:
+            self.filled.add(band)
+
+
+class TileRasterizer(object):
+    """
+    Rasterize multiple geometries tile by tile.
+
+    The geometries over a tile are burned in a single pass, using their
+    position in the geometry list as label, and the pixels are split by label.
+    Geometries that might share pixels are burned in separate passes, so that
+    overlapping geometries keep all their pixels.
+    """
+
+    def __init__(self, geoms, tilez, all_touched):
+        """
+        The geometries are expected in the web mercator projection.
+        """
+        self.geoms = geoms
+        self.tilez = tilez
+        self.all_touched = all_touched
+        self.shapes = [json.loads(geom.json) for geom in geoms]
+        # Index of the geometries that intersect with each tile extent.
+        self.tile_geoms = {}
+        for index, geom in enumerate(geoms):
+            idx = tile_index_range(geom.extent, tilez)
+            for tilex in range(idx[0], idx[2] + 1):
+                for tiley in range(idx[1], idx[3] + 1):
+                    self.tile_geoms.setdefault((tilex, tiley), []).append(index)
+        self._pixels = {}
+
+    def tiles(self):
+        """
+        Return the (tilex, tiley) indices of all tiles touched by the geometry
+        extents, ordered by tilex and tiley.
+        """
+        return sorted(self.tile_geoms)
+
+    def burn(self, tilex, tiley):
+        """
+        Return a dictionary with the flat indices of the pixels covered by each
+        geometry in the tile, in ascending order.
+        """
+        bounds = tile_bounds(tilex, tiley, self.tilez)
+        scale = tile_scale(self.tilez)
+        transform = Affine(scale, 0, bounds[0], 0, -scale, bounds[3])
+        # Group the geometries into layers where the pixel extents, buffered by
+        # one pixel, do not overlap.
+        layers = []
+        for index in self.tile_geoms.get((tilex, tiley), []):
+            xmin, ymin, xmax, ymax = self.geoms[index].extent
+            window = (
+                slice(max(0, int((bounds[3] - ymax) // scale) - 1), max(0, int((bounds[3] - ymin) // scale) + 2)),
+                slice(max(0, int((xmin - bounds[0]) // scale) - 1), max(0, int((xmax - bounds[0]) // scale) + 2)),
+            )
+            for occupied, members in layers:
+                if not occupied[window].any():
+                    break
+            else:
+                occupied = numpy.zeros((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), dtype='bool')
+                members = []
+                layers.append((occupied, members))
+            occupied[window] = True
+            members.append(index)
+
+        pixels = {}
+        for occupied, members in layers:
+            labels = rasterize_shapes(
+                [(self.shapes[index], index + 1) for index in members],
+                out_shape=(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE),
+                transform=transform,
+                all_touched=self.all_touched,
+                dtype='uint32',
+            ).ravel()
+            # Split the pixel indices by label, the stable sort keeps the
+            # pixels of each label in ascending order.
+            order = numpy.argsort(labels, kind='stable')
+            sorted_labels = labels[order]
+            for index in members:
+                start, end = numpy.searchsorted(sorted_labels, [index + 1, index + 2])
+                pixels[index] = order[start:end]
+        return pixels
+
+    def pixels(self, index, tilex, tiley):
+        """
+        Return the flat pixel indices of one geometry in a tile. The burned
+        tiles are kept, so that each tile is only rasterized once.
+        """
+        if (tilex, tiley) not in self._pixels:
+            self._pixels[(tilex, tiley)] = self.burn(tilex, tiley)
+        return self._pixels[(tilex, tiley)].get(index, numpy.empty(0, dtype='int64'))
 
 
 def populate_raster_metadata(raster):
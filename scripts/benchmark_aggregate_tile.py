@@ -0,0 +1,62 @@
+"""
+Compare the gdal based tile aggregation against the numpy block aggregation.
+
+Usage:
+
+    python scripts/benchmark_aggregate_tile.py [--count 200] [--batch 13]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps'))
+
+from sentinel.utils import AGGREGATE_MODE, aggregate_tile, aggregate_tile_gdal  # noqa: E402
+
+
+def time_calls(count, func):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    print('{:<16} n={:<5} mean={:7.2f}ms median={:7.2f}ms p95={:7.2f}ms'.format(
+        label,
+        len(timings),
+        1000 * statistics.mean(timings),
+        1000 * statistics.median(timings),
+        1000 * timings[int(0.95 * (len(timings) - 1))],
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=13)
+    args = parser.parse_args()
+
+    tile = numpy.random.randint(0, 10000, (512, 512)).astype('uint16')
+    tiles = numpy.random.randint(0, 10000, (args.batch, 512, 512)).astype('uint16')
+    classes = numpy.random.randint(0, 12, (512, 512)).astype('uint8')
+
+    report('gdal bilinear', time_calls(args.count, lambda: aggregate_tile_gdal(tile)))
+    report('numpy mean', time_calls(args.count, lambda: aggregate_tile(tile, nodata=0)))
+    report('gdal nearest', time_calls(args.count, lambda: aggregate_tile_gdal(classes, discrete=True)))
+    report('numpy nearest', time_calls(args.count, lambda: aggregate_tile(classes, discrete=True, nodata=0)))
+    report('numpy mode', time_calls(args.count, lambda: aggregate_tile(classes, nodata=0, method=AGGREGATE_MODE)))
+    # Per band time when aggregating a batch of bands in one call.
+    timings = time_calls(args.count, lambda: aggregate_tile(tiles, nodata=0))
+    report('numpy batch/band', [timing / args.batch for timing in timings])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Compare the time to build the max zoom level tiles of a composite tile with
+process_compositetile_s2 for different numbers of composite workers.
+
+The composite tile is the one of the test fixtures. The scene tiles are
+synthetic stacks instead of reads from the tile store, the pixel selection,
+tile writer and mosaic run as in the composite jobs. The tiles are written to
+a temporary media root.
+
+Usage:
+
+    python scripts/benchmark_composite_pool.py [--scenes 8] [--workers 1 2 4] [--write-workers 8]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+from unittest.mock import patch
+
+import django
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tesselo.settings')
+django.setup()
+
+from django.test import override_settings  # noqa: E402
+from raster.tiles.utils import tile_index_range  # noqa: E402
+
+from sentinel import const  # noqa: E402
+from sentinel.clouds.utils import stack_array  # noqa: E402
+from sentinel.tasks import composite_band_spec, process_compositetile_s2  # noqa: E402
+from sentinel.utils import TileMosaic  # noqa: E402
+
+# A point within the composite tile of the test fixtures.
+FIXTURE_POINT = (11843687, -458452)
+
+
+def make_stacks(scenes):
+    stacks = []
+    for i in range(scenes):
+        stack = {key: numpy.random.randint(1, 10000, (256, 256)).astype('uint16') for key in const.ALL_BANDS}
+        stack[const.SCL] = numpy.random.randint(0, 12, (256, 256)).astype('uint8')
+        stacks.append(stack)
+    return stacks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenes', type=int, default=8)
+    parser.add_argument('--version', type=int, default=7)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--write-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    tilex, tiley = tile_index_range(FIXTURE_POINT * 2, const.ZOOM_LEVEL_WORLDLAYER)[:2]
+    ctile = types.SimpleNamespace(
+        tilex=tilex,
+        tiley=tiley,
+        tilez=const.ZOOM_LEVEL_WORLDLAYER,
+        cloud_classifier=None,
+        cloud_version=args.version,
+        get_version_string=lambda: 'Version {}'.format(args.version),
+        write=lambda *messages: None,
+    )
+    rasterlayer_lookup = {band: index for index, band in enumerate(const.ALL_BANDS)}
+    bands = {band: composite_band_spec(band)[:2] for band in rasterlayer_lookup}
+
+    # Reuse a small set of stacks to keep the fixture memory bounded.
+    fixtures = [stack_array(make_stacks(args.scenes)) for i in range(4)]
+    size = 2 ** (const.ZOOM_LEVEL_10M - const.ZOOM_LEVEL_WORLDLAYER)
+    tiles = [(x, y) for x in range(tilex * size, (tilex + 1) * size) for y in range(tiley * size, (tiley + 1) * size)]
+
+    def compositetile_stacks(ctile):
+        for index, (x, y) in enumerate(tiles):
+            yield x, y, fixtures[index % len(fixtures)]
+
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as root:
+            with override_settings(MEDIA_ROOT=root, COMPOSITE_WORKERS=workers, TILE_WRITE_WORKERS=args.write_workers):
+                with patch('sentinel.tasks.compositetile_stacks', compositetile_stacks):
+                    with TileMosaic(ctile.tilex, ctile.tiley, ctile.tilez, const.ZOOM_LEVEL_10M, bands) as mosaic:
+                        start = time.perf_counter()
+                        process_compositetile_s2(ctile, rasterlayer_lookup, mosaic)
+                        duration = time.perf_counter() - start
+        print('workers={:<3} tiles={:<5} total={:8.2f}s per tile={:7.2f}ms'.format(workers, len(tiles), duration, 1000 * duration / len(tiles)))
+
+
+if __name__ == '__main__':
+    main()
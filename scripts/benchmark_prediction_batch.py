@@ -0,0 +1,77 @@
+"""
+Compare the prediction throughput in tiles per second for different numbers
+of tiles per predict call, using a classifier fitted on synthetic pixels.
+
+Usage:
+
+    python scripts/benchmark_prediction_batch.py [--tiles 64] [--batch-sizes 1 4 8 16 32] [--model keras] [--keras-batch-size 65536]
+"""
+import argparse
+import time
+
+import numpy
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import RobustScaler
+
+# Number of pixels in a tile.
+TILE_PIXELS = 256 * 256
+
+MODELS = {
+    'rf': lambda: RandomForestClassifier(n_estimators=20, max_depth=12),
+    'mlp': lambda: MLPClassifier(hidden_layer_sizes=(64, 32), max_iter=20),
+}
+
+
+def fit_model(model, bands):
+    X = numpy.random.randint(0, 10000, (20000, bands)).astype('uint16')
+    Y = (X[:, 0] > X[:, 1]).astype('uint8') + (X[:, 2] > 5000).astype('uint8') + 1
+    if model == 'keras':
+        # Tensorflow is only imported when used.
+        from tensorflow.keras.layers import Dense
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.utils import to_categorical
+        clf = Sequential([Dense(64, input_shape=(bands, ), activation='relu'), Dense(3, activation='softmax')])
+        clf.compile(optimizer='adam', loss='categorical_crossentropy')
+        clf.fit(X.astype('float16'), to_categorical(Y - 1), epochs=1, verbose=0)
+        return clf
+    return Pipeline([('scaler', RobustScaler()), ('estimator', MODELS[model]())]).fit(X, Y)
+
+
+def predict_batches(clf, tiles, batch_size, keras_batch_size=TILE_PIXELS):
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        data = numpy.concatenate(batch)
+        # TF keras cant handle unit16, and predicts 32 pixels per batch by
+        # default.
+        predict_kwargs = {}
+        if not isinstance(clf, Pipeline):
+            data = data.astype('float16')
+            predict_kwargs['batch_size'] = keras_batch_size
+        predicted = clf.predict(data, **predict_kwargs)
+        # Split the prediction into the tiles.
+        [predicted[index * TILE_PIXELS:(index + 1) * TILE_PIXELS] for index in range(len(batch))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tiles', type=int, default=64)
+    parser.add_argument('--bands', type=int, default=10)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--model', choices=sorted(MODELS) + ['keras'], default='rf')
+    parser.add_argument('--keras-batch-size', type=int, default=TILE_PIXELS, help='Pixels per Keras predict batch.')
+    args = parser.parse_args()
+
+    clf = fit_model(args.model, args.bands)
+    tiles = [numpy.random.randint(0, 10000, (TILE_PIXELS, args.bands)).astype('uint16') for i in range(args.tiles)]
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        predict_batches(clf, tiles, batch_size, args.keras_batch_size)
+        duration = time.perf_counter() - start
+        print('batch size={:<4} total={:7.2f}s {:7.2f} tiles per second'.format(batch_size, duration, args.tiles / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare the tile encoders and codecs by throughput and compressed tile size.
+
+The tiles are read from a directory with GeoTIFF tiles, for instance a layer
+folder of the local tile store. Without a directory, synthetic tiles are used.
+
+Usage:
+
+    python scripts/benchmark_tile_encoder.py [--path /tesselo_media/tiles/23/14] [--count 200]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps'))
+
+from django.contrib.gis.gdal import GDALRaster  # noqa: E402
+from sentinel.tileencoder import GDALTileEncoder, TiffTileEncoder  # noqa: E402
+
+# Labels, encoder classes, codecs and compression levels to compare.
+CONFIGURATIONS = (
+    ('gdal', GDALTileEncoder, 'deflate', 6),
+    ('gdal', GDALTileEncoder, 'deflate', 1),
+    ('gdal', GDALTileEncoder, 'zstd', 3),
+    ('gdal', GDALTileEncoder, 'zstd', 9),
+    ('gdal', GDALTileEncoder, 'lzw', None),
+    ('tiff', TiffTileEncoder, 'deflate', 6),
+    ('tiff', TiffTileEncoder, 'deflate', 1),
+    ('tiff', TiffTileEncoder, 'zstd', 3),
+    ('tiff', TiffTileEncoder, 'zstd', 9),
+)
+
+# GDAL datatypes of the numpy dtypes.
+DATATYPES = {
+    'uint8': 1,
+    'uint16': 2,
+    'int16': 3,
+    'float32': 6,
+}
+
+
+def load_tiles(path, count):
+    tiles = []
+    for filename in sorted(glob.glob(os.path.join(path, '**', '*.tif'), recursive=True))[:count]:
+        band = GDALRaster(filename).bands[0]
+        tiles.append((band.data(), band.nodata_value))
+    return tiles
+
+
+def synthetic_tiles(count):
+    # Smooth reflectance values, similar to the composite bands.
+    tiles = []
+    for i in range(count):
+        data = numpy.cumsum(numpy.random.randint(-20, 21, (256, 256)), axis=1) + 3000
+        tiles.append((numpy.clip(data, 1, 10000).astype('uint16'), 0))
+    return tiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', help='Directory with GeoTIFF tiles.')
+    parser.add_argument('--count', type=int, default=200)
+    args = parser.parse_args()
+
+    tiles = load_tiles(args.path, args.count) if args.path else synthetic_tiles(args.count)
+    raw_bytes = sum(data.nbytes for data, nodata in tiles)
+    origin = (-20037508.342789244, 20037508.342789244)
+
+    for label, encoder_class, codec, level in CONFIGURATIONS:
+        try:
+            encoder = encoder_class(codec, level)
+        except ImportError as exc:
+            print('{:<8} {:<8} {:<6} skipped: {}'.format(label, codec, str(level), exc))
+            continue
+        encoded_bytes = 0
+        start = time.perf_counter()
+        for data, nodata in tiles:
+            encoded_bytes += len(encoder.encode([data], origin, 10, DATATYPES[data.dtype.name], nodata))
+        duration = time.perf_counter() - start
+        print('{:<8} {:<8} {:<6} {:8.1f} MB/s {:9.0f} bytes/tile {:6.1f}% of raw'.format(
+            label,
+            codec,
+            str(level),
+            raw_bytes / duration / 1024 ** 2,
+            encoded_bytes / len(tiles),
+            100 * encoded_bytes / raw_bytes,
+        ))
+
+
+if __name__ == '__main__':
+    main()
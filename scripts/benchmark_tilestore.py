@@ -0,0 +1,72 @@
+"""
+Compare per-tile read latency of a fresh boto3 client per request against the
+pooled tile store client.
+
+Usage:
+
+    python scripts/benchmark_tilestore.py <bucket> <prefix> [--count 200]
+
+The prefix should point to a folder with existing tiles, for instance
+tiles/1234/14/.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import boto3
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps'))
+
+from sentinel.tilestore import S3TileStore  # noqa: E402
+
+
+def time_reads(keys, read):
+    timings = []
+    for key in keys:
+        start = time.perf_counter()
+        read(key)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    print('{:<12} n={:<5} mean={:7.1f}ms median={:7.1f}ms p95={:7.1f}ms'.format(
+        label,
+        len(timings),
+        1000 * statistics.mean(timings),
+        1000 * statistics.median(timings),
+        1000 * timings[int(0.95 * (len(timings) - 1))],
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('bucket')
+    parser.add_argument('prefix')
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--pool', type=int, default=50)
+    args = parser.parse_args()
+
+    store = S3TileStore(args.bucket, max_pool_connections=args.pool)
+    keys = []
+    for key in store.list(args.prefix):
+        keys.append(key)
+        if len(keys) == args.count:
+            break
+    if not keys:
+        raise ValueError('No tiles found under prefix {}.'.format(args.prefix))
+
+    def read_unpooled(key):
+        # Previous behaviour, one client per tile read.
+        s3 = boto3.client('s3')
+        s3.get_object(Bucket=args.bucket, Key=key)['Body'].read()
+
+    report('unpooled', time_reads(keys, read_unpooled))
+    report('tilestore', time_reads(keys, store.get))
+
+
+if __name__ == '__main__':
+    main()
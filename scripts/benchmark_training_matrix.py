@@ -0,0 +1,87 @@
+"""
+Compare collecting training pixels by stacking arrays after every sample with
+the chunked training matrix accumulator, for synthetic training samples.
+
+Usage:
+
+    python scripts/benchmark_training_matrix.py [--samples 1000 2000 5000 10000] [--stack-max 2000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps'))
+
+from classify.utils import TrainingMatrixAccumulator  # noqa: E402
+
+
+def sample_chunks(count, bands):
+    # Polygons covering between 50 and 500 pixels.
+    for index in range(count):
+        rows = numpy.random.randint(50, 500)
+        yield (
+            numpy.random.randint(0, 10000, (rows, bands)).astype('uint16'),
+            numpy.full(rows, index % 10, dtype='uint8'),
+            numpy.arange(rows, dtype='int64'),
+            numpy.full(rows, index, dtype='int64'),
+        )
+
+
+def collect_stack(chunks, bands):
+    X = numpy.empty(shape=(0, bands), dtype='uint16')
+    Y = numpy.empty(shape=(0, ), dtype='uint8')
+    PID = numpy.empty(shape=(0, ), dtype='int64')
+    SID = numpy.empty(shape=(0, ), dtype='int64')
+    for Xh, Yh, PIDh, SIDh in chunks:
+        Y = numpy.hstack([Yh, Y])
+        X = numpy.vstack([Xh, X])
+        PID = numpy.hstack([PIDh, PID])
+        SID = numpy.hstack([SIDh, SID])
+    return X, Y, PID, SID
+
+
+def collect_accumulator(chunks, bands, spill_bytes=None):
+    matrix = TrainingMatrixAccumulator([('uint16', (bands, )), ('uint8', ()), ('int64', ()), ('int64', ())], spill_bytes=spill_bytes)
+    for chunk in chunks:
+        matrix.append(*chunk)
+    return matrix.arrays(reverse=True)
+
+
+def measure(label, count, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<12} samples={:<6} rows={:<9} total={:8.2f}s per sample={:7.3f}ms peak={:8.1f}MB'.format(
+        label,
+        count,
+        len(result[1]),
+        duration,
+        1000 * duration / count,
+        peak / 1024 ** 2,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, nargs='+', default=[1000, 2000, 5000, 10000])
+    parser.add_argument('--bands', type=int, default=10)
+    parser.add_argument('--stack-max', type=int, default=2000, help='Largest sample count for the stacking approach.')
+    parser.add_argument('--spill-bytes', type=int, default=64 * 1024 ** 2)
+    args = parser.parse_args()
+
+    for count in args.samples:
+        if count <= args.stack_max:
+            measure('stack', count, lambda: collect_stack(sample_chunks(count, args.bands), args.bands))
+        measure('accumulator', count, lambda: collect_accumulator(sample_chunks(count, args.bands), args.bands))
+        measure('spilled', count, lambda: collect_accumulator(sample_chunks(count, args.bands), args.bands, args.spill_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/dev/ref/settings/
 """
 import glob
 import os
+import tempfile
 
 import sentry_sdk
 import structlog
@@ -249,6 +250,75 @@ if 'AWS_STORAGE_BUCKET_NAME_MEDIA' in os.environ:
 else:
     MEDIA_ROOT = '/tesselo_media'
 
+# Size of the connection pool of the shared S3 client used for tile reads and
+# writes.
+TILE_STORE_MAX_POOL_CONNECTIONS = int(os.environ.get('TILE_STORE_MAX_POOL_CONNECTIONS', 50))
+
+# Number of threads used for concurrent tile reads, should not exceed the
+# connection pool size.
+TILE_FETCH_WORKERS = int(os.environ.get('TILE_FETCH_WORKERS', 32))
+
+# Time to live in seconds of the in-process tile existence index, which caches
+# tile misses and the tile columns listed at ancestor zoom levels. The index is
+# only enabled for the duration of tile processing jobs. Set to zero to disable
+# the index.
+TILE_INDEX_TTL = int(os.environ.get('TILE_INDEX_TTL', 300))
+
+# Maximum number of tile misses held by the tile existence index.
+TILE_INDEX_MAX_MISSING = int(os.environ.get('TILE_INDEX_MAX_MISSING', 100000))
+
+# Maximum size in bytes of the decoded tile cache, which is enabled for the
+# duration of tile processing jobs.
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+
+# Fetch the scene tiles for the next 20m tile of a composite tile in the
+# background while the current 20m tile is processed.
+COMPOSITE_STACK_PREFETCH = os.environ.get('COMPOSITE_STACK_PREFETCH', 'True') == 'True'
+
+# Fetch the tiles for the next prediction batch in the background while the
+# current batch is predicted.
+PREDICTION_PREFETCH = os.environ.get('PREDICTION_PREFETCH', 'True') == 'True'
+
+# Number of pixels per batch when predicting with Keras models, the Keras
+# default of 32 pixels is far too small for predicting full tiles.
+PREDICTION_KERAS_BATCH_SIZE = int(os.environ.get('PREDICTION_KERAS_BATCH_SIZE', 256 * 256))
+
+# Number of threads building the tiles of a pyramid level of predicted layers
+# concurrently. With a single worker, the tiles are built sequentially.
+PYRAMID_WORKERS = int(os.environ.get('PYRAMID_WORKERS', 4))
+
+# Number of processes for the S2 pixel selection when building composite tiles.
+# With a single worker, the selection runs in the main process.
+COMPOSITE_WORKERS = int(os.environ.get('COMPOSITE_WORKERS', 1))
+
+# Encoder for raster tiles, either "gdal" or "tiff" for the direct GeoTIFF
+# writer. The codec is one of "deflate", "zstd" or "lzw", the tiff encoder
+# supports deflate and zstd. Without a level, the GDAL default of the codec is
+# used.
+TILE_ENCODER = os.environ.get('TILE_ENCODER', 'gdal')
+TILE_CODEC = os.environ.get('TILE_CODEC', 'deflate')
+TILE_CODEC_LEVEL = int(os.environ['TILE_CODEC_LEVEL']) if 'TILE_CODEC_LEVEL' in os.environ else None
+
+# Number of threads used to encode and upload tiles in the background while
+# processing jobs compute the next tiles. Set to zero to write synchronously.
+TILE_WRITE_WORKERS = int(os.environ.get('TILE_WRITE_WORKERS', 8))
+
+# Size in bytes above which collected training pixels are spilled to
+# temporary files on disk.
+TRAINING_MATRIX_SPILL_BYTES = int(os.environ.get('TRAINING_MATRIX_SPILL_BYTES', 4 * 1024 ** 3))
+
+# Directory of the local trained model cache, keyed by the model checksum.
+# Workers on the same host load the model files from there instead of
+# downloading them. Set to an empty string to disable.
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'tesselo_models'))
+
+# Number of trained models kept in memory per process.
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 2))
+
+# Number of report aggregations that are stored together with their
+# valuecounts in one transaction with bulk queries.
+REPORT_WRITE_BATCH_SIZE = int(os.environ.get('REPORT_WRITE_BATCH_SIZE', 500))
+
 # Rest framework settings.
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
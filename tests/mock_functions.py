@@ -195,10 +195,41 @@ def patch_get_raster_tile(layer_id, tilez, tilex, tiley, data_max=None, look_up=
     })
 
 
+def patch_get_raster_tiles_seeded(requests, look_up=True):
+    """
+    Tiles with pixel values seeded by the tile request, without database access
+    so that they can be fetched from background threads.
+    """
+    tiles = []
+    for layer_id, tilez, tilex, tiley in requests:
+        state = numpy.random.RandomState(abs(hash((layer_id, tilez, tilex, tiley))) % 2 ** 32)
+        bounds = tile_bounds(tilex, tiley, tilez)
+        tiles.append(GDALRaster({
+            'width': WEB_MERCATOR_TILESIZE,
+            'height': WEB_MERCATOR_TILESIZE,
+            'origin': (bounds[0], bounds[3]),
+            'scale': (tile_scale(tilez), -tile_scale(tilez)),
+            'srid': WEB_MERCATOR_SRID,
+            'datatype': 2,
+            'bands': [
+                {'nodata_value': 0, 'data': state.randint(1, 10000, (WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE)).astype('int16')},
+            ],
+        }))
+    return tiles
+
+
 def patch_get_raster_tile_range_100(layer_id, tilez, tilex, tiley, look_up=True):
     return patch_get_raster_tile(layer_id, tilez, tilex, tiley, data_max=100)
 
 
+def patch_get_raster_tiles(requests, look_up=True):
+    return [patch_get_raster_tile(*request, look_up=look_up) for request in requests]
+
+
+def patch_get_raster_tiles_range_100(requests, look_up=True):
+    return [patch_get_raster_tile_range_100(*request, look_up=look_up) for request in requests]
+
+
 def patch_write_raster_tile(layer_id, result, tilez, tilex, tiley, nodata_value=const.SENTINEL_NODATA_VALUE, datatype=2, merge_with_existing=False, nr_of_bands=1):
     # Convert data to file-like object and store.
     result_dict = {
@@ -231,6 +262,11 @@ def patch_write_raster_tile(layer_id, result, tilez, tilex, tiley, nodata_value=
     )
 
 
+def patch_write_raster_tiles(tiles, **kwargs):
+    for tile in tiles:
+        patch_write_raster_tile(*tile, **kwargs)
+
+
 def patch_process_l2a(stile_id):
     # Get sentineltile.
     stile = SentinelTile.objects.get(id=stile_id)
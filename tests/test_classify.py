@@ -8,8 +8,11 @@ import dateutil
 import numpy
 from django.contrib.auth.models import User
 from django.contrib.gis.gdal import GDALRaster, OGRGeometry
+from django.contrib.gis.geos import GEOSGeometry
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from raster.rasterize import rasterize
+from raster.tiles.utils import tile_bounds, tile_scale
 from raster_aggregation.models import AggregationArea, AggregationLayer
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.neural_network import MLPClassifier, MLPRegressor
@@ -20,23 +23,29 @@ from tensorflow.keras.layers import GRU, BatchNormalization, Dense, Dropout
 from tensorflow.keras.models import Model, Sequential
 from tensorflow.keras.wrappers.scikit_learn import KerasClassifier
 from tests.mock_functions import (
-    client_get_object, iterator_search, patch_get_raster_tile, patch_process_l2a, patch_write_raster_tile,
-    point_to_test_file
+    client_get_object, iterator_search, patch_get_raster_tile, patch_get_raster_tiles, patch_process_l2a,
+    patch_write_raster_tile, patch_write_raster_tiles, point_to_test_file
 )
 
+from classify.collectpixels import combine_trainingpixels_patches
 from classify.const import (
     KERAS_JSON_MALFORMED_ERROR_MSG, KERAS_LAST_LAYER_NOT_DENSE_ERROR_MSG, KERAS_LAST_LAYER_UNITS_ERROR_MSG_TMPL,
     KERAS_MIN_ONE_LAYER_ERROR_MSG, PREDICTION_CONFIG_ERROR_MSG, SIEVE_CONIFG_ERROR_MSG, TP_MSG_NOT_FINISHED,
     TP_MSG_REGRESSOR, VALUE_CONFIG_ERROR_MSG
 )
+from classify.dataset import TrainingDataset, open_training_dataset
 from classify.models import (
     Classifier, PredictedLayer, PredictedLayerChunk, TrainingLayer, TrainingPixels, TrainingPixelsPatch,
     TrainingSample
 )
-from classify.tasks import predict_sentinel_layer, train_sentinel_classifier
-from classify.utils import RNNRobustScaler
+from classify.tasks import (
+    get_aggregationlayer_tile_indices, get_aggregationlayer_tile_manifest, get_tile_manifest_blocks, pack_tile_manifest_blocks,
+    predict_sentinel_layer, read_array_file, read_prediction_tile_manifest, train_sentinel_classifier
+)
+from classify.utils import PixelSequence, RNNRobustScaler, TrainingMatrixAccumulator
 from jobs import ecs
 from sentinel.models import Composite, MGRSTile, SentinelTile
+from sentinel.utils import TileRasterizer
 
 MEDIA_ROOT = tempfile.mkdtemp()
 
@@ -45,12 +54,14 @@ MEDIA_ROOT = tempfile.mkdtemp()
 @patch('sentinel.tasks.boto3.session.Session.client', client_get_object)
 @patch('raster.tiles.parser.urlretrieve', point_to_test_file)
 @patch('sentinel.tasks.get_raster_tile', patch_get_raster_tile)
+@patch('sentinel.tasks.get_raster_tiles', patch_get_raster_tiles)
 @patch('sentinel.tasks.write_raster_tile', patch_write_raster_tile)
-@patch('classify.tasks.get_raster_tile', patch_get_raster_tile)
+@patch('sentinel.tasks.write_raster_tiles', patch_write_raster_tiles)
+@patch('classify.tasks.get_raster_tiles', patch_get_raster_tiles)
 @patch('classify.tasks.write_raster_tile', patch_write_raster_tile)
-@patch('classify.collectpixels.get_raster_tile', patch_get_raster_tile)
+@patch('classify.collectpixels.get_raster_tiles', patch_get_raster_tiles)
 @patch('jobs.ecs.process_l2a', patch_process_l2a)
-@override_settings(CELERY_TASK_ALWAYS_EAGER=True, LOCAL=True, MEDIA_ROOT=MEDIA_ROOT)
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, LOCAL=True, MEDIA_ROOT=MEDIA_ROOT, COMPOSITE_STACK_PREFETCH=False, TILE_WRITE_WORKERS=0, PREDICTION_PREFETCH=False, PYRAMID_WORKERS=0)
 class SentinelClassifierTest(TestCase):
 
     @classmethod
@@ -63,10 +74,12 @@ class SentinelClassifierTest(TestCase):
             patch('sentinel.tasks.boto3.session.Session.client', client_get_object),
             patch('raster.tiles.parser.urlretrieve', point_to_test_file),
             patch('sentinel.tasks.get_raster_tile', patch_get_raster_tile),
+            patch('sentinel.tasks.get_raster_tiles', patch_get_raster_tiles),
             patch('sentinel.tasks.write_raster_tile', patch_write_raster_tile),
-            patch('classify.tasks.get_raster_tile', patch_get_raster_tile),
+            patch('sentinel.tasks.write_raster_tiles', patch_write_raster_tiles),
+            patch('classify.tasks.get_raster_tiles', patch_get_raster_tiles),
             patch('classify.tasks.write_raster_tile', patch_write_raster_tile),
-            patch('classify.collectpixels.get_raster_tile', patch_get_raster_tile),
+            patch('classify.collectpixels.get_raster_tiles', patch_get_raster_tiles),
             patch('jobs.ecs.process_l2a', patch_process_l2a),
         ]
         for mock in mocks:
@@ -207,6 +220,15 @@ class SentinelClassifierTest(TestCase):
         # Classifier training on pixels was successful.
         self.assertEqual(self.clf.status, self.clf.FINISHED)
         self.assertTrue(isinstance(self.clf.clf, Pipeline))
+        # The trained model is cached by checksum and reused across instances.
+        self.assertEqual(len(self.clf.trained_checksum), 64)
+        self.assertIs(Classifier.objects.get(id=self.clf.id).clf, self.clf.clf)
+        # The checksum of classifiers trained before checksums were stored is
+        # computed and stored on first load.
+        checksum = self.clf.trained_checksum
+        Classifier.objects.filter(id=self.clf.id).update(trained_checksum='')
+        self.assertIs(Classifier.objects.get(id=self.clf.id).clf, self.clf.clf)
+        self.assertEqual(Classifier.objects.get(id=self.clf.id).trained_checksum, checksum)
 
     def test_training_pixels_collection_and_classifier_training_misconfiguration(self):
         # Create trainingpixels object.
@@ -253,6 +275,31 @@ class SentinelClassifierTest(TestCase):
         X, Y, PID, SID, categories = tr.unpack_collected_pixels()
         self.assertEqual(X.shape, (2625, 3, 4))
 
+    def test_training_pixels_combine_legacy_patches(self):
+        # Patches collected before the dataset format are npz files with the
+        # 2D pixel stacks of the samples.
+        tr = TrainingPixels.objects.create(
+            name='abc',
+            band_names='B03,B04,VH',
+            traininglayer=self.traininglayer,
+            buffer=0,
+            flatten=False,
+        )
+        tr.composites.add(self.composite)
+        tr.composites.add(self.composite2)
+        tr.composites.add(self.composite3)
+        ecs.populate_trainingpixels(tr.id)
+        self.assertTrue(tr.trainingpixelspatch_set.first().collected_pixels.name.endswith('.npz'))
+        tr.flatten = True
+        tr.save()
+        combine_trainingpixels_patches(tr.id)
+        tr.refresh_from_db()
+        self.assertEqual(tr.status, TrainingPixels.FINISHED)
+        X, Y, PID, SID, categories = tr.unpack_collected_pixels()
+        self.assertDictEqual(categories, {'Cloud': 1, 'Shadow': 2, 'Cloud free': 3})
+        self.assertEqual(X.shape, (196, 3, 3))
+        self.assertEqual(Y.shape, (196, ))
+
     def test_training_pixels_collection_2D(self):
         self.traininglayer.continuous = True
         self.traininglayer.save()
@@ -413,6 +460,14 @@ class SentinelClassifierTest(TestCase):
         # Tiles have been created.
         files = self._get_files('tiles/{}/14'.format(pred.rasterlayer_id))
         self.assertEqual(len(files), 1)
+        # The tile manifest contains the predicted tile.
+        tiles = read_prediction_tile_manifest(pred, 0, pred.chunk_size)
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(files[0], '{}.tif'.format(tiles[0][1]))
+        # Chunks of predictions without tile manifest read the index range.
+        pred.tile_manifest = None
+        self.assertEqual(read_prediction_tile_manifest(pred, 0, 1), list(get_aggregationlayer_tile_indices(self.agglayer, 14))[:1])
+        pred.refresh_from_db()
         # Pyramid has been built.
         self.assertTrue(pred.predictedlayerchunk_set.count() > 0)
         self.assertEqual(
@@ -423,6 +478,32 @@ class SentinelClassifierTest(TestCase):
         self.assertIn('Finished building pyramid', pred.log)
         self.assertEqual(pred.status, pred.FINISHED)
 
+    def test_classifier_prediction_incremental(self):
+        train_sentinel_classifier(self.clf.id)
+        pred = PredictedLayer.objects.create(
+            aggregationlayer=self.agglayer,
+            classifier=self.clf,
+            incremental=True,
+        )
+        pred.composites.add(self.composite)
+        predict_sentinel_layer(pred.id)
+        pred.refresh_from_db()
+        self.assertEqual(pred.status, PredictedLayer.FINISHED)
+        self.assertTrue(pred.tile_fingerprints)
+        chunk = pred.predictedlayerchunk_set.get()
+        self.assertEqual(len(read_array_file(chunk.written_tiles)), 1)
+        # Without changes of the inputs, no tiles are predicted again.
+        predict_sentinel_layer(pred.id)
+        pred.refresh_from_db()
+        self.assertEqual(pred.status, PredictedLayer.FINISHED)
+        chunk = pred.predictedlayerchunk_set.get()
+        self.assertEqual(len(read_array_file(chunk.written_tiles)), 0)
+        # A new classifier version changes the fingerprints of all tiles.
+        train_sentinel_classifier(self.clf.id)
+        predict_sentinel_layer(pred.id)
+        chunk = pred.predictedlayerchunk_set.get()
+        self.assertEqual(len(read_array_file(chunk.written_tiles)), 1)
+
     def test_keras_classifier(self):
         self.clf.algorithm = Classifier.KERAS
         self.clf.wrap_keras_with_sklearn = False
@@ -724,7 +805,7 @@ class SentinelClassifierTest(TestCase):
         train_sentinel_classifier(self.clf.id)
         self.clf = Classifier.objects.get(id=self.clf.id)
         self.assertIn('loading from file', self.clf.log)
-        loaded = numpy.load(self.clf.collected_pixels)
+        loaded = open_training_dataset(self.clf.collected_pixels)
         X = loaded['X']
         Y = loaded['Y']
         PID = loaded['PID']
@@ -780,3 +861,115 @@ class SentinelClassifierTest(TestCase):
         self.clf.refresh_from_db()
         self.assertEqual(self.clf.status, Classifier.FAILED)
         self.assertIn('Bad Y value configuration.', self.clf.log)
+
+    def test_training_matrix_accumulator(self):
+        chunks = [
+            (numpy.full((size, 2), size, dtype='uint16'), numpy.full(size, size, dtype='uint8'))
+            for size in (3, 0, 5, 2)
+        ]
+        for spill_bytes in (None, 0):
+            matrix = TrainingMatrixAccumulator([('uint16', (2, )), ('uint8', ())], spill_bytes=spill_bytes)
+            for chunk in chunks:
+                matrix.append(*chunk)
+            self.assertEqual(len(matrix), 10)
+            self.assertEqual(matrix.spilled, spill_bytes is not None)
+            X, Y = matrix.arrays()
+            self.assertEqual(X.shape, (10, 2))
+            self.assertEqual(Y.tolist(), [3, 3, 3, 5, 5, 5, 5, 5, 2, 2])
+            X, Y = matrix.arrays(reverse=True)
+            self.assertEqual(X[:, 0].tolist(), [2, 2, 5, 5, 5, 5, 5, 3, 3, 3])
+            self.assertEqual(Y.dtype, numpy.uint8)
+        # Empty accumulators return empty arrays with the column shapes.
+        X, Y = TrainingMatrixAccumulator([('uint16', (2, )), ('uint8', ())]).arrays()
+        self.assertEqual(X.shape, (0, 2))
+        self.assertEqual(Y.shape, (0, ))
+
+    def test_tile_rasterizer(self):
+        # Two overlapping squares and a triangle spanning multiple tiles.
+        geoms = [
+            GEOSGeometry('SRID=3857;POLYGON((11833687 -469452, 11834187 -469452, 11834187 -468952, 11833687 -468952, 11833687 -469452))'),
+            GEOSGeometry('SRID=3857;POLYGON((11833887 -469252, 11834587 -469252, 11834587 -468552, 11833887 -468552, 11833887 -469252))'),
+            GEOSGeometry('SRID=3857;POLYGON((11830687 -469452, 11836687 -469452, 11833687 -466452, 11830687 -469452))'),
+        ]
+        for all_touched in (True, False):
+            rasterizer = TileRasterizer(geoms, 14, all_touched)
+            self.assertTrue(len(rasterizer.tiles()) > 1)
+            for tilex, tiley in rasterizer.tiles():
+                bounds = tile_bounds(tilex, tiley, 14)
+                rast = GDALRaster({
+                    'width': 256,
+                    'height': 256,
+                    'srid': 3857,
+                    'scale': [tile_scale(14), -tile_scale(14)],
+                    'origin': [bounds[0], bounds[3]],
+                    'datatype': 1,
+                    'nr_of_bands': 1,
+                })
+                # The pixels match the rasterization of each geometry alone.
+                for index, geom in enumerate(geoms):
+                    expected = numpy.flatnonzero(rasterize(geom, rast, all_touched=all_touched).bands[0].data().ravel())
+                    numpy.testing.assert_array_equal(rasterizer.pixels(index, tilex, tiley), expected)
+
+    def test_training_dataset_pixel_sequence(self):
+        X = numpy.arange(3000, dtype='uint16').reshape(1000, 3, 1)
+        Y = X[:, 0, 0] % 3 + 1
+        with tempfile.TemporaryFile() as fl:
+            with TrainingDataset(fl, 'w', chunk_rows=64) as dataset:
+                dataset.append(X=X[:600], Y=Y[:600])
+                dataset.append(X=X[600:], Y=Y[600:])
+                dataset.categories = {'Cloud': 1}
+            with TrainingDataset(fl) as dataset:
+                self.assertEqual(len(dataset), 1000)
+                self.assertEqual(dataset.categories, {'Cloud': 1})
+                numpy.testing.assert_array_equal(dataset['X'][:], X)
+                # The generator reads the selected rows in shuffled chunks.
+                indices = numpy.arange(0, 1000, 3)
+                sequence = PixelSequence(dataset['X'], Y[indices], batch_size=50, indices=indices, num_classes=3)
+                self.assertEqual(sequence.chunk_size, 64)
+                values = []
+                for index in range(len(sequence)):
+                    batch_x, batch_y = sequence[index]
+                    numpy.testing.assert_array_equal(numpy.argmax(batch_y, axis=1) + 1, batch_x[:, 0, 0] % 3 + 1)
+                    values.append(batch_x[:, 0, 0])
+                numpy.testing.assert_array_equal(numpy.sort(numpy.concatenate(values)), X[indices, 0, 0])
+                # Batches mix rows from several chunks and classes.
+                sequence = PixelSequence(dataset['X'], Y, batch_size=50, num_classes=3, buffer_chunks=8)
+                for index in range(len(sequence) - 1):
+                    batch_x, batch_y = sequence[index]
+                    self.assertGreater(len(numpy.unique(batch_x[:, 0, 0] // 64)), 3)
+                    self.assertEqual(numpy.unique(numpy.argmax(batch_y, axis=1)).tolist(), [0, 1, 2])
+                # The scaler gives the same result on disk as in memory.
+                scaler = RNNRobustScaler().fit(dataset['X'])
+                numpy.testing.assert_array_almost_equal(scaler.transform(dataset['X']), RNNRobustScaler().fit(X).transform(X))
+
+    def test_aggregationlayer_tile_manifest(self):
+        agglayer = AggregationLayer.objects.create(name='Diagonal')
+        AggregationArea.objects.create(
+            name='Diagonal area',
+            aggregationlayer=agglayer,
+            geom='SRID=3857;MULTIPOLYGON(((11833687 -469452, 11863687 -439452, 11863687 -439402, 11833687 -469402, 11833687 -469452)))',
+        )
+        tiles = get_aggregationlayer_tile_manifest(agglayer, 14)
+        # Only the tiles along the diagonal are included, not the full tile
+        # range of the bounding box.
+        self.assertEqual(len(tiles), 25)
+        self.assertLess(len(tiles), len(list(get_aggregationlayer_tile_indices(agglayer, 14))))
+        # The tiles are sorted by tilex and tiley.
+        numpy.testing.assert_array_equal(tiles, numpy.array(sorted(tiles.tolist())))
+        # For sieving, the tiles are grouped into square blocks.
+        blocks, starts = get_tile_manifest_blocks(tiles, 4)
+        self.assertEqual(sorted(blocks.tolist()), tiles.tolist())
+        self.assertEqual(starts[0], 0)
+        self.assertEqual(starts[-1], len(tiles))
+        for start, end in zip(starts[:-1], starts[1:]):
+            self.assertLessEqual(end - start, 16)
+            self.assertEqual(len(numpy.unique(blocks[start:end] // 4, axis=0)), 1)
+        # Consecutive blocks are packed into chunks of whole blocks.
+        chunks = pack_tile_manifest_blocks(starts, 16)
+        self.assertLess(len(chunks), len(starts))
+        self.assertEqual(chunks[-1], len(tiles))
+        self.assertTrue(set(chunks).issubset(starts))
+        for start, end in zip(chunks[:-1], chunks[1:]):
+            self.assertLessEqual(end - start, 16)
+        self.assertEqual(pack_tile_manifest_blocks([0, 3, 5, 9], 4), [0, 3, 5, 9])
+        self.assertEqual(pack_tile_manifest_blocks([0, 1, 2, 3, 4], 4), [0, 4])
@@ -1,25 +1,30 @@
 import io
+import json
 import operator
 import tempfile
 from unittest.mock import patch
 
 import dateutil
+import numpy
 from django.contrib.auth.models import User
 from django.contrib.gis.gdal import GDALRaster
+from django.contrib.gis.geos import Polygon
 from django.core.files import File
 from django.db.models.expressions import RawSQL
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from raster.algebra.parser import FormulaParser
 from raster.models import RasterLayer, RasterTile
 from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
-from raster_aggregation.models import AggregationArea, AggregationLayer
-from tests.mock_functions import patch_get_raster_tile_range_100
+from raster.tiles.utils import tile_bounds, tile_scale
+from raster_aggregation.models import AggregationArea, AggregationLayer, ValueCountResult
+from tests.mock_functions import patch_get_raster_tile_range_100, patch_get_raster_tiles_range_100
 
 from classify.models import PredictedLayer
 from formulary.models import Formula, PredictedLayerFormula
 from report.models import ReportAggregation, ReportAggregationLayerSrid, ReportSchedule, ReportScheduleTask
 from report.tasks import push_reports
-from report.utils import populate_vc
+from report.utils import AggregatorProjection, aggregate_zonal, populate_vc, populate_vc_zonal
 from sentinel.models import Composite, MGRSTile, SentinelTile, SentinelTileBand
 
 
@@ -89,6 +94,7 @@ class AggregationViewTestsBase(TestCase):
 
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True, LOCAL=True)
 @patch('report.utils.get_raster_tile', patch_get_raster_tile_range_100)
+@patch('report.utils.get_raster_tiles', patch_get_raster_tiles_range_100)
 class AggregationViewTests(AggregationViewTestsBase):
 
     def test_create_aggregator_composite(self):
@@ -138,6 +144,36 @@ class AggregationViewTests(AggregationViewTestsBase):
         self.assertDictEqual(agg.value, {key: float(val) for key, val in agg.valuecountresult.value.items()})
         self.assertEqual(agg.stats_avg, agg.valuecountresult.stats_avg)
 
+    def test_aggregate_zonal(self):
+        areas = [self.aggarea, self.aggarea2]
+        # Aggregate a discrete and a continuous configuration in one pass.
+        configs = [
+            ReportAggregation(predictedlayer=self.predictedlayer, aggregationlayer=self.agglayer, aggregationarea=self.aggarea),
+            ReportAggregation(formula=self.formula, composite=self.composite, aggregationlayer=self.agglayer, aggregationarea=self.aggarea),
+        ]
+        results = aggregate_zonal([config.get_valuecount() for config in configs], [area.geom for area in areas])
+        self.assertEqual(len(results), 2)
+        for config, stats in zip(configs, results):
+            for index, area in enumerate(areas):
+                agg = ReportAggregation(
+                    formula=config.formula,
+                    composite=config.composite,
+                    predictedlayer=config.predictedlayer,
+                    aggregationlayer=self.agglayer,
+                    aggregationarea=area,
+                )
+                vc = populate_vc_zonal(agg.get_valuecount(), stats, index)
+                self.assertEqual(vc.status, vc.FINISHED)
+                self.assertTrue(vc.stats_cumsum_t0 > 0)
+                # The covered area matches the area by area aggregation.
+                expected = populate_vc(agg.get_valuecount(), 3857)
+                self.assertEqual(vc.stats_cumsum_t0, expected.stats_cumsum_t0)
+                self.assertAlmostEqual(vc.pixel_size_m2, expected.pixel_size_m2)
+                self.assertAlmostEqual(
+                    sum(float(val) for val in vc.value.values()),
+                    sum(float(val) for val in expected.value.values()),
+                )
+
     def test_create_aggregator_predicted_formula(self):
         # Create and populated predictedlayer.
         tile_rst = GDALRaster({
@@ -225,6 +261,44 @@ class AggregationViewTests(AggregationViewTestsBase):
         push_reports('composite', self.composite.id)
         self.assertEqual(ReportAggregation.objects.count(), 2)
 
+    def test_report_schedule_zonal_failure(self):
+        self._create_report_schedule()
+        # A failed zonal pass falls back to the area by area aggregation.
+        with patch('report.tasks.aggregate_zonal', lambda vcs, geoms: [None] * len(vcs)):
+            push_reports('composite', self.composite.id)
+        self.assertEqual(ReportAggregation.objects.count(), 2)
+        for agg in ReportAggregation.objects.all():
+            self.assertEqual(agg.valuecountresult.status, ValueCountResult.FINISHED)
+        task = ReportScheduleTask.objects.get(composite=self.composite, formula=self.formula, aggregationlayer=self.agglayer)
+        self.assertEqual(task.status, ReportScheduleTask.FINISHED)
+        self.assertIn('aggregating area by area', task.log)
+
+    def test_report_schedule_task_failure(self):
+        self._create_report_schedule()
+        # A failing task is marked as failed instead of staying in processing.
+        with patch('report.tasks.populate_vc_zonal', side_effect=ValueError('Broken statistics.')):
+            push_reports('composite', self.composite.id)
+        task = ReportScheduleTask.objects.get(composite=self.composite, formula=self.formula, aggregationlayer=self.agglayer)
+        self.assertEqual(task.status, ReportScheduleTask.FAILED)
+        self.assertIn('Broken statistics.', task.log)
+
+    @override_settings(REPORT_WRITE_BATCH_SIZE=1)
+    def test_report_schedule_rerun_replaces_valuecounts(self):
+        self._create_report_schedule()
+        push_reports('composite', self.composite.id)
+        old_ids = set(ReportAggregation.objects.values_list('valuecountresult_id', flat=True))
+        push_reports('composite', self.composite.id)
+        # The aggregations were updated in place with new valuecounts.
+        self.assertEqual(ReportAggregation.objects.count(), 2)
+        new_ids = set(ReportAggregation.objects.values_list('valuecountresult_id', flat=True))
+        self.assertEqual(len(new_ids), 2)
+        self.assertFalse(old_ids & new_ids)
+        self.assertFalse(ValueCountResult.objects.filter(id__in=old_ids).exists())
+        # The date range was copied from the composite.
+        agg = ReportAggregation.objects.first()
+        self.assertEqual(agg.min_date, Composite.objects.get(id=self.composite.id).min_date)
+        self.assertEqual(agg.max_date, Composite.objects.get(id=self.composite.id).max_date)
+
     def test_report_schedule_populate_reportschedule(self):
         sc = self._create_report_schedule()
         push_reports('reportschedule', sc.id)
@@ -342,6 +416,7 @@ class AggregationViewTests(AggregationViewTestsBase):
 
 @override_settings(CELERY_TASK_ALWAYS_EAGER=True, LOCAL=True)
 @patch('report.utils.get_raster_tile', patch_get_raster_tile_range_100)
+@patch('report.utils.get_raster_tiles', patch_get_raster_tiles_range_100)
 class AggregationViewTestsApi(AggregationViewTestsBase):
 
     def setUp(self):
@@ -455,3 +530,118 @@ class AggregationViewTestsApi(AggregationViewTestsBase):
         expected = list(ReportAggregation.objects.all().order_by('aggregationarea__name', 'min_date').values_list('id', flat=True))
         result = [dat['id'] for dat in result['results']]
         self.assertEqual(result, expected)
+
+
+class AggregatorProjectionTests(TestCase):
+    """
+    Value counts over a block of two by two tiles with the values 1 to 4,
+    surrounded by tiles with the value 9.
+    """
+    tilex = 7804
+    tiley = 6230
+
+    def setUp(self):
+        self.missing = set()
+        bounds = tile_bounds(self.tilex, self.tiley + 1, 14)[:2] + tile_bounds(self.tilex + 1, self.tiley, 14)[2:]
+        self.geom = Polygon.from_bbox(bounds)
+        self.geom.srid = WEB_MERCATOR_SRID
+        # Hectares covered by one tile.
+        self.tile_area = WEB_MERCATOR_TILESIZE ** 2 * tile_scale(14) ** 2 / 10000
+
+    def get_raster_tiles(self, requests, look_up=True):
+        tiles = []
+        for layer_id, tilez, tilex, tiley in requests:
+            if (tilex, tiley) in self.missing:
+                tiles.append(None)
+                continue
+            if 0 <= tilex - self.tilex <= 1 and 0 <= tiley - self.tiley <= 1:
+                value = 1 + tilex - self.tilex + 2 * (tiley - self.tiley)
+            else:
+                value = 9
+            bounds = tile_bounds(tilex, tiley, tilez)
+            tiles.append(GDALRaster({
+                'width': WEB_MERCATOR_TILESIZE,
+                'height': WEB_MERCATOR_TILESIZE,
+                'origin': (bounds[0], bounds[3]),
+                'scale': (tile_scale(tilez), -tile_scale(tilez)),
+                'srid': WEB_MERCATOR_SRID,
+                'datatype': 1,
+                'bands': [{'data': numpy.full((WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), value, dtype='uint8')}],
+            }))
+        return tiles
+
+    def value_count(self, srid=WEB_MERCATOR_SRID):
+        agg = AggregatorProjection(
+            layer_dict={'x': 1},
+            formula='x',
+            zoom=14,
+            geom=self.geom,
+            acres=False,
+            grouping='discrete',
+            srid=srid,
+        )
+        with patch('report.utils.get_raster_tiles', self.get_raster_tiles):
+            return {float(key): float(val) for key, val in agg.value_count().items()}
+
+    def test_value_count_direct_clip(self):
+        # In web mercator, the tiles are clipped without warping.
+        result = self.value_count()
+        self.assertEqual(sorted(result), [1, 2, 3, 4])
+        for value in result.values():
+            self.assertAlmostEqual(value, self.tile_area)
+
+    def test_value_count_column_mosaics(self):
+        expected = self.value_count()
+        # Above the mosaic size limit, the tiles are aggregated by column.
+        with patch('report.utils.REPORT_MOSAIC_MAX_TILES', 0):
+            result = self.value_count()
+        self.assertEqual(sorted(result), sorted(expected))
+        for key, value in expected.items():
+            self.assertAlmostEqual(result[key], value)
+
+    def test_value_count_missing_tile(self):
+        # The pixels of missing tiles are not counted, also without nodata
+        # value.
+        self.missing.add((self.tilex, self.tiley))
+        result = self.value_count()
+        self.assertEqual(sorted(result), [2, 3, 4])
+        for value in result.values():
+            self.assertAlmostEqual(value, self.tile_area)
+        # Same when warping the mosaic.
+        result = self.value_count(3763)
+        self.assertNotIn(0, result)
+        self.assertNotIn(1, result)
+        for key in (2, 3, 4):
+            self.assertIn(key, result)
+
+    def test_count_values_legend(self):
+        legend = [
+            {'name': 'Two', 'expression': '2', 'color': '#00FF00'},
+            {'name': 'High', 'expression': 'x > 3', 'color': '#0000FF'},
+            {'name': 'One', 'expression': '1', 'color': '#FF0000'},
+            {'name': 'Half', 'expression': '2.5', 'color': '#FFFF00'},
+            {'name': 'Absent', 'expression': '7', 'color': '#00FFFF'},
+            {'name': 'Low', 'expression': '(x >= 1) & (x < 3)', 'color': '#FF00FF'},
+        ]
+        agg = AggregatorProjection(
+            layer_dict={'x': 1},
+            formula='x',
+            zoom=14,
+            geom=self.geom,
+            acres=False,
+            grouping=json.dumps(legend),
+            srid=WEB_MERCATOR_SRID,
+        )
+        data = numpy.random.randint(0, 6, 1000)
+        for result_data in (data.astype('uint8'), data.astype('float32'), data.astype('float32') / 2, data[:0].astype('uint8')):
+            # The counts match the comparison of each legend entry.
+            expected = {}
+            for entry in legend:
+                try:
+                    selector = result_data == float(entry['expression'])
+                except ValueError:
+                    selector = FormulaParser().evaluate({'x': result_data}, entry['expression'])
+                expected[entry['expression']] = numpy.sum(selector)
+            result = agg._count_values(result_data)
+            self.assertEqual(list(result), [entry['expression'] for entry in legend])
+            self.assertEqual({key: int(val) for key, val in result.items()}, {key: int(val) for key, val in expected.items()})
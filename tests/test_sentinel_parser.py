@@ -3,14 +3,16 @@ import tempfile
 from unittest import skip
 from unittest.mock import patch
 
+import numpy
 from django.contrib.gis.gdal import OGRGeometry
 from django.core.files import File
 from django.core.files.storage import default_storage
 from django.test import TestCase, override_settings
 from raster_aggregation.models import AggregationArea, AggregationLayer
 from tests.mock_functions import (
-    client_get_object, iterator_search, patch_get_raster_tile, patch_process_l2a, patch_snap_terrain_correction,
-    patch_write_raster_tile, point_to_test_file
+    client_get_object, iterator_search, patch_get_raster_tile, patch_get_raster_tiles, patch_get_raster_tiles_seeded,
+    patch_process_l2a, patch_snap_terrain_correction, patch_write_raster_tile, patch_write_raster_tiles,
+    point_to_test_file
 )
 
 from classify.models import Classifier
@@ -19,7 +21,7 @@ from sentinel.models import (
     BucketParseLog, Composite, CompositeBuild, CompositeTile, MGRSTile, SentinelTile, SentinelTileBand
 )
 from sentinel.tasks import (
-    clear_composite, clear_sentineltile, composite_build_callback, generate_bands_and_sceneclass,
+    clear_composite, clear_sentineltile, composite_build_callback, compositetile_stacks, generate_bands_and_sceneclass,
     sync_sentinel_bucket_utm_zone
 )
 from sentinel_1 import const as s1const
@@ -31,17 +33,21 @@ MEDIA_ROOT = tempfile.mkdtemp()
 @patch('sentinel.tasks.boto3.session.botocore.paginate.PageIterator.search', iterator_search)
 @patch('sentinel.tasks.boto3.session.Session.client', client_get_object)
 @patch('sentinel.tasks.get_raster_tile', patch_get_raster_tile)
+@patch('sentinel.tasks.get_raster_tiles', patch_get_raster_tiles)
 @patch('sentinel.tasks.write_raster_tile', patch_write_raster_tile)
+@patch('sentinel.tasks.write_raster_tiles', patch_write_raster_tiles)
 @patch('raster.tiles.parser.urlretrieve', point_to_test_file)
 @patch('jobs.ecs.process_l2a', patch_process_l2a)
 @patch('jobs.ecs.snap_terrain_correction', patch_snap_terrain_correction)
-@override_settings(CELERY_TASK_ALWAYS_EAGER=True, LOCAL=True, MEDIA_ROOT=MEDIA_ROOT)
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, LOCAL=True, MEDIA_ROOT=MEDIA_ROOT, COMPOSITE_STACK_PREFETCH=False, TILE_WRITE_WORKERS=0)
 class SentinelBucketParserTest(TestCase):
 
     @patch('sentinel.tasks.boto3.session.botocore.paginate.PageIterator.search', iterator_search)
     @patch('sentinel.tasks.boto3.session.Session.client', client_get_object)
     @patch('sentinel.tasks.get_raster_tile', patch_get_raster_tile)
+    @patch('sentinel.tasks.get_raster_tiles', patch_get_raster_tiles)
     @patch('sentinel.tasks.write_raster_tile', patch_write_raster_tile)
+    @patch('sentinel.tasks.write_raster_tiles', patch_write_raster_tiles)
     @patch('raster.tiles.parser.urlretrieve', point_to_test_file)
     @patch('jobs.ecs.process_l2a', patch_process_l2a)
     @patch('jobs.ecs.snap_terrain_correction', patch_snap_terrain_correction)
@@ -163,6 +169,9 @@ class SentinelBucketParserTest(TestCase):
             sorted(default_storage.listdir(os.path.join(path, default_storage.listdir(path)[0][0]))[1]),
             expected,
         )
+        # The pyramid has been built from the composite tile mosaic.
+        path = 'tiles/{}/{}'.format(band.rasterlayer.id, ctile.tilez)
+        self.assertEqual(default_storage.listdir(path)[0], [str(ctile.tilex)])
         # Run the classifier based version.
         with open('tests/data/classifier-1.pickle', 'rb') as fl:
             self.build.cloud_classifier = Classifier.objects.create(name='Test', trained=File(fl))
@@ -181,6 +190,19 @@ class SentinelBucketParserTest(TestCase):
         stile.refresh_from_db()
         self.assertEqual(stile.status, SentinelTile.UNPROCESSED)
 
+    @patch('sentinel.tasks.get_raster_tiles', patch_get_raster_tiles_seeded)
+    def test_compositetile_stacks_prefetch(self):
+        composite_build_callback(self.build.id, initiate=True, rebuild=True)
+        ctile = self.build.compositetiles.first()
+        expected = list(compositetile_stacks(ctile))
+        self.assertTrue(len(expected) > 0)
+        # Prefetching the parent tiles in the background yields the same stacks.
+        with self.settings(COMPOSITE_STACK_PREFETCH=True):
+            result = list(compositetile_stacks(ctile))
+        self.assertEqual([(x, y) for x, y, stacks in result], [(x, y) for x, y, stacks in expected])
+        for (x, y, stacks), (ex, ey, expected_stacks) in zip(result, expected):
+            numpy.testing.assert_array_equal(stacks, expected_stacks)
+
     def test_bucket_parser(self):
         # Check mgrs
         self.assertEqual(MGRSTile.objects.count(), 3)
@@ -1,7 +1,7 @@
 import numpy
 from django.test import TestCase
 
-from sentinel.tasks import aggregate_tile, disaggregate_tile
+from sentinel.utils import AGGREGATE_MODE, aggregate_tile, aggregate_tile_gdal, disaggregate_tile
 
 
 class AggregatorTests(TestCase):
@@ -20,6 +20,46 @@ class AggregatorTests(TestCase):
         self.assertEqual(7, result[0, 3])
         self.assertEqual(result.dtype, numpy.uint16)
 
+    def test_aggregator_gdal_parity(self):
+        # Nearest neighbor matches gdal exactly.
+        tile = numpy.random.randint(0, 12, (512, 512)).astype('uint8')
+        numpy.testing.assert_array_equal(
+            aggregate_tile(tile, discrete=True),
+            aggregate_tile_gdal(tile, discrete=True),
+        )
+        # For smooth data, the block average matches bilinear resampling away
+        # from the tile edges.
+        rows, cols = numpy.mgrid[0:512, 0:512]
+        tile = (7 * rows + 3 * cols).astype('uint16')
+        result = aggregate_tile(tile).astype('int32')
+        expected = aggregate_tile_gdal(tile).astype('int32')
+        self.assertEqual(result.shape, (256, 256))
+        self.assertLessEqual(numpy.abs(result - expected)[1:-1, 1:-1].max(), 1)
+
+    def test_aggregator_nodata(self):
+        tile = numpy.array([
+            [0, 4, 0, 0],
+            [8, 0, 0, 0],
+            [1, 1, 5, 5],
+            [2, 1, 5, 0],
+        ], dtype='uint8')
+        # Nodata is ignored in the average and empty blocks stay empty.
+        result = aggregate_tile(tile, nodata=0)
+        self.assertEqual(result.tolist(), [[6, 0], [1, 5]])
+        # Nearest falls back to pixels with data.
+        result = aggregate_tile(tile, discrete=True, nodata=0)
+        self.assertEqual(result.tolist(), [[8, 0], [1, 5]])
+        # Mode uses the most frequent value.
+        result = aggregate_tile(tile, nodata=0, method=AGGREGATE_MODE)
+        self.assertEqual(result.tolist(), [[8, 0], [1, 5]])
+
+    def test_aggregator_batch(self):
+        tiles = numpy.random.randint(0, 1000, (3, 512, 512)).astype('uint16')
+        result = aggregate_tile(tiles, target_dtype='uint16', nodata=0)
+        self.assertEqual(result.shape, (3, 256, 256))
+        for index in range(3):
+            numpy.testing.assert_array_equal(result[index], aggregate_tile(tiles[index], target_dtype='uint16', nodata=0))
+
     def test_disaggregator(self):
         data = numpy.arange(1, 256 * 256 + 1)
         factor = 2
@@ -1,8 +1,23 @@
 import datetime
+import tempfile
+import types
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
-from django.test import TestCase
+import numpy
+from django.contrib.gis.gdal import GDALRaster
+from django.test import TestCase, override_settings
 
-from sentinel.clouds.utils import sun
+from sentinel import const
+from sentinel.clouds.algorithms import Clouds
+from sentinel.clouds.pool import CloudSelectionPool
+from sentinel.clouds.utils import BandStack, stack_array, sun
+from sentinel.tasks import write_compositetile_s2_results
+from sentinel.tilecache import TileCache, get_tile_cache, use_tile_cache
+from sentinel.tileencoder import GDALTileEncoder, TiffTileEncoder
+from sentinel.tileindex import TileIndex, get_tile_index, use_tile_index
+from sentinel.tilestore import LocalTileStore, get_tile_store, layer_prefix, tile_key
+from sentinel.utils import TileMosaic, TileWriter, _candidate_zooms
 
 
 class UtilsTests(TestCase):
@@ -16,3 +31,219 @@ class UtilsTests(TestCase):
             sun(date, lat, lon),
             expected,
         )
+
+    def test_local_tile_store(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalTileStore(root)
+            key = tile_key(23, 14, 3, 4)
+            self.assertEqual(key, 'tiles/23/14/3/4.tif')
+            self.assertIsNone(store.get(key))
+            store.put(key, b'tile')
+            store.put(tile_key(24, 14, 3, 4), b'other')
+            self.assertEqual(store.get(key), b'tile')
+            self.assertEqual(list(store.list(layer_prefix(23))), [key])
+            store.delete_prefix(layer_prefix(23))
+            self.assertIsNone(store.get(key))
+            self.assertEqual(store.get(tile_key(24, 14, 3, 4)), b'other')
+
+    def test_tile_index(self):
+        with tempfile.TemporaryDirectory() as root:
+            with override_settings(MEDIA_ROOT=root):
+                get_tile_store().put(tile_key(23, 12, 1, 2), b'tile')
+                index = TileIndex(ttl=60)
+                # Ancestor zoom levels are resolved from the store listing.
+                self.assertEqual(index.find_zoom(23, 14, 5, 9, range(13, -1, -1)), 12)
+                self.assertIsNone(index.find_zoom(23, 14, 9, 9, range(13, -1, -1)))
+                # Written tiles are added to loaded zoom levels.
+                index.add(23, 13, 4, 4)
+                self.assertEqual(index.find_zoom(23, 14, 9, 9, range(13, -1, -1)), 13)
+                # Misses are cached until the tile is written.
+                index.add_missing(23, 14, 9, 9)
+                self.assertTrue(index.is_missing(23, 14, 9, 9))
+                index.add(23, 14, 9, 9)
+                self.assertFalse(index.is_missing(23, 14, 9, 9))
+                # Dropping the layer forgets all entries.
+                index.add_missing(23, 14, 9, 9)
+                index.drop_layer(23)
+                self.assertFalse(index.is_missing(23, 14, 9, 9))
+                self.assertEqual(index.column_tiles(23, 13, 4), set())
+                # A zero time to live disables the negative cache.
+                index = TileIndex(ttl=0)
+                index.add_missing(23, 14, 9, 9)
+                self.assertFalse(index.is_missing(23, 14, 9, 9))
+                # The negative cache drops the oldest misses.
+                index = TileIndex(ttl=60, max_missing=2)
+                for tiley in range(3):
+                    index.add_missing(23, 14, 9, tiley)
+                self.assertFalse(index.is_missing(23, 14, 9, 0))
+                self.assertTrue(index.is_missing(23, 14, 9, 1))
+                self.assertTrue(index.is_missing(23, 14, 9, 2))
+                # Concurrent requests for a tile column share one listing.
+                index = TileIndex(ttl=60)
+                store = get_tile_store()
+                with patch.object(store, 'list', wraps=store.list) as listing:
+                    with ThreadPoolExecutor(4) as executor:
+                        results = list(executor.map(lambda i: index.column_tiles(23, 12, 1), range(8)))
+                self.assertEqual(listing.call_count, 1)
+                listing.assert_called_with('tiles/23/12/1/')
+                self.assertEqual(results, [{2}] * 8)
+                # The index is only enabled within jobs.
+                self.assertFalse(get_tile_index().enabled)
+                with use_tile_index(ttl=60) as index:
+                    self.assertIs(get_tile_index(), index)
+                    self.assertTrue(index.enabled)
+                    with use_tile_index() as nested:
+                        self.assertIs(nested, index)
+                    # Zoom levels below the indexed one or all lower zoom levels
+                    # are probed in case the index is outdated.
+                    self.assertEqual(list(_candidate_zooms(23, 14, 5, 9, True)), [14, 12] + list(range(11, -1, -1)))
+                    self.assertEqual(list(_candidate_zooms(23, 14, 9, 9, True)), list(range(14, -1, -1)))
+                    self.assertEqual(list(_candidate_zooms(23, 14, 9, 9, False)), [14])
+                self.assertFalse(get_tile_index().enabled)
+
+    def test_tile_cache(self):
+        def make_tile(value):
+            return GDALRaster({
+                'width': 4,
+                'height': 4,
+                'srid': 3857,
+                'datatype': 1,
+                'bands': [{'nodata_value': 0, 'data': numpy.full((4, 4), value, dtype='uint8')}],
+            })
+        # The cache holds two tiles of 16 bytes.
+        cache = TileCache(max_bytes=32)
+        self.assertIsNone(cache.get((1, 2, 3, 4)))
+        cache.put((1, 2, 3, 4), make_tile(1))
+        cache.put((1, 2, 3, 5), make_tile(2))
+        tile = cache.get((1, 2, 3, 4))
+        self.assertEqual(tile.bands[0].data().tolist(), numpy.full((4, 4), 1).tolist())
+        self.assertEqual(tile.bands[0].nodata_value, 0)
+        # The least recently used tile is evicted.
+        cache.put((1, 2, 3, 6), make_tile(3))
+        self.assertIsNone(cache.get((1, 2, 3, 5)))
+        self.assertIsNotNone(cache.get((1, 2, 3, 6)))
+        cache.invalidate((1, 2, 3, 6))
+        self.assertIsNone(cache.get((1, 2, 3, 6)))
+        self.assertEqual(cache.stats, {'hits': 2, 'misses': 3, 'evictions': 1, 'entries': 1, 'nbytes': 16})
+        # The process-wide cache is only active within jobs.
+        self.assertIsNone(get_tile_cache())
+        with use_tile_cache() as cache:
+            self.assertIs(get_tile_cache(), cache)
+            with use_tile_cache() as nested:
+                self.assertIs(nested, cache)
+            self.assertIs(get_tile_cache(), cache)
+        self.assertIsNone(get_tile_cache())
+
+    def make_stacks(self, scenes=3):
+        stacks = []
+        for i in range(scenes):
+            stack = {key: numpy.random.randint(1, 10000, (256, 256)).astype('uint16') for key in const.ALL_BANDS}
+            stack[const.SCL] = numpy.random.randint(0, 12, (256, 256)).astype('uint8')
+            # Add nodata pixels.
+            stack[const.BD2][:10, :10] = const.SENTINEL_NODATA_VALUE
+            stacks.append(stack)
+        return stacks
+
+    def test_cloud_scoring_stack_array(self):
+        stacks = self.make_stacks()
+        array = stack_array(stacks)
+        self.assertEqual(array.shape, (3, len(const.ALL_BANDS), 256, 256))
+        for version in (1, 2, 3, 6, 7):
+            clouds = Clouds(types.SimpleNamespace(cloud_classifier=None, cloud_version=version))
+            # The vectorized scores match the scores of the individual scenes.
+            expected = [clouds.clouds(stack) for stack in stacks]
+            numpy.testing.assert_array_equal(clouds.clouds(BandStack(array)), expected)
+
+    def test_cloud_selection_pool(self):
+        clouds = Clouds(types.SimpleNamespace(cloud_classifier=None, cloud_version=7))
+        tiles = [(tilex, 7, stack_array(self.make_stacks())) for tilex in range(4)]
+        expected = {tilex: clouds.composite(stacks) for tilex, tiley, stacks in tiles}
+        with CloudSelectionPool(clouds, 2) as pool:
+            results = list(pool.imap(iter(tiles)))
+        self.assertEqual(sorted(tilex for tilex, tiley, result in results), [0, 1, 2, 3])
+        for tilex, tiley, result in results:
+            self.assertEqual(tiley, 7)
+            self.assertEqual(set(result), set(expected[tilex]))
+            for key, data in result.items():
+                self.assertEqual(data.dtype, expected[tilex][key].dtype)
+                numpy.testing.assert_array_equal(data, expected[tilex][key])
+
+    def test_tile_encoders(self):
+        origin = (-20037508.342789244, 20037508.342789244)
+        data = numpy.random.randint(1, 10000, (256, 256)).astype('uint16')
+        data[:10, :10] = 0
+        probs = numpy.random.random((3, 256, 256)).astype('float32')
+        for encoder in (GDALTileEncoder(), TiffTileEncoder(), TiffTileEncoder('deflate', 1)):
+            tile = GDALRaster(encoder.encode([data.ravel()], origin, 10, 2, 0))
+            self.assertEqual(tile.srid, 3857)
+            self.assertEqual((tile.width, tile.height), (256, 256))
+            self.assertAlmostEqual(tile.origin.x, origin[0])
+            self.assertAlmostEqual(tile.origin.y, origin[1])
+            self.assertEqual(tuple(tile.scale), (10, -10))
+            self.assertEqual(tile.bands[0].nodata_value, 0)
+            numpy.testing.assert_array_equal(tile.bands[0].data(), data)
+            # Multi band tiles without nodata value.
+            tile = GDALRaster(encoder.encode(list(probs), origin, 10, 6))
+            self.assertEqual(len(tile.bands), 3)
+            for index, band in enumerate(tile.bands):
+                self.assertIsNone(band.nodata_value)
+                numpy.testing.assert_array_equal(band.data(), probs[index])
+
+    def test_tile_writer(self):
+        written = []
+        for workers in (0, 2):
+            with TileWriter(workers) as writer:
+                for index in range(10):
+                    writer.submit(written.append, index)
+            self.assertEqual(sorted(written), list(range(10)))
+            written.clear()
+        # Errors of the writes are raised.
+        with self.assertRaises(ZeroDivisionError):
+            with TileWriter(2) as writer:
+                writer.submit(lambda: 1 / 0)
+
+    def test_tile_mosaic_threads(self):
+        bands = {key: ('uint16', const.SENTINEL_NODATA_VALUE) for key in const.ALL_BANDS}
+        with TileMosaic(4, 6, 13, 14, bands) as mosaic:
+            # Fill the mosaic from multiple writer threads.
+            with TileWriter(4) as writer:
+                for tilex in range(8, 10):
+                    for tiley in range(12, 14):
+                        for index, key in enumerate(const.ALL_BANDS):
+                            data = numpy.full(256 * 256, index * 100 + tilex * 10 + tiley, dtype='uint16')
+                            writer.submit(mosaic.add, key, tilex, tiley, data)
+            self.assertEqual(mosaic.filled, set(const.ALL_BANDS))
+            for index, key in enumerate(const.ALL_BANDS):
+                array = mosaic.array(key)
+                self.assertEqual(array.shape, (512, 512))
+                for tilex in range(8, 10):
+                    for tiley in range(12, 14):
+                        row, col = tiley - 12, tilex - 8
+                        tile = array[row * 256:(row + 1) * 256, col * 256:(col + 1) * 256]
+                        self.assertTrue(numpy.all(tile == index * 100 + tilex * 10 + tiley))
+
+    def test_write_compositetile_s2_results_threads(self):
+        written = []
+
+        def write_raster_tile(layer_id, data, tilez, tilex, tiley, **kwargs):
+            written.append((layer_id, tilez, tilex, tiley))
+
+        lookup = {key: index for index, key in enumerate(const.ALL_BANDS)}
+        results = [
+            (tilex, tiley, {key: numpy.full(256 * 256, index * 100 + tilex * 10 + tiley, dtype='uint16') for key, index in lookup.items()})
+            for tilex in range(8, 10) for tiley in range(12, 14)
+        ]
+        bands = {key: ('uint16', const.SENTINEL_NODATA_VALUE) for key in const.ALL_BANDS}
+        with patch('sentinel.tasks.write_raster_tile', write_raster_tile):
+            with TileMosaic(4, 6, 13, 14, bands) as mosaic:
+                # The tiles are written from multiple threads.
+                with TileWriter(4) as writer:
+                    write_compositetile_s2_results(types.SimpleNamespace(), lookup, results, writer, mosaic)
+                for key, index in lookup.items():
+                    array = mosaic.array(key)
+                    for tilex, tiley, result in results:
+                        row, col = tiley - 12, tilex - 8
+                        tile = array[row * 256:(row + 1) * 256, col * 256:(col + 1) * 256]
+                        self.assertTrue(numpy.all(tile == index * 100 + tilex * 10 + tiley))
+        expected = [(index, 14, tilex, tiley) for tilex, tiley, result in results for index in lookup.values()]
+        self.assertEqual(sorted(written), sorted(expected))